@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Measures the encoding and decoding speed of every installed codec of
+:py:mod:`snorky.codec` with typical Snorky messages.
+
+Usage: benchmark_codecs.py [iterations]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from snorky.codec import codec_classes, default_codec
+
+
+def make_messages():
+    row = {
+        "id": 42,
+        "title": u"Buy milk and some bread",
+        "completed": False,
+        "tags": ["home", "shopping"],
+        "list": {"id": 7, "owner": "alice"},
+        "createdAt": "2014-05-02T13:21:06Z",
+        "priority": 2.5,
+    }
+    return {
+        "delta": {
+            "service": "datasync",
+            "message": {
+                "type": "delta",
+                "delta": {"type": "update", "model": "Task",
+                          "newData": row, "oldData": row},
+            },
+        },
+        "publish": {
+            "service": "pubsub",
+            "message": {
+                "command": "publish",
+                "params": {"channel": "news", "message": "Hello world"},
+            },
+        },
+        "publishDeltas": {
+            "service": "datasync_backend",
+            "message": {
+                "command": "publishDeltas",
+                "params": {"deltas": [
+                    {"type": "insert", "model": "Task", "data": row}
+                ] * 50},
+            },
+        },
+    }
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    messages = make_messages()
+
+    print("Default codec: %s" % default_codec.name)
+    print("%-10s %-14s %12s %12s" % ("codec", "message", "encode/s",
+                                     "decode/s"))
+    for cls in codec_classes:
+        if not cls.available:
+            print("%-10s (not installed)" % cls.name)
+            continue
+        codec = cls()
+        for name, message in sorted(messages.items()):
+            text = codec.dumps(message)
+            encode_time = timeit.timeit(lambda: codec.dumps(message),
+                                        number=iterations)
+            decode_time = timeit.timeit(lambda: codec.loads(text),
+                                        number=iterations)
+            print("%-10s %-14s %12.0f %12.0f" % (
+                codec.name, name, iterations / encode_time,
+                iterations / decode_time))
+
+
+if __name__ == "__main__":
+    main()
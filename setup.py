@@ -22,7 +22,7 @@ setup(
     author_email='ntrrgc@gmail.com',
     packages=find_packages(),
     install_requires=[
-        "tornado<5.0",
+        "tornado>=4.5,<5.0",
         "requests",
         "funcsigs",
         "python-dateutil",
@@ -3,8 +3,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import requests
-import json
 import logging
+from snorky.codec import default_codec
 
 log = logging.getLogger('snorky')
 websession = requests.session()
@@ -19,10 +19,12 @@ class SnorkyHTTPTransport(object):
         self.url = url
         self.key = key
 
-    def send(self, message, json=json):
+    def send(self, message, json=default_codec):
         """Sends a message to Snorky service, encoded in JSON with the
-        library provided in the optional ``json`` argument (by default it will
-        use the default :mod:`json` module).
+        library provided in the optional ``json`` argument, which may be any
+        object with the ``dumps`` and ``loads`` functions of :mod:`json`, like
+        a codec from :py:mod:`snorky.codec` (by default
+        :py:data:`snorky.codec.default_codec`).
         """
         response = websession.post(self.url, headers={
             "X-Backend-Key": self.key,
@@ -45,14 +47,21 @@ class SnorkyHTTPTransport(object):
 
 class SnorkyBackend(object):
     """Provides methods to send messanges and make calls against Snorky RPC
-    services."""
-    def __init__(self, transport, json=json):
+    services.
+
+    Messages are encoded with ``codec``, by default
+    :py:data:`snorky.codec.default_codec`. ``json`` is an older name for the
+    same argument.
+    """
+    def __init__(self, transport, codec=None, json=None):
         self.transport = transport
-        self.json = json
+        if codec is None:
+            codec = json if json is not None else default_codec
+        self.codec = codec
 
     def send(self, message):
         """Send a bare message to Snorky."""
-        return self.transport.send(message, json=self.json)
+        return self.transport.send(message, json=self.codec)
 
     def call(self, service, command, **params):
         """Make an RPC call to a Snorky service.
@@ -10,6 +10,10 @@ class Client(object):
     This is an abstract base class not associated to any protocol.
     """
 
+    codec = None
+    """Codec negotiated by the client, if any. Otherwise the codec of the
+    service registry is used."""
+
     def __init__(self):
         self.identity = None
 
@@ -21,6 +25,9 @@ class Client(object):
     @abstractmethod
     def send(self, msg):
         """Send a message to the client. The message must be a JSON entity,
-        e.g. dictionary, string or number.
+        e.g. dictionary, string or number, or a
+        :py:class:`snorky.codec.EncodedMessage`, which must be encoded with
+        its ``encode_with`` method so the encoding is shared with the other
+        clients receiving it.
         """
         pass
@@ -0,0 +1,335 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import struct
+from snorky.hashable import HashableDict, HashableList, make_hashable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+__all__ = ('Codec', 'JSONCodec', 'OrjsonCodec', 'MsgspecCodec', 'UJSONCodec',
+           'MsgpackCodec', 'CBORCodec',
+           'get_codec', 'get_subprotocol_codec', 'default_codec',
+           'EncodedMessage')
+
+
+class Codec(object):
+    """Encodes and decodes messages.
+
+    A codec has the ``dumps`` and ``loads`` methods of :mod:`json`, so it can
+    be used wherever a JSON module is expected. ``loads`` raises
+    :py:class:`ValueError` on invalid input.
+    """
+    __slots__ = ()
+
+    name = None
+    """Name of the codec, as accepted by :py:func:`get_codec`."""
+
+    format = None
+    """Name of the encoding, for humans."""
+
+    available = True
+    """Whether the library used by the codec is installed."""
+
+    binary = False
+    """Whether ``dumps`` returns bytes instead of a character string."""
+
+    subprotocol = None
+    """WebSocket subprotocol a client must request in order to exchange
+    messages encoded with this codec."""
+
+    def dumps(self, obj):
+        """Encodes a message."""
+        raise NotImplementedError
+
+    def loads(self, data):
+        """Decodes a message."""
+        raise NotImplementedError
+
+    def loads_hashable(self, data):
+        """Decodes a message into a hashable entity, as returned by
+        :py:func:`snorky.hashable.make_hashable`."""
+        return make_hashable(self.loads(data))
+
+    def join(self, encoded_messages):
+        """Returns an array of messages already encoded with this codec,
+        encoded without decoding the messages."""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<%s>" % self.__class__.__name__
+
+
+class JSONCodec(Codec):
+    """Encodes and decodes JSON messages with the standard :mod:`json`
+    module.
+
+    ``dumps`` always returns a character string and ``loads`` accepts either
+    a character string or UTF-8 bytes.
+
+    The subclasses use faster third party libraries and fall back to this
+    class for the few inputs those libraries do not support.
+    """
+    __slots__ = ()
+
+    name = 'json'
+    format = 'JSON'
+    subprotocol = 'snorky.json'
+
+    def dumps(self, obj):
+        """Encodes a JSON entity as a JSON string."""
+        return json.dumps(obj)
+
+    def loads(self, text):
+        """Decodes a JSON string or UTF-8 bytes."""
+        if isinstance(text, bytes):
+            text = text.decode('UTF-8')
+        return json.loads(text)
+
+    def join(self, encoded_messages):
+        return '[' + ','.join(encoded_messages) + ']'
+
+
+class OrjsonCodec(JSONCodec):
+    """Codec using the ``orjson`` library."""
+    __slots__ = ()
+
+    name = 'orjson'
+    available = orjson is not None
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj).decode('UTF-8')
+        except TypeError:
+            # Non string keys, integers over 64 bits...
+            return super(OrjsonCodec, self).dumps(obj)
+
+    def loads(self, text):
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            # Either invalid JSON, which will fail again, or something orjson
+            # does not support, like integers over 64 bits.
+            return super(OrjsonCodec, self).loads(text)
+
+
+class MsgspecCodec(JSONCodec):
+    """Codec using the ``msgspec`` library."""
+    __slots__ = ()
+
+    name = 'msgspec'
+    available = msgspec is not None
+
+    def dumps(self, obj):
+        try:
+            return msgspec.json.encode(obj).decode('UTF-8')
+        except (TypeError, msgspec.EncodeError):
+            return super(MsgspecCodec, self).dumps(obj)
+
+    def loads(self, text):
+        try:
+            return msgspec.json.decode(text)
+        except msgspec.DecodeError:
+            return super(MsgspecCodec, self).loads(text)
+
+
+class UJSONCodec(JSONCodec):
+    """Codec using the ``ujson`` library."""
+    __slots__ = ()
+
+    name = 'ujson'
+    available = ujson is not None
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(obj)
+        except (TypeError, OverflowError):
+            return super(UJSONCodec, self).dumps(obj)
+
+    def loads(self, text):
+        try:
+            return ujson.loads(text)
+        except (ValueError, OverflowError):
+            return super(UJSONCodec, self).loads(text)
+
+
+class MsgpackCodec(Codec):
+    """Binary codec using the ``msgpack`` library."""
+    __slots__ = ()
+
+    name = 'msgpack'
+    format = 'MessagePack'
+    available = msgpack is not None
+    binary = True
+    subprotocol = 'snorky.msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return self.unpack(data)
+
+    def loads_hashable(self, data):
+        # Built directly by the unpacker, without copying the message.
+        return self.unpack(data, object_hook=HashableDict,
+                           list_hook=HashableList)
+
+    def join(self, encoded_messages):
+        length = len(encoded_messages)
+        if length < 16:
+            header = struct.pack('B', 0x90 | length)
+        elif length < 0x10000:
+            header = struct.pack('>BH', 0xdc, length)
+        else:
+            header = struct.pack('>BI', 0xdd, length)
+        return header + b''.join(encoded_messages)
+
+    def unpack(self, data, **kwargs):
+        try:
+            return msgpack.unpackb(data, raw=False, **kwargs)
+        except Exception as error:
+            # msgpack raises many unrelated exception types
+            raise ValueError("Invalid MessagePack: %s" % error)
+
+
+class CBORCodec(Codec):
+    """Binary codec using the ``cbor2`` library."""
+    __slots__ = ()
+
+    name = 'cbor'
+    format = 'CBOR'
+    available = cbor2 is not None
+    binary = True
+    subprotocol = 'snorky.cbor'
+
+    def dumps(self, obj):
+        return cbor2.dumps(obj)
+
+    def loads(self, data):
+        try:
+            return cbor2.loads(data)
+        except Exception as error:
+            # The exception types of cbor2 differ between versions
+            raise ValueError("Invalid CBOR: %s" % error)
+
+    def join(self, encoded_messages):
+        # Array header: major type 4 and the length
+        length = len(encoded_messages)
+        if length < 24:
+            header = struct.pack('B', 0x80 | length)
+        elif length < 0x100:
+            header = struct.pack('>BB', 0x98, length)
+        elif length < 0x10000:
+            header = struct.pack('>BH', 0x99, length)
+        else:
+            header = struct.pack('>BI', 0x9a, length)
+        return header + b''.join(encoded_messages)
+
+
+codec_classes = (OrjsonCodec, MsgspecCodec, UJSONCodec, JSONCodec)
+"""JSON codec classes, fastest first."""
+
+binary_codec_classes = (MsgpackCodec, CBORCodec)
+"""Binary codec classes, which may be negotiated by WebSocket clients."""
+
+
+def get_codec(name=None):
+    """Returns a codec by name.
+
+    If no name is specified, the fastest JSON codec whose library is
+    installed is returned. :py:class:`ValueError` is raised if the codec does
+    not exist or its library is not installed.
+    """
+    if name is None:
+        return next(cls() for cls in codec_classes if cls.available)
+
+    for cls in codec_classes + binary_codec_classes:
+        if cls.name == name:
+            if not cls.available:
+                raise ValueError("The %s codec requires a library which is "
+                                 "not installed" % name)
+            return cls()
+    raise ValueError("Unknown codec: %s" % name)
+
+
+def get_subprotocol_codec(subprotocol):
+    """Returns a binary codec for a WebSocket subprotocol, or ``None`` if the
+    subprotocol is unknown or the library of its codec is not installed."""
+    for cls in binary_codec_classes:
+        if cls.subprotocol == subprotocol and cls.available:
+            return cls()
+    return None
+
+
+default_codec = get_codec()
+"""The codec used by default by service registries."""
+
+
+class EncodedMessage(object):
+    """A message sent to many clients, which is encoded only once per codec
+    instead of once per client.
+
+    Transports send it encoded with :py:meth:`encode_with` and the codec of
+    the client or of their service registry.
+    """
+    __slots__ = ('msg', 'encodings')
+
+    def __init__(self, msg):
+        self.msg = msg
+        """The message, as a JSON entity."""
+
+        self.encodings = {}
+        """Encodings of the message made so far, by codec class."""
+
+    def decode(self):
+        """Returns the message as a JSON entity."""
+        return self.msg
+
+    def encode_with(self, codec):
+        """Returns the message encoded with a codec.
+
+        Encodings are made the first time they are requested and reused
+        afterwards by every codec of the same class."""
+        try:
+            return self.encodings[type(codec)]
+        except KeyError:
+            data = self.encodings[type(codec)] = codec.dumps(self.msg)
+            return data
+
+    def __eq__(self, other):
+        # Only used in unit tests
+        if isinstance(other, EncodedMessage):
+            other = other.decode()
+        return self.decode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "EncodedMessage(%r)" % (self.msg,)
@@ -4,8 +4,8 @@
 
 from tornado.web import RequestHandler, HTTPError, asynchronous
 from snorky.client import Client
+from snorky.codec import EncodedMessage
 from streql import equals # constant time string comparison
-import json
 
 
 class HTTPClient(Client):
@@ -21,7 +21,14 @@ class HTTPClient(Client):
 
     def send(self, msg):
         """Sends a message on the HTTP response."""
-        self.req_handler.write(msg)
+        codec = self.req_handler.service_registry.codec
+        if isinstance(msg, EncodedMessage):
+            text = msg.encode_with(codec)
+        else:
+            text = codec.dumps(msg)
+        self.req_handler.set_header("Content-Type",
+                                    "application/json; charset=UTF-8")
+        self.req_handler.write(text)
         self.req_handler.finish()
 
 
@@ -53,7 +60,7 @@ class BackendHTTPHandler(RequestHandler):
         self.check_api_key()
 
         try:
-            msg = json.loads(self.request.body.decode("UTF-8"))
+            msg = self.service_registry.codec.loads(self.request.body)
         except ValueError:
             raise HTTPError(400, "Invalid JSON")
 
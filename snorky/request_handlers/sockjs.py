@@ -4,7 +4,7 @@
 
 from sockjs.tornado import SockJSRouter, SockJSConnection
 from snorky.client import Client
-import json
+from snorky.codec import EncodedMessage
 
 
 class SockJSClient(Client):
@@ -20,7 +20,11 @@ class SockJSClient(Client):
 
     def send(self, msg):
         """Sends a message through the SockJS channel."""
-        self.req_handler.send(json.dumps(msg))
+        codec = self.req_handler.service_registry.codec
+        if isinstance(msg, EncodedMessage):
+            self.req_handler.send(msg.encode_with(codec))
+        else:
+            self.req_handler.send(codec.dumps(msg))
 
 
 class SnorkySockJSHandler(SockJSConnection):
@@ -2,27 +2,303 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from tornado.websocket import WebSocketHandler
+from tornado.websocket import WebSocketHandler, WebSocketProtocol13
 from tornado.ioloop import IOLoop
+from tornado.escape import utf8
 from snorky.client import Client
-from datetime import timedelta
-import json
+from snorky.codec import EncodedMessage, JSONCodec, get_subprotocol_codec
+from snorky.timeout import TimerWheelTimeoutFactory
+from collections import deque
 
 
 class WebSocketClient(Client):
-    """A WebSocket client."""
+    """A WebSocket client.
+
+    Encoded messages go through an outbox before being written to the
+    connection.
+
+    If :py:attr:`batch` is true, the messages sent during an iteration of the
+    IOLoop are kept in the outbox and written at the end of the iteration in
+    a single frame, as an array of messages. A batch is written earlier if
+    the outbox overflows the limits of the handler.
+
+    If the handler limits the messages or bytes written to the connection
+    but not yet flushed to the network, messages wait in the outbox while
+    the client is over either limit. The outbox is bounded by the same
+    limits: when it overflows, the ``slow_consumer_policy`` of the handler is
+    applied. See :py:class:`SnorkyWebSocketHandler`.
+    """
     def __init__(self, req_handler):
         super(WebSocketClient, self).__init__()
         self.req_handler = req_handler
 
+        self.batch = False
+        """Whether the client asked for its messages to be batched."""
+
+        self.outbox = deque()
+        """``(message, encoded message)`` pairs waiting to be written."""
+
+        self.outbox_bytes = 0
+        """Size of the encoded messages in the outbox."""
+
+        self.flush_scheduled = False
+        """Whether a batch flush is scheduled for the end of the current
+        IOLoop iteration."""
+
+        self.pending_messages = 0
+        """Messages written but not yet flushed to the network, counted only
+        if the handler has limits."""
+
+        self.pending_bytes = 0
+        """Size of the messages written but not yet flushed to the network,
+        counted only if the handler has limits."""
+
     @property
     def remote_address(self):
         """IP address of the client"""
         return self.req_handler.request.remote_ip
 
+    def get_codec(self):
+        """Returns the codec messages are encoded with."""
+        if self.codec is not None:
+            return self.codec
+        return self.req_handler.service_registry.codec
+
     def send(self, msg):
-        """Sends a message through the WebSocket channel."""
-        self.req_handler.write_message(json.dumps(msg))
+        """Sends a message through the WebSocket channel, in a binary frame
+        if the client negotiated a binary codec."""
+        codec = self.get_codec()
+        if isinstance(msg, EncodedMessage):
+            data = msg.encode_with(codec)
+        else:
+            data = codec.dumps(msg)
+
+        self.outbox.append((msg, data))
+        self.outbox_bytes += len(data)
+
+        if not self.batch or self.is_outbox_full():
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            IOLoop.current().add_callback(self.flush)
+
+    def flush(self):
+        """Writes the messages in the outbox, unless the client is over the
+        limits of the handler."""
+        self.flush_scheduled = False
+        if not self.outbox:
+            return
+
+        # The connection may have been closed in the meantime
+        if self.req_handler.ws_connection is None:
+            self.clear_outbox()
+            return
+
+        if self.is_congested():
+            self.enforce_limits()
+            return
+
+        codec = self.get_codec()
+        outbox = self.outbox
+        self.clear_outbox()
+        if self.batch:
+            self.write(codec.join([data for (msg, data) in outbox]),
+                       len(outbox), codec.binary)
+        else:
+            for msg, data in outbox:
+                self.write(data, 1, codec.binary)
+
+    def write(self, data, messages, binary):
+        """Writes a frame with one or more messages to the connection."""
+        handler = self.req_handler
+        future = handler.write_message(data, binary=binary)
+
+        # Since Tornado 4.5 each write has its own future
+        if handler.has_outbox_limits():
+            size = len(data)
+            self.pending_messages += messages
+            self.pending_bytes += size
+            future.add_done_callback(
+                lambda future: self.written(messages, size))
+
+    def written(self, messages, size):
+        """Called when a frame has been flushed to the network."""
+        self.pending_messages -= messages
+        self.pending_bytes -= size
+        if not self.flush_scheduled:
+            self.flush()
+
+    def clear_outbox(self):
+        """Empties the outbox."""
+        self.outbox = deque()
+        self.outbox_bytes = 0
+
+    def is_congested(self):
+        """Whether the messages not yet flushed to the network reach any
+        limit of the handler."""
+        handler = self.req_handler
+        return ((handler.max_pending_messages is not None and
+                 self.pending_messages >= handler.max_pending_messages) or
+                (handler.max_pending_bytes is not None and
+                 self.pending_bytes >= handler.max_pending_bytes))
+
+    def is_outbox_full(self):
+        """Whether the outbox exceeds any limit of the handler."""
+        handler = self.req_handler
+        return ((handler.max_pending_messages is not None and
+                 len(self.outbox) > handler.max_pending_messages) or
+                (handler.max_pending_bytes is not None and
+                 self.outbox_bytes > handler.max_pending_bytes))
+
+    def enforce_limits(self):
+        """Applies the slow consumer policy of the handler if the outbox is
+        full."""
+        if not self.is_outbox_full():
+            return
+
+        handler = self.req_handler
+        stats = handler.slow_consumer_stats
+        policy = handler.slow_consumer_policy
+
+        if policy == 'disconnect':
+            stats.disconnections += 1
+            self.clear_outbox()
+            handler.close(handler.slow_consumer_close_code, "Slow consumer")
+            return
+
+        if policy == 'conflate':
+            self.conflate()
+
+        # Drop the oldest messages until the outbox fits
+        while self.is_outbox_full():
+            msg, data = self.outbox.popleft()
+            self.outbox_bytes -= len(data)
+            stats.dropped_messages += 1
+            stats.dropped_bytes += len(data)
+
+    def conflate(self):
+        """Removes the messages of the outbox superseded by a newer message
+        with the same conflation key."""
+        get_key = self.req_handler.conflation_key
+        stats = self.req_handler.slow_consumer_stats
+        seen_keys = set()
+        outbox = deque()
+        for msg, data in reversed(self.outbox):
+            key = get_key(msg)
+            if key is not None:
+                if key in seen_keys:
+                    self.outbox_bytes -= len(data)
+                    stats.conflated_messages += 1
+                    continue
+                seen_keys.add(key)
+            outbox.appendleft((msg, data))
+        self.outbox = outbox
+
+
+class SlowConsumerStats(object):
+    """Counters of the actions taken on WebSocket clients which do not read
+    their messages fast enough."""
+    __slots__ = ('dropped_messages', 'dropped_bytes', 'conflated_messages',
+                 'disconnections')
+
+    def __init__(self):
+        self.dropped_messages = 0
+        """Number of messages dropped because the outbox was full."""
+
+        self.dropped_bytes = 0
+        """Size of the messages dropped because the outbox was full."""
+
+        self.conflated_messages = 0
+        """Number of messages superseded by a newer one."""
+
+        self.disconnections = 0
+        """Number of clients disconnected because the outbox was full."""
+
+    def __repr__(self):
+        return ("<SlowConsumerStats dropped_messages=%d dropped_bytes=%d "
+                "conflated_messages=%d disconnections=%d>" % (
+                    self.dropped_messages, self.dropped_bytes,
+                    self.conflated_messages, self.disconnections))
+
+
+class CompressionStats(object):
+    """Counters of the messages sent through WebSocket connections."""
+    __slots__ = ('messages', 'compressed_messages', 'raw_bytes',
+                 'sent_bytes')
+
+    def __init__(self):
+        self.messages = 0
+        """Number of messages sent."""
+
+        self.compressed_messages = 0
+        """Number of messages sent compressed."""
+
+        self.raw_bytes = 0
+        """Size of the messages sent, before compression."""
+
+        self.sent_bytes = 0
+        """Size of the frames sent, after compression and including their
+        headers."""
+
+    @property
+    def ratio(self):
+        """Raw bytes per byte sent, 1.0 if nothing was sent."""
+        if not self.sent_bytes:
+            return 1.0
+        return float(self.raw_bytes) / self.sent_bytes
+
+    def __repr__(self):
+        return ("<CompressionStats messages=%d compressed_messages=%d "
+                "raw_bytes=%d sent_bytes=%d>" % (
+                    self.messages, self.compressed_messages,
+                    self.raw_bytes, self.sent_bytes))
+
+
+class SnorkyWebSocketProtocol(WebSocketProtocol13):
+    """WebSocket protocol which only compresses the messages bigger than the
+    ``compression_threshold`` of its handler and keeps its byte counters.
+
+    Leaving a message uncompressed is allowed by permessage-deflate and does
+    not disturb the compression context of the connection. Frames are still
+    written by Tornado, which also keeps its own counters.
+    """
+
+    def write_message(self, message, binary=False):
+        handler = self.handler
+        message = utf8(message)
+        stats = handler.stats
+        stats.messages += 1
+        stats.raw_bytes += len(message)
+
+        compressor = self._compressor
+        compress = (compressor is not None and
+                    len(message) >= handler.compression_threshold)
+        wire_bytes_out = self._wire_bytes_out
+
+        # Without a compressor Tornado writes the message as is.
+        if not compress:
+            self._compressor = None
+        try:
+            future = super(SnorkyWebSocketProtocol, self) \
+                    .write_message(message, binary)
+        finally:
+            self._compressor = compressor
+
+        if compress:
+            stats.compressed_messages += 1
+        stats.sent_bytes += self._wire_bytes_out - wire_bytes_out
+        return future
+
+    def _parse_extensions_header(self, headers):
+        extensions = super(SnorkyWebSocketProtocol, self) \
+                ._parse_extensions_header(headers)
+        if not self.handler.context_takeover:
+            # A server may always refuse to keep its compression context
+            # between messages, even if the client did not ask for it.
+            for name, params in extensions:
+                if name == 'permessage-deflate':
+                    params['server_no_context_takeover'] = None
+        return extensions
 
 
 class SnorkyWebSocketHandler(WebSocketHandler):
@@ -30,14 +306,116 @@ class SnorkyWebSocketHandler(WebSocketHandler):
 
     A ``service_registry`` parameter must be specified for instances of this
     request handler.
+
+    permessage-deflate compression is disabled by default and is enabled with
+    the ``compression`` parameter. It is tuned with these parameters:
+
+    * ``compression_threshold``: Messages smaller than this size in bytes are
+      sent uncompressed. By default 256.
+    * ``compression_level``: zlib compression level, from 1 (fastest) to 9
+      (smallest). By default 6.
+    * ``compression_mem_level``: zlib memory level, from 1 to 9. By default
+      8.
+    * ``context_takeover``: When true, the default, each connection keeps a
+      compression context between messages, improving the ratio of similar
+      messages at the cost of around 256 KiB of memory per connection. When
+      false, messages are compressed independently.
+
+    A ping is sent every ``ping_pong_interval`` seconds, 90 by default, with
+    the timeouts of ``timeout_factory``, by default the shared
+    :py:data:`snorky.timeout.TimerWheelTimeoutFactory`.
+
+    Clients may ask for their messages to be batched by adding a ``batch=1``
+    argument to the query string of the URL. Every frame they receive is
+    then an array with the messages sent to them in an iteration of the
+    IOLoop. See :py:class:`WebSocketClient`.
+
+    Byte counters are kept in :py:attr:`stats`. A ``stats`` parameter may be
+    specified in order to share a :py:class:`CompressionStats` between
+    every connection.
+
+    Slow clients are kept from growing the write buffer of their connection
+    without bound with these parameters, disabled by default:
+
+    * ``max_pending_messages`` and ``max_pending_bytes``: High-water marks of
+      the messages, and their size, written to the connection but not yet
+      flushed to the network. Further messages wait in the outbox of the
+      client, which is bounded by the same marks.
+    * ``slow_consumer_policy``: What is done when the outbox overflows.
+      ``"drop_oldest"``, the default, drops the oldest messages.
+      ``"conflate"`` drops the messages superseded by a newer one with the
+      same key, as returned by the ``conflation_key`` function (it receives
+      each message, which may be an :py:class:`snorky.codec.EncodedMessage`,
+      and returns ``None`` for messages which must not be conflated), and
+      then the oldest ones if the outbox still overflows. ``"disconnect"``
+      closes the connection with ``slow_consumer_close_code``, by default
+      1013 (Try Again Later).
+
+    The actions taken are counted in :py:attr:`slow_consumer_stats`, which
+    may also be shared with a ``slow_consumer_stats`` parameter.
     """
+    slow_consumer_policies = ('drop_oldest', 'conflate', 'disconnect')
+
     def __init__(self, *args, **kwargs):
         self.service_registry = kwargs.pop("service_registry")
         self.ping_pong_interval = kwargs.pop('ping_pong_interval', 90) # seconds
+        self.timeout_factory = kwargs.pop('timeout_factory',
+                                          TimerWheelTimeoutFactory)
+        self.ping_handle = None
+        self.compression = kwargs.pop('compression', False)
+        self.compression_threshold = kwargs.pop('compression_threshold', 256)
+        self.compression_level = kwargs.pop('compression_level', None)
+        self.compression_mem_level = kwargs.pop('compression_mem_level', None)
+        self.context_takeover = kwargs.pop('context_takeover', True)
+        self.stats = kwargs.pop('stats', None)
+        if self.stats is None:
+            self.stats = CompressionStats()
+        self.max_pending_messages = kwargs.pop('max_pending_messages', None)
+        self.max_pending_bytes = kwargs.pop('max_pending_bytes', None)
+        self.slow_consumer_policy = kwargs.pop('slow_consumer_policy',
+                                               'drop_oldest')
+        if self.slow_consumer_policy not in self.slow_consumer_policies:
+            raise ValueError("Unknown slow consumer policy: %s"
+                             % self.slow_consumer_policy)
+        self.conflation_key = kwargs.pop('conflation_key', None)
+        if self.slow_consumer_policy == 'conflate' and \
+                self.conflation_key is None:
+            raise ValueError("The conflate slow consumer policy requires a "
+                             "conflation_key")
+        self.slow_consumer_close_code = kwargs.pop('slow_consumer_close_code',
+                                                   1013)
+        self.slow_consumer_stats = kwargs.pop('slow_consumer_stats', None)
+        if self.slow_consumer_stats is None:
+            self.slow_consumer_stats = SlowConsumerStats()
         self.client = WebSocketClient(req_handler=self)
 
         super(SnorkyWebSocketHandler, self).__init__(*args, **kwargs)
 
+    def has_outbox_limits(self):
+        """Whether the messages pending to be flushed to the network are
+        limited."""
+        return (self.max_pending_messages is not None or
+                self.max_pending_bytes is not None)
+
+    def get_compression_options(self):
+        """Returns the compression options for Tornado, or ``None`` if
+        compression is disabled."""
+        if not self.compression:
+            return None
+
+        options = {}
+        if self.compression_level is not None:
+            options['compression_level'] = self.compression_level
+        if self.compression_mem_level is not None:
+            options['mem_level'] = self.compression_mem_level
+        return options
+
+    def get_websocket_protocol(self):
+        websocket_version = self.request.headers.get("Sec-WebSocket-Version")
+        if websocket_version in ("7", "8", "13"):
+            return SnorkyWebSocketProtocol(
+                self, compression_options=self.get_compression_options())
+
     def check_origin(self, origin):
         """By default returns true, telling Tornado to allow cross origin
         requests.
@@ -45,26 +423,47 @@ class SnorkyWebSocketHandler(WebSocketHandler):
         # TODO Allow to customize this
         return True
 
+    def select_subprotocol(self, subprotocols):
+        """Chooses the first subprotocol requested by the client which is
+        supported.
+
+        ``snorky.json`` is the default protocol, with JSON in text frames.
+        ``snorky.msgpack`` and ``snorky.cbor`` exchange the same messages
+        encoded as MessagePack or CBOR in binary frames, provided their
+        libraries are installed. See :py:mod:`snorky.codec`.
+        """
+        for subprotocol in subprotocols:
+            if subprotocol == JSONCodec.subprotocol:
+                return subprotocol
+
+            codec = get_subprotocol_codec(subprotocol)
+            if codec is not None:
+                self.client.codec = codec
+                return subprotocol
+        return None
+
     def open(self):
         """Executed when the connection is started."""
+        self.client.batch = self.get_query_argument("batch", "0") == "1"
         self.service_registry.client_connected(self.client)
+        self.schedule_ping()
 
+    def schedule_ping(self):
+        """Schedules the next ping, unless pings are disabled."""
         if self.ping_pong_interval:
-            IOLoop.instance().add_timeout(
-                timedelta(seconds=self.ping_pong_interval),
-                self.its_ping_time)
+            self.ping_handle = self.timeout_factory.call_later(
+                self.ping_pong_interval, self.its_ping_time)
 
     def its_ping_time(self):
+        self.ping_handle = None
+
         # Still alive?
         if self.ws_connection:
             # Send a ping frame
             self.ping(b'')
 
             # Repeat
-            if self.ping_pong_interval:
-                IOLoop.instance().add_timeout(
-                    timedelta(seconds=self.ping_pong_interval),
-                    self.its_ping_time)
+            self.schedule_ping()
 
     def on_message(self, message):
         """Called when a message is received."""
@@ -72,6 +471,9 @@ class SnorkyWebSocketHandler(WebSocketHandler):
 
     def on_close(self):
         """Called when the connection finalizes."""
+        if self.ping_handle is not None:
+            self.ping_handle.cancel()
+            self.ping_handle = None
         self.service_registry.client_disconnected(self.client)
 
     @classmethod
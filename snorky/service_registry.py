@@ -3,17 +3,23 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from snorky.log import snorky_log
-from snorky.hashable import make_hashable
-import json
+from snorky.codec import default_codec
 
 
 class ServiceRegistry(object):
     """Manages a set of services identified by name and delivers messages to
     them.
+
+    Messages are encoded and decoded with ``codec``, by default
+    :py:data:`snorky.codec.default_codec`. See :py:mod:`snorky.codec`.
     """
 
-    def __init__(self, services=None):
+    def __init__(self, services=None, codec=None):
         self.registered_services = {}
+        self.codec = codec if codec is not None else default_codec
+        """Codec used by the request handlers associated with this registry
+        to encode and decode JSON messages."""
+
         if services:
             for service in services:
                 self.register_service(service)
@@ -49,13 +55,15 @@ class ServiceRegistry(object):
         service.process_message_from(client, content)
 
     def process_message_raw(self, client, msg):
-        """Decodes a message encoded as a JSON character string and sends it to
-        the destination service."""
+        """Decodes a message encoded as a JSON character string, or with the
+        codec negotiated by the client, and sends it to the destination
+        service."""
+        codec = client.codec if client.codec is not None else self.codec
         try:
-            decoded_msg = make_hashable(json.loads(msg))
+            decoded_msg = codec.loads_hashable(msg)
         except ValueError:
-            snorky_log.warning('Invalid JSON from client %s: %s'
-                            % (client.remote_address, msg))
+            snorky_log.warning('Invalid %s from client %s: %r'
+                            % (codec.format, client.remote_address, msg))
             return
 
         return self.process_message_from(client, decoded_msg)
@@ -9,6 +9,7 @@ except ImportError:
     from funcsigs import signature
 from snorky.log import snorky_log
 from snorky.types import with_metaclass
+from snorky.codec import EncodedMessage
 
 
 class Service(object):
@@ -37,6 +38,20 @@ class Service(object):
             "message": msg,
         })
 
+    def send_message_to_many(self, clients, msg):
+        """Sends the same message to several clients through the current
+        service.
+
+        The same :py:class:`snorky.codec.EncodedMessage` is handed to every
+        client, so the message is encoded only once per codec.
+        """
+        encoded = EncodedMessage({
+            "service": self.name,
+            "message": msg,
+        })
+        for client in clients:
+            client.send(encoded)
+
     def client_connected(self, client):
         """Called each time a client connects to Snorky through a channel which
         is connected to the same :py:class:`snorky.ServiceRegistry` than this
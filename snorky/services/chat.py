@@ -89,8 +89,8 @@ class ChatService(RPCService):
             "timestamp": self.get_time(),
         }
 
-        for client in self.clients_by_channel.get_set(channel):
-            self.send_message_to(client, message)
+        self.send_message_to_many(self.clients_by_channel.get_set(channel),
+                                  message)
 
     def send_presence(self, channel, client, status):
         presence = {
@@ -100,8 +100,8 @@ class ChatService(RPCService):
             "status": status,
             "timestamp": self.get_time(),
         }
-        for client in self.clients_by_channel.get_set(channel):
-            self.send_message_to(client, presence)
+        self.send_message_to_many(self.clients_by_channel.get_set(channel),
+                                  presence)
 
     @rpc_command
     def read(self, req, channel):
@@ -111,10 +111,11 @@ class ChatService(RPCService):
             "timestamp": self.get_time(),
         }
 
-        for client in self.clients_by_identity_and_channel.get_set(
-                            (req.client.identity, channel)):
-            if client is not req.client:
-                self.send_message_to(client, notification)
+        clients = self.clients_by_identity_and_channel.get_set(
+            (req.client.identity, channel))
+        self.send_message_to_many((client for client in clients
+                                   if client is not req.client),
+                                  notification)
 
 
     def client_disconnected(self, client):
@@ -103,13 +103,13 @@ class CursorsService(RPCService):
         self.cursors_by_document[document][cursor.public_handle] = cursor
 
         # Publish
-        for other_client in self.clients_by_document.get_set(document):
-            if other_client is client:
-                continue
-            self.send_message_to(other_client, {
-                "type": "cursorAdded",
-                "cursor": cursor.for_json(),
-            })
+        other_clients = (other_client for other_client
+                         in self.clients_by_document.get_set(document)
+                         if other_client is not client)
+        self.send_message_to_many(other_clients, {
+            "type": "cursorAdded",
+            "cursor": cursor.for_json(),
+        })
 
         return handle
 
@@ -128,13 +128,13 @@ class CursorsService(RPCService):
             cursor.status = newData["status"]
 
         # Publish
-        for other_client in self.clients_by_document.get_set(cursor.document):
-            if other_client is client:
-                continue
-            self.send_message_to(other_client, {
-                "type": "cursorUpdated",
-                "cursor": cursor.for_json(),
-            })
+        other_clients = (other_client for other_client
+                         in self.clients_by_document.get_set(cursor.document)
+                         if other_client is not client)
+        self.send_message_to_many(other_clients, {
+            "type": "cursorUpdated",
+            "cursor": cursor.for_json(),
+        })
 
     @rpc_command
     def removeCursor(self, req, privateHandle):
@@ -157,16 +157,16 @@ class CursorsService(RPCService):
             del self.cursors_by_client[client]
 
         # Publish
-        for other_client in self.clients_by_document.get_set(cursor.document):
-            if other_client is client:
-                continue
-            self.send_message_to(other_client, {
-                "type": "cursorRemoved",
-                "cursor": {
-                    "publicHandle": cursor.public_handle,
-                    "document": cursor.document,
-                },
-            })
+        other_clients = (other_client for other_client
+                         in self.clients_by_document.get_set(cursor.document)
+                         if other_client is not client)
+        self.send_message_to_many(other_clients, {
+            "type": "cursorRemoved",
+            "cursor": {
+                "publicHandle": cursor.public_handle,
+                "document": cursor.document,
+            },
+        })
 
     def do_leave(self, client, document):
         # Get list of cursor handles belonging to the specified user and
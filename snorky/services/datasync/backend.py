@@ -9,7 +9,8 @@ from snorky.services.datasync.subscription import \
         Subscription, SubscriptionItem
 from snorky.services.datasync.delta import \
         InsertionDelta, UpdateDelta, DeletionDelta
-from snorky.timeout import TornadoTimeoutFactory
+from snorky.services.datasync.filters import BadQuery
+from snorky.timeout import TimerWheelTimeoutFactory
 from snorky.log import snorky_log
 from snorky.types import is_string
 import functools
@@ -22,7 +23,7 @@ class DataSyncBackend(RPCService):
 
         self.frontend = frontend
         self.timeout_interval = timeout_interval
-        self.timeout_factory = timeout_factory or TornadoTimeoutFactory
+        self.timeout_factory = timeout_factory or TimerWheelTimeoutFactory
 
     @rpc_command
     def authorizeSubscription(self, req, items):
@@ -50,7 +51,14 @@ class DataSyncBackend(RPCService):
 
         subscription = Subscription(obj_items, self.frontend)
         token = self.frontend.sm.register_subscription(subscription)
-        self.frontend.dm.connect_subscription(subscription)
+        try:
+            self.frontend.dm.connect_subscription(subscription)
+        except BadQuery:
+            self.frontend.sm.unregister_subscription(subscription)
+            raise RPCError("Bad query")
+        except Exception:
+            self.frontend.sm.unregister_subscription(subscription)
+            raise
 
         subscription._awaited_client_timeout = self.timeout_factory.call_later(
                 self.timeout_interval, self.frontend.do_cancel_subscription,
@@ -94,5 +102,4 @@ class DataSyncBackend(RPCService):
         except KeyError:
             raise RPCError("Missing field")
 
-        for delta_obj in obj_deltas:
-            self.frontend.dm.deliver_delta(delta_obj)
+        self.frontend.dm.deliver_deltas(obj_deltas)
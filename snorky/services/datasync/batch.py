@@ -0,0 +1,219 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from binascii import hexlify
+from snorky.types import PY2, Number, is_string
+from snorky.services.datasync.filters import \
+        comparison_operators, orderable_types, split_field, compile_getter, \
+        is_scalar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ('BatchEvaluator',)
+
+# Greatest integer every number below which is exactly representable as a
+# float. Bigger integers can't be compared in a float array without losing
+# precision.
+MAX_EXACT_FLOAT_INT = 2 ** 53
+
+
+class BatchEvaluator(object):
+    """Evaluates filters over a batch of models at once, column by column.
+
+    The result of evaluating a filter is a bitmask, as a Python integer, whose
+    bit ``i`` is set if the ``i``-th model of the batch matches the filter.
+    ``and``, ``or`` and ``not`` are then just bitwise operations over the
+    whole batch.
+
+    The values of each field are gathered once per batch. Equality atoms are
+    answered from a table of the models having each value in a field, built
+    once per field. Order comparison atoms are evaluated over the whole
+    column, using NumPy if it is available and the column is numeric.
+
+    Atoms are cached, so an atom shared by several filters is only evaluated
+    once per batch.
+    """
+    __slots__ = ('models', 'all', 'columns', 'masks_by_value',
+                 'numeric_columns', 'atoms')
+
+    use_numpy = numpy is not None
+
+    def __init__(self, models):
+        self.models = models
+
+        self.all = (1 << len(models)) - 1
+        """Bitmask with all the models."""
+
+        self.columns = {}
+        """Values of each field path for each model, or ``BatchEvaluator`` if
+        the model does not have the field."""
+
+        self.masks_by_value = {}
+        """For each field path, bitmask of the models having each value."""
+
+        self.numeric_columns = {}
+        """For each field path, a NumPy array of its values and a boolean
+        array telling which models have a numeric value, or ``None`` if the
+        column can't be used with NumPy."""
+
+        self.atoms = {}
+        """Bitmask of each evaluated atom."""
+
+    def column(self, path):
+        """Returns the list of values of a field for each of the models."""
+        column = self.columns.get(path)
+        if column is None:
+            getter = compile_getter(path)
+            column = []
+            for model in self.models:
+                try:
+                    column.append(getter(model))
+                except (KeyError, TypeError):
+                    column.append(BatchEvaluator)
+            self.columns[path] = column
+        return column
+
+    def value_masks(self, path):
+        """Returns a dictionary with the bitmask of the models having each
+        hashable value in a field."""
+        masks = self.masks_by_value.get(path)
+        if masks is None:
+            masks = {}
+            bit = 1
+            for value in self.column(path):
+                if value is not BatchEvaluator:
+                    try:
+                        masks[value] = masks.get(value, 0) | bit
+                    except TypeError:
+                        # Unhashable, it can't be equal to a scalar
+                        pass
+                bit <<= 1
+            self.masks_by_value[path] = masks
+        return masks
+
+    def numeric_column(self, path):
+        """Returns the values of a field as a NumPy array along with a boolean
+        array of the models having a numeric value in it, or ``None`` if NumPy
+        can't be used for this column."""
+        if path in self.numeric_columns:
+            return self.numeric_columns[path]
+
+        values = []
+        valid = []
+        for value in self.column(path):
+            if isinstance(value, Number) and not is_string(value):
+                if isinstance(value, float) or \
+                        -MAX_EXACT_FLOAT_INT < value < MAX_EXACT_FLOAT_INT:
+                    values.append(value)
+                    valid.append(True)
+                    continue
+                else:
+                    # Big integer
+                    self.numeric_columns[path] = None
+                    return None
+            values.append(0)
+            valid.append(False)
+
+        array = numpy.array(values)
+        if array.dtype.kind not in 'biuf':
+            result = None
+        else:
+            result = (array, numpy.array(valid, dtype=bool))
+        self.numeric_columns[path] = result
+        return result
+
+    def mask_from_array(self, array):
+        """Converts a NumPy boolean array into a bitmask."""
+        if len(array) == 0:
+            return 0
+        # packbits() puts the first element in the most significant bit and
+        # pads the last byte with zeros. Reverse the array so the first model
+        # ends in the least significant bit and remove the padding.
+        packed = numpy.packbits(array[::-1]).tobytes()
+        padding = (-len(array)) % 8
+        return int(hexlify(packed), 16) >> padding
+
+    def evaluate_comparison(self, op, path, value):
+        """Returns the bitmask of the models satisfying a comparison atom."""
+        if op == '==' and is_scalar(value) and value == value:
+            # Not a NaN, which is equal to nothing
+            return self.value_masks(path).get(value, 0)
+
+        if op != '==' and self.use_numpy and \
+                isinstance(value, Number) and not isinstance(value, bool) and \
+                (isinstance(value, float) or
+                 -MAX_EXACT_FLOAT_INT < value < MAX_EXACT_FLOAT_INT):
+            numeric_column = self.numeric_column(path)
+            if numeric_column is not None:
+                array, valid = numeric_column
+                compare = comparison_operators[op]
+                return self.mask_from_array(compare(array, value) & valid)
+
+        compare = comparison_operators[op]
+        mask = 0
+        bit = 1
+        for field_value in self.column(path):
+            if field_value is not BatchEvaluator:
+                try:
+                    # Python3 does not allow to compare strings with numbers,
+                    # emulate that.
+                    if (op == '==' or not PY2 or
+                            orderable_types(field_value, value)) and \
+                            compare(field_value, value):
+                        mask |= bit
+                except TypeError:
+                    pass
+            bit <<= 1
+        return mask
+
+    def evaluate(self, filter):
+        """Returns the bitmask of the models matching a filter. The filter
+        must be valid, e.g. a :py:attr:`CompiledFilter.filter`."""
+        op = filter[0]
+
+        if op in comparison_operators:
+            field, value = filter[1:]
+            atom = (op, field, value)
+            try:
+                return self.atoms[atom]
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable constant, don't cache
+                return self.evaluate_comparison(op, split_field(field), value)
+
+            mask = self.atoms[atom] = \
+                    self.evaluate_comparison(op, split_field(field), value)
+            return mask
+        elif op == 'and':
+            mask = self.all
+            for expr in filter[1:]:
+                mask &= self.evaluate(expr)
+                if not mask:
+                    break
+            return mask
+        elif op == 'or':
+            mask = 0
+            for expr in filter[1:]:
+                mask |= self.evaluate(expr)
+                if mask == self.all:
+                    break
+            return mask
+        else: # not
+            return self.all & ~self.evaluate(filter[1])
+
+    def match(self, filters):
+        """Receives an iterable of ``(key, filter)`` pairs and returns a list
+        with the set of keys of the filters matched by each model."""
+        results = [set() for model in self.models]
+        for key, filter in filters:
+            mask = self.evaluate(filter)
+            while mask:
+                lowest_bit = mask & -mask
+                results[lowest_bit.bit_length() - 1].add(key)
+                mask ^= lowest_bit
+        return results
@@ -3,23 +3,101 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import abc
+import heapq
+import math
+import time
+import calendar
+import dateutil.parser
+from bisect import bisect_left, bisect_right, insort
+from fractions import Fraction
+from numbers import Integral
 from snorky.types import with_metaclass
-from collections import namedtuple
-from functools import wraps
-from snorky.types import PY2, StringTypes, Number, MultiDict, items
+from collections import namedtuple, OrderedDict
+from snorky.types import MultiDict, items, Number, is_string
 from snorky.services.datasync.delta import \
-        Delta, InsertionDelta, UpdateDelta, DeletionDelta
+        InsertionDelta, UpdateDelta, DeletionDelta, AggregateDelta
+from snorky.services.datasync.filters import \
+        BadQuery, CompiledFilter, canonical_filter, filter_fields, \
+        split_field, compile_getter
+from snorky.services.datasync.matchers import ScanMatcher
+from snorky.timeout import TornadoTimeoutFactory
 
 
-class BadQuery(Exception):
-    pass
+class MatchCache(object):
+    """A bounded LRU cache of the subscription items matching models, keyed
+    by the values of the fields the matching depends on.
+
+    The cache must be cleared every time the set of subscription items of the
+    dealer changes.
+    """
+    __slots__ = ('size', 'entries', 'fields', 'hits', 'misses')
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.fields = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Removes all the entries."""
+        self.entries.clear()
+        self.fields = None
+
+    def key_for_model(self, model, fields):
+        """Returns the cache key for a model, or ``None`` if it can't be
+        cached."""
+        if self.fields is None:
+            self.fields = tuple(sorted(fields))
+
+        try:
+            key = tuple((type(value), value)
+                        for value in (model.get(field, MatchCache)
+                                      for field in self.fields))
+            hash(key)
+        except (AttributeError, TypeError):
+            # Not a dictionary or unhashable values
+            return None
+        return key
+
+    def get(self, key):
+        """Returns the cached subscription items for a key, or ``None``."""
+        items = self.entries.pop(key, None)
+        if items is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # Mark as most recently used
+            self.entries[key] = items
+        return items
+
+    def put(self, key, items):
+        """Stores the subscription items for a key, discarding the least
+        recently used entry if the cache is full."""
+        self.entries[key] = items
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
 
 
 class Dealer(with_metaclass(abc.ABCMeta, object)):
     """Matches dealer data with subscriptions in order to deliver deltas to
     clients.
+
+    Dealers which know their dependent fields (see
+    :py:meth:`get_dependent_fields`) may cache the results of matching by
+    setting ``match_cache_size`` to a positive number. Such dealers must call
+    :py:meth:`invalidate_match_cache` each time a subscription item is added
+    or removed; the dealers in this module already do.
     """
-    __slots__ = tuple()
+    __slots__ = ('match_cache',)
+
+    match_cache_size = 0
+
+    def __init__(self):
+        if self.match_cache_size:
+            self.match_cache = MatchCache(self.match_cache_size)
+        else:
+            self.match_cache = None
 
     @property
     def name(self):
@@ -60,6 +138,59 @@ class Dealer(with_metaclass(abc.ABCMeta, object)):
         """
         pass
 
+    def get_dependent_fields(self):
+        """Returns an iterable of the names of the model fields the result of
+        :py:meth:`get_subscription_items_for_model` depends on, or ``None`` if
+        they are not known, which is the default.
+
+        When an update delta does not change any of these fields the dealer
+        will look for subscription items only once, since the result would be
+        the same for the old and the new data.
+        """
+        return None
+
+    related_models = ()
+    """Names of other model classes whose deltas this dealer needs to see,
+    e.g. to track relationships. They are passed to
+    :py:meth:`process_related_delta`."""
+
+    def process_related_delta(self, delta):
+        """Called with every delta of the model classes in
+        ``related_models``, before it is delivered to the dealers of its own
+        model class. Does nothing by default."""
+        pass
+
+    def invalidate_match_cache(self):
+        """Discards the cached matching results, if any."""
+        match_cache = getattr(self, 'match_cache', None)
+        if match_cache is not None:
+            match_cache.clear()
+
+    def lookup_subscription_items(self, model):
+        """Returns the subscription items for a model, as
+        :py:meth:`get_subscription_items_for_model` does, using the match
+        cache if it's enabled.
+
+        The returned set must not be modified.
+        """
+        match_cache = getattr(self, 'match_cache', None)
+        if match_cache is None:
+            return self.get_subscription_items_for_model(model)
+
+        fields = self.get_dependent_fields()
+        if fields is None:
+            return self.get_subscription_items_for_model(model)
+
+        key = match_cache.key_for_model(model, fields)
+        if key is None:
+            return self.get_subscription_items_for_model(model)
+
+        items = match_cache.get(key)
+        if items is None:
+            items = self.get_subscription_items_for_model(model)
+            match_cache.put(key, items)
+        return items
+
     def deliver_delta(self, delta):
         """Receives a delta, computes a set of destination subscriptions
         items and forwards the delta to them.
@@ -87,41 +218,111 @@ class Dealer(with_metaclass(abc.ABCMeta, object)):
         be sent to the client.
         """
 
-        if isinstance(delta, InsertionDelta) or \
-           isinstance(delta, DeletionDelta):
-            deliver_to = self.get_subscription_items_for_model(delta.data)
+        for item, item_delta in self.route_delta(delta):
+            item.subscription.deliver_delta(item_delta)
 
-            for subscription_item in deliver_to:
-                subscription_item.subscription.deliver_delta(delta)
+    def route_delta(self, delta):
+        """Returns a list of ``(subscription_item, delta)`` pairs with the
+        deltas that must be delivered to each subscription item in response
+        to a delta, following the rules explained in :py:meth:`deliver_delta`.
+        """
+        return self.route_deltas([delta])[0]
 
-        else:
-            # If origin delta is an update
-            model = delta.model
-            new_data = delta.new_data
-            old_data = delta.old_data
+    def route_deltas(self, deltas):
+        """Batch version of :py:meth:`route_delta`. Returns a list with the
+        routes of each of the provided deltas.
 
-            set_old = self.get_subscription_items_for_model(old_data)
-            set_new = self.get_subscription_items_for_model(new_data)
+        All the models carried by the deltas are matched at once with
+        :py:meth:`get_subscription_items_for_models`.
+        """
+        # Collect the models which must be matched
+        models = []
+        rematch = []
+        fields = self.get_dependent_fields()
+        for delta in deltas:
+            if isinstance(delta, UpdateDelta):
+                # If none of the fields the matching depends on changed,
+                # every subscription item matching the old data matches the
+                # new data.
+                needs_rematch = fields is None or \
+                        fields_changed(delta.old_data, delta.new_data, fields)
+                rematch.append(needs_rematch)
+                models.append(delta.old_data)
+                if needs_rematch:
+                    models.append(delta.new_data)
+            else:
+                models.append(delta.data)
+
+        matches = iter(self.lookup_subscription_items_for_models(models))
+        rematch = iter(rematch)
+
+        routes = []
+        for delta in deltas:
+            if not isinstance(delta, UpdateDelta):
+                routes.append([(item, delta) for item in next(matches)])
+                continue
+
+            set_old = next(matches)
+            if not next(rematch):
+                routes.append([(item, delta) for item in set_old])
+                continue
+            set_new = next(matches)
 
             # Prepare every type of destination delta
-            insertion_delta = InsertionDelta(model, new_data)
+            insertion_delta = InsertionDelta(delta.model, delta.new_data)
             update_delta = delta
-            deletion_delta = DeletionDelta(model, old_data)
+            deletion_delta = DeletionDelta(delta.model, delta.old_data)
 
+            route = []
             # For the subscription items that do not match the filter with the
             # old data but do with the new data, send a insertion delta.
-            for item in set_new - set_old:
-                item.subscription.deliver_delta(insertion_delta)
+            route.extend((item, insertion_delta)
+                         for item in set_new - set_old)
 
             # For the subscription items that match the filter with both the
             # new and old data, send an update delta.
-            for item in set_old.intersection(set_new):
-                item.subscription.deliver_delta(update_delta)
+            route.extend((item, update_delta)
+                         for item in set_old.intersection(set_new))
 
             # For the subscription items that match the filter with the old
             # data but do not match with the new data, send a deletion delta.
-            for item in set_old - set_new:
-                item.subscription.deliver_delta(deletion_delta)
+            route.extend((item, deletion_delta)
+                         for item in set_old - set_new)
+            routes.append(route)
+
+        return routes
+
+    def get_subscription_items_for_models(self, models):
+        """Batch version of :py:meth:`get_subscription_items_for_model`.
+        Returns a list with the set of subscription items matching each of the
+        provided models.
+
+        By default it just calls :py:meth:`get_subscription_items_for_model`
+        for each model. Dealers which can match many models at once faster
+        than one by one should override it.
+        """
+        return [self.get_subscription_items_for_model(model)
+                for model in models]
+
+    def lookup_subscription_items_for_models(self, models):
+        """Batch version of :py:meth:`lookup_subscription_items`."""
+        if getattr(self, 'match_cache', None) is not None:
+            return [self.lookup_subscription_items(model)
+                    for model in models]
+        return self.get_subscription_items_for_models(models)
+
+
+def fields_changed(old_data, new_data, fields):
+    """Returns true if any of the specified fields has a different value in
+    ``old_data`` and ``new_data``, or if the data are not dictionaries."""
+    try:
+        for field in fields:
+            if old_data.get(field, fields_changed) != \
+                    new_data.get(field, fields_changed):
+                return True
+    except (AttributeError, TypeError):
+        return True
+    return False
 
 
 class BroadcastDealer(Dealer):
@@ -137,22 +338,36 @@ class BroadcastDealer(Dealer):
     def add_subscription_item(self, item):
         """Adds a subscription item."""
         self.items.add(item)
+        self.invalidate_match_cache()
 
     def remove_subscription_item(self, item):
         """Removes a subscription item."""
         self.items.remove(item)
+        self.invalidate_match_cache()
 
     def get_subscription_items_for_model(self, model):
         """Returns all the subscription items."""
         return self.items
 
+    def get_dependent_fields(self):
+        """Returns an empty tuple, since no field is used."""
+        return ()
+
 
 class SimpleDealer(Dealer):
     """This dealer uses a key function in order to determine which subscription
     items match which models.
+
+    Subclasses may list the fields :py:meth:`get_key_for_model` reads in
+    ``key_fields``, allowing to skip matching for updates which do not change
+    them. Subclasses which list them may also enable the match cache with
+    ``match_cache_size``, which is worth it if :py:meth:`get_key_for_model`
+    is expensive.
     """
     __slots__ = ('items_by_model_key',)
 
+    key_fields = None
+
     def __init__(self):
         super(SimpleDealer, self).__init__()
         self.items_by_model_key = MultiDict()
@@ -172,10 +387,12 @@ class SimpleDealer(Dealer):
         of the model key which will cause this client to receive a
         notification."""
         self.items_by_model_key.add(item.query, item)
+        self.invalidate_match_cache()
 
     def remove_subscription_item(self, item):
         """Removes a subscription item."""
         self.items_by_model_key.remove(item.query, item)
+        self.invalidate_match_cache()
 
     def get_subscription_items_for_model(self, model):
         """Returns the subscription items whose queries match the key of the
@@ -186,163 +403,1390 @@ class SimpleDealer(Dealer):
         # there is none.
         return self.items_by_model_key.get_set(query)
 
+    def get_dependent_fields(self):
+        """Returns ``key_fields``."""
+        return self.key_fields
 
-FilterAssociation = namedtuple('FilterAssociation',
-                               ('filter', 'subscription_item'))
 
-"""
-Filter syntax
-=============
+class MultiKeyDealer(SimpleDealer):
+    """Like :py:class:`SimpleDealer`, but the query of each subscription item
+    is a list of keys instead of a single one. The subscription item receives
+    the deltas of models whose key is any of them.
 
-['==', 'color', 'blue']
-color is 'blue'
+    Routing a delta still takes a single lookup in the index, regardless of
+    how many keys each subscription item watches.
+    """
+    __slots__ = ('keys_by_item',)
 
-['<', 'age', 21]
-age is less than 21
+    def __init__(self):
+        super(MultiKeyDealer, self).__init__()
+        self.keys_by_item = {}
 
-['>=', 'age', 21]
-age is greater than or equal to 21
+    def add_subscription_item(self, item):
+        """Adds a subscription item. The query must be a list with the values
+        of the model key which will cause this client to receive a
+        notification.
 
-['and', ['==', 'service', 'prosody'], ['>=', 'severity_level', 3]]
-service is 'prosody' and severity_level is greater than or equal to 3
+        Raises :py:class:`BadQuery` if the query is not a list of hashable
+        values."""
+        if not isinstance(item.query, list):
+            raise BadQuery("The query must be a list of keys")
+        try:
+            keys = frozenset(item.query)
+        except TypeError:
+            raise BadQuery("Keys must be hashable")
 
-['or', ['not', ['==', 'service', 'java']], ['>=', 'severity_level', 3]]
-service is not 'java' or severity_level is greater than or equal to 3
+        items_by_model_key = self.items_by_model_key
+        for key in keys:
+            items_by_model_key.add(key, item)
+        self.keys_by_item[item] = keys
+        self.invalidate_match_cache()
 
-['==', 'player.color', 'blue']
-color of player is 'blue'
-"""
+    def remove_subscription_item(self, item):
+        """Removes a subscription item."""
+        items_by_model_key = self.items_by_model_key
+        for key in self.keys_by_item.pop(item):
+            items_by_model_key.remove(key, item)
+        self.invalidate_match_cache()
 
-def get_field(model, name):
-    """
-    Given a dictionary for `model` and a dot separated string for `name`,
-    accesses the named properties in model.
 
-    e.g. get_field(model, 'service.name') returns model['service']['name']
-    """
-    prop = model
-    for prop_name in name.split('.'):
-        prop = model[prop_name]
-    return prop
-
-def false_on_raise(function):
-    """Decorator to make a function return False when a :py:class:`KeyError` or
-    :py:class:`TypeError` is thrown.
-    """
-    @wraps(function)
-    def _false_on_raise(*args):
-        try:
-            return function(*args)
-        except (KeyError, TypeError):
-            # KeyError: missing property
-            # TypeError: unorderable types (e.g. compared str with int)
-            return False
-    return _false_on_raise
-
-def orderable_types(a, b):
-    """The provided parameters are orderable if and only if both are number
-    types or both are string types."""
-    return (isinstance(a, Number) and isinstance(b, Number)) or \
-            (isinstance(a, StringTypes) and isinstance(b, StringTypes))
-
-@false_on_raise
-def filter_eq(model, field, value):
-    """Equality filter."""
-    return get_field(model, field) == value
-
-@false_on_raise
-def filter_lt(model, field, value):
-    """*Less than* filter"""
-    field_value = get_field(model, field)
-    # Python3 does not allow to compare strings with numbers, emulate that.
-    if PY2 and not orderable_types(field_value, value):
-        raise TypeError
-    return field_value < value
-
-@false_on_raise
-def filter_lte(model, field, value):
-    """*Less than or equal* filter"""
-    field_value = get_field(model, field)
-    # Python3 does not allow to compare strings with numbers, emulate that.
-    if PY2 and not orderable_types(field_value, value):
-        raise TypeError
-    return field_value <= value
-
-@false_on_raise
-def filter_gt(model, field, value):
-    """*Greater than* filter"""
-    field_value = get_field(model, field)
-    # Python3 does not allow to compare strings with numbers, emulate that.
-    if PY2 and not orderable_types(field_value, value):
-        raise TypeError
-    return field_value > value
-
-@false_on_raise
-def filter_gte(model, field, value):
-    """*Greater or equal than* filter"""
-    field_value = get_field(model, field)
-    # Python3 does not allow to compare strings with numbers, emulate that.
-    if PY2 and not orderable_types(field_value, value):
-        raise TypeError
-    return field_value >= value
-
-@false_on_raise
-def filter_not(model, expr):
-    """*Not* filter."""
-    return not filter_matches(model, expr)
-
-@false_on_raise
-def filter_and(model, *expressions):
-    """*And* filter. Accepts any number of expressions."""
-    return all(filter_matches(model, expr)
-               for expr in expressions)
-
-@false_on_raise
-def filter_or(model, *expressions):
-    """*Or* filter. Accepts any number of expressions."""
-    return any(filter_matches(model, expr)
-               for expr in expressions)
-
-operator_functions = {
-    '==': filter_eq,
-    '<': filter_lt,
-    '<=': filter_lte,
-    '>': filter_gt,
-    '>=': filter_gte,
-    'and': filter_and,
-    'or': filter_or,
-    'not': filter_not,
-}
-
-def filter_matches(model, filter):
-    """Returns true if a model matches the provided filter."""
-    op = filter[0]
-    args = filter[1:]
-    return operator_functions[op](model, *args)
+FilterAssociation = namedtuple('FilterAssociation',
+                               ('filter', 'subscription_item'))
+
 
 class FilterDealer(Dealer):
     """This dealer matches deltas against filters specified in subscription
-    queries."""
-    __slots__ = ('filters_by_item',)
+    queries.
+
+    Filters are compiled when the subscription item is added, so each delta
+    only has to run the resulting predicates. Subscription items with
+    equivalent filters share them: each distinct filter is evaluated once per
+    delta regardless of how many subscription items use it.
+
+    How the filters that match a model are found is delegated to a
+    :py:class:`snorky.services.datasync.matchers.Matcher`, chosen with the
+    ``matcher_class`` attribute or constructor parameter. By default every
+    filter is checked against every model (:py:class:`ScanMatcher`);
+    :py:class:`IndexMatcher` avoids that for filters with equality atoms and
+    :py:class:`AdaptiveMatcher` picks a strategy depending on the filters.
+
+    When deltas repeat the same values in the filtered fields, a cache of the
+    matching results can be enabled with the ``match_cache_size`` attribute
+    or constructor parameter.
+    """
+    __slots__ = ('filters_by_item', 'items_by_filter', 'matcher',
+                 'field_refs')
 
-    def __init__(self):
+    matcher_class = ScanMatcher
+
+    def __init__(self, matcher_class=None, match_cache_size=None):
         super(FilterDealer, self).__init__()
+        if match_cache_size is not None:
+            self.match_cache = \
+                    MatchCache(match_cache_size) if match_cache_size else None
         self.filters_by_item = {}
+        """Canonical filter of each subscription item."""
+
+        self.items_by_filter = MultiDict()
+        """Subscription items by canonical filter."""
+
+        self.matcher = (matcher_class or self.matcher_class)()
+
+        self.field_refs = {}
+        """Number of distinct filters using each top level field."""
 
     def add_subscription_item(self, item):
-        """Adds a new subscription item. The query must be a filter."""
+        """Adds a new subscription item. The query must be a filter.
+
+        Raises :py:class:`BadQuery` if the filter is malformed.
+        """
         if not isinstance(item.query, list):
             raise BadQuery
 
-        filter = item.query
+        filter = canonical_filter(item.query)
+        if filter not in self.items_by_filter:
+            self.matcher.add(filter, CompiledFilter(filter))
+            for field in filter_fields(filter):
+                self.field_refs[field] = self.field_refs.get(field, 0) + 1
+
+        self.items_by_filter.add(filter, item)
         self.filters_by_item[item] = filter
+        self.invalidate_match_cache()
 
     def remove_subscription_item(self, item):
         """Removes a subscription item."""
-        del self.filters_by_item[item]
+        filter = self.filters_by_item.pop(item)
+        self.items_by_filter.remove(filter, item)
+        self.invalidate_match_cache()
+
+        if filter not in self.items_by_filter:
+            self.matcher.remove(filter)
+            for field in filter_fields(filter):
+                self.field_refs[field] -= 1
+                if self.field_refs[field] == 0:
+                    del self.field_refs[field]
 
     def get_subscription_items_for_model(self, model):
         """Returns the subscription items matching a filter."""
-        for subscription_item, filter in items(self.filters_by_item):
-            if filter_matches(model, filter):
-                yield subscription_item
+        matched_items = set()
+        for filter in self.matcher.match(model):
+            matched_items.update(self.items_by_filter[filter])
+        return matched_items
+
+    def get_subscription_items_for_models(self, models):
+        """Returns the subscription items matching a filter for each of the
+        provided models, matching all of them at once (see
+        :py:meth:`Matcher.match_many`)."""
+        items_by_filter = self.items_by_filter
+        results = []
+        for filters in self.matcher.match_many(models):
+            matched_items = set()
+            for filter in filters:
+                matched_items.update(items_by_filter[filter])
+            results.append(matched_items)
+        return results
+
+    def get_dependent_fields(self):
+        """Returns the top level fields used by the registered filters."""
+        return self.field_refs
+
+
+def order_key(value):
+    """Returns a key to sort model field values by, or ``None`` if the value
+    can't be ordered. Numbers sort before strings."""
+    if isinstance(value, Number):
+        return (0, value) if value == value else None
+    elif is_string(value):
+        return (1, value)
+    return None
+
+
+class WindowDealer(Dealer):
+    """Base class of the dealers which keep a window of rows for each query,
+    such as :py:class:`TopNDealer` and :py:class:`TimeWindowDealer`.
+
+    :py:meth:`parse_query` turns the query of a subscription item into the
+    key of its window and the rows to seed it with. Subscription items with
+    the same key share the window, which is created by
+    :py:meth:`create_window`. Windows have an ``items`` set, a ``rows``
+    dictionary by primary key and ``seed`` and ``route`` methods.
+
+    Rows are identified by the field named in the ``primary_key`` attribute,
+    ``id`` by default.
+    """
+    __slots__ = ('windows', 'windows_by_item', 'get_primary_key')
+
+    primary_key = 'id'
+
+    def __init__(self):
+        super(WindowDealer, self).__init__()
+
+        self.get_primary_key = compile_getter(split_field(self.primary_key))
+
+        self.windows = {}
+        """Windows by the key of their query."""
+
+        self.windows_by_item = {}
+        """Window key of each subscription item."""
+
+    def primary_key_for(self, row):
+        """Returns the primary key of a row or ``None`` if it has none."""
+        try:
+            pk = self.get_primary_key(row)
+            hash(pk)
+            return pk
+        except (KeyError, TypeError):
+            return None
+
+    @abc.abstractmethod
+    def parse_query(self, query):
+        """Validates a query and returns the key identifying its window and
+        its initial rows.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        pass
+
+    @abc.abstractmethod
+    def create_window(self, key):
+        """Returns a new, empty window for a query key."""
+        pass
+
+    def drop_window(self, window):
+        """Called when the last subscription item of a window is removed."""
+        pass
+
+    def add_subscription_item(self, item):
+        """Adds a new subscription item. Items with an equal query (not
+        counting ``rows``) share the same window, which is seeded only by the
+        first of them.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        key, rows = self.parse_query(item.query)
+
+        window = self.windows.get(key)
+        if window is None:
+            window = self.create_window(key)
+            window.seed(rows)
+            self.windows[key] = window
+
+        window.items.add(item)
+        self.windows_by_item[item] = key
+
+    def remove_subscription_item(self, item):
+        """Removes a subscription item."""
+        key = self.windows_by_item.pop(item)
+        window = self.windows[key]
+        window.items.remove(item)
+        if not window.items:
+            self.drop_window(window)
+            del self.windows[key]
+
+    def get_subscription_items_for_model(self, model):
+        """Returns the subscription items whose window contains the model."""
+        pk = self.primary_key_for(model)
+        matched_items = set()
+        if pk is not None:
+            for window in self.windows.values():
+                if pk in window.rows:
+                    matched_items.update(window.items)
+        return matched_items
+
+    def route_delta(self, delta):
+        """Updates every window with the delta and returns the deltas their
+        subscription items must receive."""
+        route = []
+        for window in self.windows.values():
+            for item_delta in window.route(delta):
+                route.extend((item, item_delta) for item in window.items)
+        return route
+
+    def route_deltas(self, deltas):
+        """Windows change with every delta, so each is routed in turn."""
+        return [self.route_delta(delta) for delta in deltas]
+
+
+class SortedWindow(object):
+    """The first ``limit`` rows of a query in a certain order, as known by a
+    :py:class:`TopNDealer`.
+
+    Rows are kept sorted by their order key, ascending. If the order is
+    descending the first rows of the window are therefore the last ones of
+    the list.
+
+    Once a row of the query has been left out of the window, the window no
+    longer knows every row which could follow its last one. From then on it
+    only admits rows ranking before all the rows it has left out.
+    """
+    __slots__ = ('dealer', 'compiled', 'get_order_value', 'descending',
+                 'limit', 'keys', 'ids', 'rows', 'items', 'boundary')
+
+    def __init__(self, dealer, filter, order_by, descending, limit):
+        self.dealer = dealer
+        self.compiled = CompiledFilter(filter) if filter is not None else None
+        self.get_order_value = compile_getter(split_field(order_by))
+        self.descending = descending
+        self.limit = limit
+
+        self.keys = []
+        """Order keys of the rows in the window, sorted."""
+
+        self.ids = []
+        """Primary keys of the rows in the window, in the same order."""
+
+        self.rows = {}
+        """Order key and data of each row in the window by primary key."""
+
+        self.items = set()
+        """Subscription items sharing this window."""
+
+        self.boundary = None
+        """Order key of the first row left out of the window, or ``None`` if
+        no row has been left out. Unknown rows may follow it."""
+
+    def qualifying_key(self, row):
+        """Returns the order key of a row if it satisfies the filter of the
+        window, ``None`` otherwise."""
+        if self.compiled is not None and not self.compiled.matches(row):
+            return None
+        try:
+            return order_key(self.get_order_value(row))
+        except (KeyError, TypeError):
+            return None
+
+    def worse(self, key, other):
+        """Returns true if a row with order key ``key`` goes after a row with
+        order key ``other``. Rows are placed after the ones they tie with."""
+        if self.descending:
+            return key <= other
+        else:
+            return key >= other
+
+    def worst_key(self):
+        """Returns the order key of the last row of the window."""
+        return self.keys[0] if self.descending else self.keys[-1]
+
+    def fits(self, key):
+        """Returns true if a row with the specified order key would be part of
+        the window."""
+        if len(self.keys) < self.limit:
+            return self.boundary is None or \
+                    not self.worse(key, self.boundary)
+        return not self.worse(key, self.worst_key())
+
+    def leave_out(self, key):
+        """Records that a row of the query with the specified order key is
+        not part of the window."""
+        if self.boundary is None or not self.worse(key, self.boundary):
+            self.boundary = key
+
+    def insert(self, pk, key, row):
+        """Adds a row to the window. If the window overflows its last row is
+        discarded and its data returned."""
+        if self.descending:
+            position = bisect_left(self.keys, key)
+        else:
+            position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.ids.insert(position, pk)
+        self.rows[pk] = (key, row)
+
+        if len(self.keys) > self.limit:
+            last = self.ids[0 if self.descending else -1]
+            self.leave_out(self.rows[last][0])
+            return self.remove(last)
+        return None
+
+    def remove(self, pk):
+        """Removes a row from the window and returns its data."""
+        key, row = self.rows.pop(pk)
+        position = bisect_left(self.keys, key)
+        while self.ids[position] != pk:
+            position += 1
+        del self.keys[position]
+        del self.ids[position]
+        return row
+
+    def seed(self, rows):
+        """Fills the window with the current rows of the query."""
+        for row in rows:
+            pk = self.dealer.primary_key_for(row)
+            key = self.qualifying_key(row)
+            if pk is None or key is None or pk in self.rows:
+                continue
+            if self.fits(key):
+                self.insert(pk, key, row)
+            else:
+                self.leave_out(key)
+
+    def route(self, delta):
+        """Updates the window with a delta and returns the list of deltas the
+        subscription items of the window must receive."""
+        if isinstance(delta, InsertionDelta):
+            return self.route_insertion(delta.model, delta.data, delta)
+        elif isinstance(delta, DeletionDelta):
+            pk = self.dealer.primary_key_for(delta.data)
+            if pk is not None and pk in self.rows:
+                self.remove(pk)
+                return [delta]
+            return []
+        elif isinstance(delta, UpdateDelta):
+            pk = self.dealer.primary_key_for(delta.old_data)
+            if pk is None or pk not in self.rows:
+                return self.route_insertion(delta.model, delta.new_data)
+
+            # A row falling behind the rows left out of the window leaves
+            # it: unknown rows could go between them.
+            self.remove(pk)
+
+            new_pk = self.dealer.primary_key_for(delta.new_data)
+            key = self.qualifying_key(delta.new_data)
+            if new_pk is not None and key is not None and self.fits(key):
+                self.insert(new_pk, key, delta.new_data)
+                return [delta]
+            return [DeletionDelta(delta.model, delta.old_data)]
+        return []
+
+    def route_insertion(self, model_class, data, delta=None):
+        """Handles a row which may enter the window. Returns the deltas to
+        send: the deletion of the row discarded to make room for it, if any,
+        and its insertion."""
+        pk = self.dealer.primary_key_for(data)
+        key = self.qualifying_key(data)
+        if pk is None or key is None or pk in self.rows:
+            return []
+        if not self.fits(key):
+            self.leave_out(key)
+            return []
+
+        deltas = []
+        evicted = self.insert(pk, key, data)
+        if evicted is not None:
+            deltas.append(DeletionDelta(model_class, evicted))
+        deltas.append(delta or InsertionDelta(model_class, data))
+        return deltas
+
+
+class TopNDealer(WindowDealer):
+    """This dealer keeps the first rows of a query in a certain order, e.g.
+    the latest 50 events, and only sends the deltas which change them: rows
+    entering or leaving that window and updates of rows inside it.
+
+    The query is a dictionary with these keys:
+
+    ``orderBy``
+        The field rows are sorted by. Rows without a number or a string in
+        it are ignored.
+    ``limit``
+        The number of rows in the window.
+    ``descending``
+        Optional, ``false`` by default.
+    ``filter``
+        Optional, a filter as accepted by :py:class:`FilterDealer`.
+    ``rows``
+        Optional, the rows of the query at the time of the subscription, so
+        the window starts up to date.
+
+    Rows are identified by the field named in the ``primary_key`` attribute,
+    ``id`` by default.
+
+    The dealer only knows about the rows in the window. When a row leaves it
+    the window shrinks, and since the rows which were left out of the window
+    are unknown, only rows ranking before all of them will fill it again.
+
+    Subscription items with the same query share the window.
+    """
+    def parse_query(self, query):
+        """Validates a query and returns the key identifying its window and
+        its initial rows.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        if not isinstance(query, dict):
+            raise BadQuery("The query must be a dictionary")
+
+        order_by = query.get("orderBy")
+        limit = query.get("limit")
+        descending = query.get("descending", False)
+        filter = query.get("filter")
+        rows = query.get("rows", [])
+
+        if not is_string(order_by):
+            raise BadQuery("orderBy must be a field name")
+        split_field(order_by)
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+            raise BadQuery("limit must be a positive integer")
+        if not isinstance(descending, bool):
+            raise BadQuery("descending must be a boolean")
+        if filter is not None:
+            if not isinstance(filter, list):
+                raise BadQuery("filter must be a list")
+            filter = canonical_filter(filter)
+        if not isinstance(rows, list):
+            raise BadQuery("rows must be a list")
+
+        return (filter, order_by, descending, limit), rows
+
+    def create_window(self, key):
+        """Returns a new window sorted as the query says."""
+        filter, order_by, descending, limit = key
+        return SortedWindow(self, filter, order_by, descending, limit)
+
+
+class Aggregate(object):
+    """The value of an aggregate function over the rows matching a filter,
+    per group, as maintained by an :py:class:`AggregateDealer`.
+    """
+    __slots__ = ('compiled', 'function', 'get_field', 'get_group', 'groups',
+                 'items')
+
+    functions = ('count', 'sum', 'min', 'max')
+
+    def __init__(self, filter, function, field, group_by):
+        self.compiled = CompiledFilter(filter) if filter is not None else None
+        self.function = function
+        self.get_field = compile_getter(split_field(field)) \
+                if field is not None else None
+        self.get_group = compile_getter(split_field(group_by)) \
+                if group_by is not None else None
+
+        self.groups = {}
+        """State of each group with rows: the count for ``count``, the count
+        of rows, the count of rows with a non integer value and the exact sum
+        for ``sum`` and the sorted order keys of the values for ``min`` and
+        ``max``."""
+
+        self.items = MultiDict()
+        """Subscription items sharing this aggregate, by label."""
+
+    def contribution(self, row):
+        """Returns the group of a row and the value it adds to the aggregate,
+        or ``None`` if the row does not count."""
+        if self.compiled is not None and not self.compiled.matches(row):
+            return None
+
+        group = None
+        if self.get_group is not None:
+            try:
+                group = self.get_group(row)
+                hash(group)
+            except (KeyError, TypeError):
+                return None
+
+        if self.get_field is None:
+            return group, None
+        try:
+            value = self.get_field(row)
+        except (KeyError, TypeError):
+            return None
+
+        if self.function == 'sum':
+            if not isinstance(value, Number) or isinstance(value, bool):
+                return None
+            if isinstance(value, float) and \
+                    (math.isinf(value) or math.isnan(value)):
+                return None
+        else:
+            value = order_key(value)
+            if value is None:
+                return None
+        return group, value
+
+    def value(self, group):
+        """Returns the current value of the aggregate for a group."""
+        state = self.groups.get(group)
+        if self.function == 'count':
+            return state or 0
+        elif self.function == 'sum':
+            if not state:
+                return 0
+            count, inexact, total = state
+            return float(total) if inexact else int(total)
+        elif not state:
+            return None
+        elif self.function == 'min':
+            return state[0][1]
+        else:
+            return state[-1][1]
+
+    def add(self, group, value):
+        """Adds the contribution of a row."""
+        if self.function == 'count':
+            self.groups[group] = self.groups.get(group, 0) + 1
+        elif self.function == 'sum':
+            count, inexact, total = self.groups.get(group, (0, 0, 0))
+            if isinstance(value, Integral):
+                self.groups[group] = (count + 1, inexact, total + value)
+            else:
+                # Summed as fractions, so removing rows can't leave rounding
+                # errors behind
+                self.groups[group] = (count + 1, inexact + 1,
+                                      total + Fraction(value))
+        else:
+            insort(self.groups.setdefault(group, []), value)
+
+    def remove(self, group, value):
+        """Removes the contribution of a row."""
+        if self.function == 'count':
+            count = self.groups.get(group, 0) - 1
+            if count > 0:
+                self.groups[group] = count
+            else:
+                self.groups.pop(group, None)
+        elif self.function == 'sum':
+            count, inexact, total = self.groups.get(group, (0, 0, 0))
+            if count <= 1:
+                self.groups.pop(group, None)
+            elif isinstance(value, Integral):
+                self.groups[group] = (count - 1, inexact, total - value)
+            else:
+                self.groups[group] = (count - 1, inexact - 1,
+                                      total - Fraction(value))
+        else:
+            values = self.groups.get(group)
+            if values is None:
+                return
+            position = bisect_left(values, value)
+            if position < len(values) and values[position] == value:
+                del values[position]
+                if not values:
+                    del self.groups[group]
+
+    def seed(self, rows):
+        """Adds the rows existing at the time of the subscription."""
+        for row in rows:
+            contribution = self.contribution(row)
+            if contribution is not None:
+                self.add(*contribution)
+
+    def route(self, delta):
+        """Updates the aggregate with a delta and returns a list of ``(group,
+        value)`` pairs with the groups whose value changed."""
+        if isinstance(delta, InsertionDelta):
+            removed, added = None, self.contribution(delta.data)
+        elif isinstance(delta, DeletionDelta):
+            removed, added = self.contribution(delta.data), None
+        elif isinstance(delta, UpdateDelta):
+            removed = self.contribution(delta.old_data)
+            added = self.contribution(delta.new_data)
+        else:
+            return []
+        if removed == added:
+            return []
+
+        groups = [contribution[0]
+                  for contribution in (removed, added)
+                  if contribution is not None]
+        if len(groups) == 2 and groups[0] == groups[1]:
+            del groups[1]
+        old_values = [self.value(group) for group in groups]
+
+        if removed is not None:
+            self.remove(*removed)
+        if added is not None:
+            self.add(*added)
+
+        changes = []
+        for group, old_value in zip(groups, old_values):
+            value = self.value(group)
+            if value != old_value or type(value) != type(old_value):
+                changes.append((group, value))
+        return changes
+
+
+class AggregateDealer(Dealer):
+    """This dealer maintains aggregates of the rows matching a filter, such as
+    the count of unread messages, and sends an
+    :py:class:`snorky.services.datasync.delta.AggregateDelta` with the new
+    value each time it changes instead of the row deltas.
+
+    The query is a dictionary with these keys:
+
+    ``function``
+        One of ``count``, ``sum``, ``min`` or ``max``.
+    ``field``
+        The field whose values are aggregated. Not used by ``count``. Rows
+        without a number in it (or a number or a string for ``min`` and
+        ``max``) are ignored. Sums are exact while there are rows, and sent
+        as a float if any of the summed values is not an integer.
+    ``groupBy``
+        Optional, a field. If present an aggregate is computed for each of
+        its values.
+    ``filter``
+        Optional, a filter as accepted by :py:class:`FilterDealer`.
+    ``label``
+        Optional, a string sent back in the deltas so the client can tell
+        apart several aggregates.
+    ``rows``
+        Optional, the rows of the query at the time of the subscription. If
+        not given the aggregates start as if there were none.
+
+    Subscription items with the same query (not counting ``label`` and
+    ``rows``) share their aggregates.
+    """
+    __slots__ = ('aggregates', 'aggregates_by_item')
+
+    def __init__(self):
+        super(AggregateDealer, self).__init__()
+
+        self.aggregates = {}
+        """Aggregates by the key of their query."""
+
+        self.aggregates_by_item = {}
+        """Aggregate key and label of each subscription item."""
+
+    def parse_query(self, query):
+        """Validates a query and returns the key identifying its aggregate,
+        its label and its initial rows.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        if not isinstance(query, dict):
+            raise BadQuery("The query must be a dictionary")
+
+        function = query.get("function")
+        field = query.get("field")
+        group_by = query.get("groupBy")
+        filter = query.get("filter")
+        label = query.get("label")
+        rows = query.get("rows", [])
+
+        if function not in Aggregate.functions:
+            raise BadQuery("Unknown aggregate function: %r" % (function,))
+        if function == 'count':
+            field = None
+        elif not is_string(field):
+            raise BadQuery("field must be a field name")
+        else:
+            split_field(field)
+        if group_by is not None:
+            if not is_string(group_by):
+                raise BadQuery("groupBy must be a field name")
+            split_field(group_by)
+        if filter is not None:
+            if not isinstance(filter, list):
+                raise BadQuery("filter must be a list")
+            filter = canonical_filter(filter)
+        if label is not None and not is_string(label):
+            raise BadQuery("label must be a string")
+        if not isinstance(rows, list):
+            raise BadQuery("rows must be a list")
+
+        return (filter, function, field, group_by), label, rows
+
+    def add_subscription_item(self, item):
+        """Adds a new subscription item. Items with an equal query share the
+        aggregate, which is seeded only by the first of them.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        key, label, rows = self.parse_query(item.query)
+
+        aggregate = self.aggregates.get(key)
+        if aggregate is None:
+            aggregate = Aggregate(*key)
+            aggregate.seed(rows)
+            self.aggregates[key] = aggregate
+
+        aggregate.items.add(label, item)
+        self.aggregates_by_item[item] = (key, label)
+
+    def remove_subscription_item(self, item):
+        """Removes a subscription item."""
+        key, label = self.aggregates_by_item.pop(item)
+        aggregate = self.aggregates[key]
+        aggregate.items.remove(label, item)
+        if not aggregate.items:
+            del self.aggregates[key]
+
+    def get_subscription_items_for_model(self, model):
+        """Returns the subscription items whose aggregates count the model."""
+        matched_items = set()
+        for aggregate in self.aggregates.values():
+            if aggregate.contribution(model) is not None:
+                for label_items in aggregate.items.values():
+                    matched_items.update(label_items)
+        return matched_items
+
+    def route_delta(self, delta):
+        """Updates every aggregate with the delta and returns the aggregate
+        deltas their subscription items must receive."""
+        route = []
+        for aggregate in self.aggregates.values():
+            for group, value in aggregate.route(delta):
+                for label, label_items in items(aggregate.items):
+                    aggregate_delta = AggregateDelta(delta.model, self.name,
+                                                     label, group, value)
+                    route.extend((item, aggregate_delta)
+                                 for item in label_items)
+        return route
+
+    def route_deltas(self, deltas):
+        """Aggregates change with every delta, so each is routed in turn."""
+        return [self.route_delta(delta) for delta in deltas]
+
+
+def parse_timestamp(value):
+    """Returns a timestamp as seconds since the epoch. Accepts numbers, which
+    are returned as they are, and ISO 8601 strings, which are assumed to be
+    in UTC if they don't specify a timezone.
+
+    Returns ``None`` for any other value."""
+    if isinstance(value, Number) and not isinstance(value, bool):
+        return value if value == value else None
+    elif is_string(value):
+        try:
+            date = dateutil.parser.parse(value)
+        except (ValueError, OverflowError):
+            return None
+        if date.utcoffset() is not None:
+            date = date - date.utcoffset()
+        return calendar.timegm(date.timetuple()) + \
+                date.microsecond / 1000000.0
+    return None
+
+
+class TimeWindow(object):
+    """The rows of a query whose timestamp is within the last seconds, as
+    maintained by a :py:class:`TimeWindowDealer`.
+    """
+    __slots__ = ('dealer', 'compiled', 'seconds', 'rows', 'expirations',
+                 'counter', 'timeout', 'items')
+
+    def __init__(self, dealer, filter, seconds):
+        self.dealer = dealer
+        self.compiled = CompiledFilter(filter) if filter is not None else None
+        self.seconds = seconds
+
+        self.rows = {}
+        """Expiration time and data of each row in the window by primary
+        key."""
+
+        self.expirations = []
+        """Heap of ``(expiration, counter, primary key)`` tuples. Entries of
+        rows which have been removed or updated are left in the heap and
+        skipped when they reach the top."""
+
+        self.counter = 0
+        """Tie breaker for the heap, so primary keys are never compared."""
+
+        self.timeout = None
+        """Timeout handle for the earliest expiration, if any."""
+
+        self.items = set()
+        """Subscription items sharing this window."""
+
+    def expiration(self, row):
+        """Returns when a row leaves the window, or ``None`` if it does not
+        satisfy the filter or has already left."""
+        if self.compiled is not None and not self.compiled.matches(row):
+            return None
+        try:
+            timestamp = parse_timestamp(self.dealer.get_time_field(row))
+        except (KeyError, TypeError):
+            return None
+        if timestamp is None:
+            return None
+
+        expiration = timestamp + self.seconds
+        if expiration <= self.dealer.clock():
+            return None
+        return expiration
+
+    def add(self, pk, expiration, row):
+        """Adds or replaces a row in the window."""
+        self.rows[pk] = (expiration, row)
+        self.counter += 1
+        heapq.heappush(self.expirations, (expiration, self.counter, pk))
+        if self.expirations[0][1] == self.counter:
+            # New earliest expiration
+            self.schedule()
+
+    def schedule(self):
+        """Sets a timeout for the earliest expiration, replacing the previous
+        one."""
+        if self.timeout is not None:
+            self.timeout.cancel()
+            self.timeout = None
+        if self.expirations:
+            delay = max(0, self.expirations[0][0] - self.dealer.clock())
+            self.timeout = self.dealer.timeout_factory.call_later(
+                delay, self.expire)
+
+    def expire(self):
+        """Called when the earliest expiration is due. Removes every expired
+        row, sends the deletion deltas and schedules the next expiration."""
+        self.timeout = None
+        now = self.dealer.clock()
+        expirations = self.expirations
+        while expirations and expirations[0][0] <= now:
+            expiration, counter, pk = heapq.heappop(expirations)
+            entry = self.rows.get(pk)
+            if entry is None or entry[0] != expiration:
+                # Stale entry
+                continue
+            del self.rows[pk]
+            delta = DeletionDelta(self.dealer.model, entry[1])
+            for item in self.items:
+                item.subscription.deliver_delta(delta)
+        self.schedule()
+
+    def cancel(self):
+        """Stops expiring rows."""
+        if self.timeout is not None:
+            self.timeout.cancel()
+            self.timeout = None
+
+    def seed(self, rows):
+        """Adds the rows of the query at the time of the subscription."""
+        for row in rows:
+            pk = self.dealer.primary_key_for(row)
+            expiration = self.expiration(row)
+            if pk is not None and expiration is not None:
+                self.add(pk, expiration, row)
+
+    def route(self, delta):
+        """Updates the window with a delta and returns the list of deltas the
+        subscription items of the window must receive."""
+        primary_key_for = self.dealer.primary_key_for
+        if isinstance(delta, InsertionDelta):
+            pk = primary_key_for(delta.data)
+            expiration = self.expiration(delta.data)
+            if pk is None or expiration is None:
+                return []
+            self.add(pk, expiration, delta.data)
+            return [delta]
+        elif isinstance(delta, DeletionDelta):
+            pk = primary_key_for(delta.data)
+            if pk is None or self.rows.pop(pk, None) is None:
+                return []
+            return [delta]
+        elif isinstance(delta, UpdateDelta):
+            old_pk = primary_key_for(delta.old_data)
+            in_window = old_pk is not None and old_pk in self.rows
+            pk = primary_key_for(delta.new_data)
+            expiration = self.expiration(delta.new_data)
+            qualifies = pk is not None and expiration is not None
+
+            if in_window:
+                del self.rows[old_pk]
+            if qualifies:
+                self.add(pk, expiration, delta.new_data)
+
+            if in_window and qualifies:
+                return [delta]
+            elif in_window:
+                return [DeletionDelta(delta.model, delta.old_data)]
+            elif qualifies:
+                return [InsertionDelta(delta.model, delta.new_data)]
+        return []
+
+
+class TimeWindowDealer(WindowDealer):
+    """This dealer sends the rows whose timestamp is within the last seconds,
+    e.g. the activity of the last five minutes, and sends a deletion delta
+    when each of them gets too old.
+
+    The query is a dictionary with these keys:
+
+    ``seconds``
+        The length of the window.
+    ``filter``
+        Optional, a filter as accepted by :py:class:`FilterDealer`.
+    ``rows``
+        Optional, the rows of the query at the time of the subscription, so
+        they are expired as well.
+
+    The timestamp of each row is read from the field named in the
+    ``time_field`` attribute, and must be either a number of seconds since
+    the epoch or an ISO 8601 string. Rows are identified by the field named
+    in ``primary_key``.
+
+    Subscription items with the same query (not counting ``rows``) share the
+    window.
+    """
+    __slots__ = ('timeout_factory', 'clock', 'get_time_field')
+
+    time_field = 'timestamp'
+
+    def __init__(self, timeout_factory=None, clock=None):
+        super(TimeWindowDealer, self).__init__()
+
+        self.timeout_factory = timeout_factory or TornadoTimeoutFactory
+
+        self.clock = clock or time.time
+        """Function returning the current time in seconds since the
+        epoch."""
+
+        self.get_time_field = compile_getter(split_field(self.time_field))
+
+    def parse_query(self, query):
+        """Validates a query and returns the key identifying its window and
+        its initial rows.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        if not isinstance(query, dict):
+            raise BadQuery("The query must be a dictionary")
+
+        seconds = query.get("seconds")
+        filter = query.get("filter")
+        rows = query.get("rows", [])
+
+        if not isinstance(seconds, Number) or isinstance(seconds, bool) or \
+                not seconds > 0:
+            raise BadQuery("seconds must be a positive number")
+        if filter is not None:
+            if not isinstance(filter, list):
+                raise BadQuery("filter must be a list")
+            filter = canonical_filter(filter)
+        if not isinstance(rows, list):
+            raise BadQuery("rows must be a list")
+
+        return (filter, seconds), rows
+
+    def create_window(self, key):
+        """Returns a new window of the last seconds the query says."""
+        return TimeWindow(self, *key)
+
+    def drop_window(self, window):
+        """Stops expiring the rows of a window no longer used."""
+        window.cancel()
+
+
+def is_finite(value):
+    """Returns whether a value is a number which fits in a float and is
+    neither infinite nor NaN."""
+    if not isinstance(value, Number):
+        return False
+    try:
+        value = float(value)
+    except (OverflowError, TypeError):
+        return False
+    return not (math.isinf(value) or math.isnan(value))
+
+
+class BoundingBoxDealer(Dealer):
+    """This dealer matches models located inside rectangular areas, e.g.
+    vehicles within the part of a map a client is showing.
+
+    The query is a list ``[min_x, min_y, max_x, max_y]``. A model matches if
+    ``min_x <= x < max_x`` and ``min_y <= y < max_y``, being ``x`` and ``y``
+    the values of the fields named in the ``x_field`` and ``y_field``
+    attributes.
+
+    Boxes are indexed in a uniform grid of ``cell_size`` units, so only the
+    boxes overlapping the cell of a model are checked. Boxes overlapping more
+    than ``max_cells`` cells are checked for every model instead.
+    """
+    __slots__ = ('items_by_box', 'boxes_by_cell', 'large_boxes',
+                 'get_x', 'get_y')
+
+    x_field = 'x'
+    y_field = 'y'
+    cell_size = 1.0
+    max_cells = 1024
+
+    def __init__(self):
+        super(BoundingBoxDealer, self).__init__()
+
+        self.items_by_box = MultiDict()
+        """Subscription items by box."""
+
+        self.boxes_by_cell = MultiDict()
+        """Boxes by the ``(column, row)`` of each cell they overlap."""
+
+        self.large_boxes = set()
+        """Boxes overlapping too many cells to be indexed."""
+
+        self.get_x = compile_getter(split_field(self.x_field))
+        self.get_y = compile_getter(split_field(self.y_field))
+
+    def parse_query(self, query):
+        """Validates a query and returns it as a tuple.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        if not isinstance(query, list) or len(query) != 4:
+            raise BadQuery("The query must be [min_x, min_y, max_x, max_y]")
+        for value in query:
+            if isinstance(value, bool) or not is_finite(value):
+                raise BadQuery("Coordinates must be finite numbers")
+        min_x, min_y, max_x, max_y = query
+        if min_x > max_x or min_y > max_y:
+            raise BadQuery("The minimum coordinates must not exceed the "
+                           "maximum ones")
+        return tuple(query)
+
+    def cell(self, x, y):
+        """Returns the grid cell containing a point."""
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def box_cells(self, box):
+        """Returns the cells overlapped by a box, or ``None`` if they are more
+        than ``max_cells``."""
+        min_x, min_y, max_x, max_y = box
+        min_column, min_row = self.cell(min_x, min_y)
+        max_column, max_row = self.cell(max_x, max_y)
+        if (max_column - min_column + 1) * (max_row - min_row + 1) > \
+                self.max_cells:
+            return None
+        return [(column, row)
+                for column in range(min_column, max_column + 1)
+                for row in range(min_row, max_row + 1)]
+
+    def add_subscription_item(self, item):
+        """Adds a new subscription item. The query must be a bounding box.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        box = self.parse_query(item.query)
+        if box not in self.items_by_box:
+            cells = self.box_cells(box)
+            if cells is None:
+                self.large_boxes.add(box)
+            else:
+                for cell in cells:
+                    self.boxes_by_cell.add(cell, box)
+        self.items_by_box.add(box, item)
+        self.invalidate_match_cache()
+
+    def remove_subscription_item(self, item):
+        """Removes a subscription item."""
+        box = tuple(item.query)
+        self.items_by_box.remove(box, item)
+        if box not in self.items_by_box:
+            cells = self.box_cells(box)
+            if cells is None:
+                self.large_boxes.remove(box)
+            else:
+                for cell in cells:
+                    self.boxes_by_cell.remove(cell, box)
+        self.invalidate_match_cache()
+
+    def get_subscription_items_for_model(self, model):
+        """Returns the subscription items whose box contains the model."""
+        try:
+            x = self.get_x(model)
+            y = self.get_y(model)
+        except (KeyError, TypeError):
+            return set()
+        if not is_finite(x) or not is_finite(y):
+            return set()
+
+        matched_items = set()
+        for boxes in (self.boxes_by_cell.get_set(self.cell(x, y)),
+                      self.large_boxes):
+            for box in boxes:
+                min_x, min_y, max_x, max_y = box
+                if min_x <= x < max_x and min_y <= y < max_y:
+                    matched_items.update(self.items_by_box[box])
+        return matched_items
+
+    def get_dependent_fields(self):
+        """Returns the top level fields of the coordinates."""
+        return (split_field(self.x_field)[0], split_field(self.y_field)[0])
+
+
+class TrieNode(object):
+    """A node of the trie of a :py:class:`PrefixDealer`."""
+    __slots__ = ('children', 'items')
+
+    def __init__(self):
+        self.children = {}
+        """Child nodes by character."""
+
+        self.items = set()
+        """Subscription items whose prefix ends in this node."""
+
+
+class PrefixDealer(Dealer):
+    """This dealer matches models whose key starts with the string given as
+    query, e.g. a query ``"projects/42/"`` matches the documents of that
+    project and its subfolders.
+
+    By default the key is the value of the field named in the ``key_field``
+    attribute. Subclasses may compute it otherwise overriding
+    :py:meth:`get_key_for_model`, as long as it only depends on that field.
+
+    Subscription items are stored in a trie, so each delta only walks the
+    nodes along its key.
+    """
+    __slots__ = ('root', 'get_key_field')
+
+    key_field = 'path'
+
+    def __init__(self):
+        super(PrefixDealer, self).__init__()
+
+        self.root = TrieNode()
+        """Root of the trie of subscription items by prefix."""
+
+        self.get_key_field = compile_getter(split_field(self.key_field))
+
+    def get_key_for_model(self, model):
+        """Returns the key of a model, the value of ``key_field`` by
+        default."""
+        return self.get_key_field(model)
+
+    def add_subscription_item(self, item):
+        """Adds a subscription item. The query must be a string prefix.
+
+        Raises :py:class:`BadQuery` if the query is not a string."""
+        if not is_string(item.query):
+            raise BadQuery("The query must be a string")
+
+        node = self.root
+        for char in item.query:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = TrieNode()
+            node = child
+        node.items.add(item)
+        self.invalidate_match_cache()
+
+    def remove_subscription_item(self, item):
+        """Removes a subscription item."""
+        path = [self.root]
+        for char in item.query:
+            path.append(path[-1].children[char])
+        path[-1].items.remove(item)
+
+        # Prune the nodes left empty
+        for depth in range(len(item.query), 0, -1):
+            node = path[depth]
+            if node.items or node.children:
+                break
+            del path[depth - 1].children[item.query[depth - 1]]
+        self.invalidate_match_cache()
+
+    def get_subscription_items_for_model(self, model):
+        """Returns the subscription items whose prefix the model key starts
+        with."""
+        try:
+            key = self.get_key_for_model(model)
+        except (KeyError, TypeError):
+            return set()
+        if not is_string(key):
+            return set()
+
+        node = self.root
+        matched_items = set(node.items)
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                break
+            matched_items.update(node.items)
+        return matched_items
+
+    def get_dependent_fields(self):
+        """Returns the top level field of ``key_field``."""
+        return (split_field(self.key_field)[0],)
+
+
+class JoinDealer(Dealer):
+    """This dealer matches models through a related parent model, e.g. the
+    todos whose list is owned by a certain user.
+
+    Models reference their parent with the field named in the
+    ``foreign_key`` attribute. The query is a dictionary with these keys:
+
+    ``value``
+        The value the field named in ``parent_field`` must have in the
+        parent, e.g. the id of the owner of the list.
+    ``parents``
+        Optional, the primary keys of the parents having that value at the
+        time of the subscription.
+
+    The dealer keeps a map of the ``parent_field`` value of each parent,
+    updated from the deltas of ``parent_model`` (identified by the field
+    named in ``parent_primary_key``), so changes of the parent do not
+    require new subscriptions. Changing the parent of a model results in
+    insertion and deletion deltas as usual, but changing the
+    ``parent_field`` of a parent only affects the deltas sent afterwards,
+    since the dealer does not know its children.
+
+    Only the parents with a value some subscription item wants are kept, so
+    the map does not grow with parents no one is interested in. A new
+    subscription item for a value gives the parents having it in
+    ``parents``.
+    """
+    __slots__ = ('values_by_parent', 'parents_by_value', 'items_by_value',
+                 'get_foreign_key', 'get_parent_primary_key',
+                 'get_parent_field')
+
+    parent_model = None
+    foreign_key = 'parent_id'
+    parent_primary_key = 'id'
+    parent_field = None
+
+    def __init__(self):
+        super(JoinDealer, self).__init__()
+
+        self.values_by_parent = {}
+        """Value of ``parent_field`` of each known parent, by primary key."""
+
+        self.parents_by_value = MultiDict()
+        """Primary keys of the known parents, by value of
+        ``parent_field``."""
+
+        self.items_by_value = MultiDict()
+        """Subscription items by the value of ``parent_field`` they
+        want."""
+
+        self.get_foreign_key = compile_getter(split_field(self.foreign_key))
+        self.get_parent_primary_key = \
+                compile_getter(split_field(self.parent_primary_key))
+        self.get_parent_field = compile_getter(split_field(self.parent_field))
+
+    @property
+    def related_models(self):
+        """The parent model class."""
+        return (self.parent_model,)
+
+    def parent_entry(self, parent):
+        """Returns the primary key and ``parent_field`` value of a parent, or
+        ``None`` if they are missing or unhashable."""
+        try:
+            entry = (self.get_parent_primary_key(parent),
+                     self.get_parent_field(parent))
+            hash(entry)
+            return entry
+        except (KeyError, TypeError):
+            return None
+
+    def set_parent(self, parent, value):
+        """Records the value of a parent, or forgets the parent if no
+        subscription item wants its value."""
+        self.forget_parent(parent)
+        if value in self.items_by_value:
+            self.values_by_parent[parent] = value
+            self.parents_by_value.add(value, parent)
+
+    def forget_parent(self, parent):
+        """Removes a parent from the map, if it is there."""
+        try:
+            value = self.values_by_parent.pop(parent)
+        except KeyError:
+            return
+        self.parents_by_value.remove(value, parent)
+
+    def process_related_delta(self, delta):
+        """Updates the map of parents with a delta of the parent model."""
+        if isinstance(delta, InsertionDelta):
+            removed, added = None, self.parent_entry(delta.data)
+        elif isinstance(delta, DeletionDelta):
+            removed, added = self.parent_entry(delta.data), None
+        elif isinstance(delta, UpdateDelta):
+            removed = self.parent_entry(delta.old_data)
+            added = self.parent_entry(delta.new_data)
+        else:
+            return
+        if removed == added:
+            return
+
+        if removed is not None:
+            self.forget_parent(removed[0])
+        if added is not None:
+            self.set_parent(*added)
+        self.invalidate_match_cache()
+
+    def add_subscription_item(self, item):
+        """Adds a subscription item.
+
+        Raises :py:class:`BadQuery` if the query is malformed."""
+        query = item.query
+        if not isinstance(query, dict) or "value" not in query:
+            raise BadQuery("The query must be a dictionary with a value")
+        value = query["value"]
+        parents = query.get("parents", [])
+        if not isinstance(parents, list):
+            raise BadQuery("parents must be a list")
+        try:
+            hash(value)
+            for parent in parents:
+                hash(parent)
+        except TypeError:
+            raise BadQuery("The value and the parents must be hashable")
+
+        self.items_by_value.add(value, item)
+        for parent in parents:
+            self.set_parent(parent, value)
+        self.invalidate_match_cache()
+
+    def remove_subscription_item(self, item):
+        """Removes a subscription item, and the parents with its value if no
+        other subscription item wants it."""
+        value = item.query["value"]
+        self.items_by_value.remove(value, item)
+        if value not in self.items_by_value:
+            for parent in self.parents_by_value.pop(value, ()):
+                del self.values_by_parent[parent]
+        self.invalidate_match_cache()
+
+    def get_subscription_items_for_model(self, model):
+        """Returns the subscription items wanting the parent of the model."""
+        try:
+            parent = self.get_foreign_key(model)
+            value = self.values_by_parent[parent]
+        except (KeyError, TypeError):
+            return set()
+        return self.items_by_value.get_set(value)
+
+    def get_dependent_fields(self):
+        """Returns the top level field of ``foreign_key``."""
+        return (split_field(self.foreign_key)[0],)
@@ -2,14 +2,57 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from snorky.codec import EncodedMessage
+
+
+def same_value(a, b):
+    """Whether two JSON values are equal, without considering equal values of
+    different types, like ``1`` and ``true``."""
+    return type(a) is type(b) and a == b
+
+
 class Delta(object):
     """Any kind of data change notification."""
-    __slots__ = tuple()
+    __slots__ = ('_messages',)
 
     def __eq__(self, other):
         # Only used in unit tests
         return isinstance(other, Delta) and self.for_json() == other.for_json()
 
+    def for_patch_json(self, primary_key):
+        """Returns this instance as a dictionary in the patch format, which
+        identifies rows by their ``primary_key`` field instead of repeating
+        them, or ``None`` if the patch format is the same as
+        :py:meth:`for_json` or is not possible for this delta."""
+        return None
+
+    def message(self, service_name, primary_key=None):
+        """Returns the :py:class:`snorky.codec.EncodedMessage` the service
+        named ``service_name`` sends to clients with this delta, in the patch
+        format if a ``primary_key`` is specified.
+
+        The result is cached, since the same delta is usually sent to many
+        clients: they share the same message and the encodings made for their
+        codecs. Deltas must not be modified after this is called."""
+        try:
+            messages = self._messages
+        except AttributeError:
+            messages = self._messages = {}
+
+        try:
+            return messages[service_name, primary_key]
+        except KeyError:
+            delta = None
+            if primary_key is not None:
+                delta = self.for_patch_json(primary_key)
+            if delta is None:
+                delta = self.for_json()
+            message = messages[service_name, primary_key] = EncodedMessage({
+                "service": service_name,
+                "message": {"type": "delta", "delta": delta},
+            })
+            return message
+
 
 class InsertionDelta(Delta):
     """An insertion notification."""
@@ -54,6 +97,29 @@ class UpdateDelta(Delta):
             "oldData": self.old_data,
         }
 
+    def for_patch_json(self, primary_key):
+        """Returns the key of the row before the update, the fields which
+        were added or changed in ``changes`` and, if any, the names of the
+        fields which were removed in ``removed``."""
+        old_data, new_data = self.old_data, self.new_data
+        if not (isinstance(old_data, dict) and isinstance(new_data, dict) and
+                primary_key in old_data):
+            return None
+
+        patch = {
+            "type": "update",
+            "model": self.model,
+            "key": old_data[primary_key],
+            "changes": dict(
+                (field, value) for (field, value) in new_data.items()
+                if field not in old_data or
+                    not same_value(old_data[field], value)),
+        }
+        removed = [field for field in old_data if field not in new_data]
+        if removed:
+            patch["removed"] = sorted(removed)
+        return patch
+
 
 class DeletionDelta(Delta):
     """A deletion notification."""
@@ -73,3 +139,48 @@ class DeletionDelta(Delta):
             "model": self.model,
             "data": self.data,
         }
+
+    def for_patch_json(self, primary_key):
+        """Returns only the key of the removed row."""
+        if not (isinstance(self.data, dict) and primary_key in self.data):
+            return None
+
+        return {
+            "type": "delete",
+            "model": self.model,
+            "key": self.data[primary_key],
+        }
+
+
+class AggregateDelta(Delta):
+    """A notification of a new value of an aggregate, e.g. a count of rows,
+    sent by an :py:class:`AggregateDealer` instead of the row deltas."""
+    __slots__ = ("model", "dealer", "label", "group", "value")
+
+    def __init__(self, model, dealer, label, group, value):
+        self.model = model
+        """The model class name this change occured in."""
+
+        self.dealer = dealer
+        """The name of the dealer computing the aggregate."""
+
+        self.label = label
+        """The label given to the aggregate in the query, if any."""
+
+        self.group = group
+        """The value of the grouping field the aggregate is for, or ``None``
+        if the aggregate is not grouped."""
+
+        self.value = value
+        """The new value of the aggregate."""
+
+    def for_json(self):
+        """Returns this instance as a dictionary."""
+        return {
+            "type": "aggregate",
+            "model": self.model,
+            "dealer": self.dealer,
+            "label": self.label,
+            "group": self.group,
+            "value": self.value,
+        }
@@ -0,0 +1,456 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import operator
+from functools import wraps
+from snorky.types import PY2, StringTypes, Number, is_string
+from snorky.hashable import make_hashable
+
+
+class BadQuery(Exception):
+    pass
+
+"""
+Filter syntax
+=============
+
+['==', 'color', 'blue']
+color is 'blue'
+
+['<', 'age', 21]
+age is less than 21
+
+['>=', 'age', 21]
+age is greater than or equal to 21
+
+['and', ['==', 'service', 'prosody'], ['>=', 'severity_level', 3]]
+service is 'prosody' and severity_level is greater than or equal to 3
+
+['or', ['not', ['==', 'service', 'java']], ['>=', 'severity_level', 3]]
+service is not 'java' or severity_level is greater than or equal to 3
+
+['==', 'player.color', 'blue']
+color of player is 'blue'
+"""
+
+def get_field(model, name):
+    """
+    Given a dictionary for `model` and a dot separated string for `name`,
+    accesses the named properties in model.
+
+    e.g. get_field(model, 'service.name') returns model['service']['name']
+    """
+    prop = model
+    for prop_name in name.split('.'):
+        prop = prop[prop_name]
+    return prop
+
+def false_on_raise(function):
+    """Decorator to make a function return False when a :py:class:`KeyError` or
+    :py:class:`TypeError` is thrown.
+    """
+    @wraps(function)
+    def _false_on_raise(*args):
+        try:
+            return function(*args)
+        except (KeyError, TypeError):
+            # KeyError: missing property
+            # TypeError: unorderable types (e.g. compared str with int)
+            return False
+    return _false_on_raise
+
+def orderable_types(a, b):
+    """The provided parameters are orderable if and only if both are number
+    types or both are string types."""
+    return (isinstance(a, Number) and isinstance(b, Number)) or \
+            (isinstance(a, StringTypes) and isinstance(b, StringTypes))
+
+@false_on_raise
+def filter_eq(model, field, value):
+    """Equality filter."""
+    return get_field(model, field) == value
+
+@false_on_raise
+def filter_lt(model, field, value):
+    """*Less than* filter"""
+    field_value = get_field(model, field)
+    # Python3 does not allow to compare strings with numbers, emulate that.
+    if PY2 and not orderable_types(field_value, value):
+        raise TypeError
+    return field_value < value
+
+@false_on_raise
+def filter_lte(model, field, value):
+    """*Less than or equal* filter"""
+    field_value = get_field(model, field)
+    # Python3 does not allow to compare strings with numbers, emulate that.
+    if PY2 and not orderable_types(field_value, value):
+        raise TypeError
+    return field_value <= value
+
+@false_on_raise
+def filter_gt(model, field, value):
+    """*Greater than* filter"""
+    field_value = get_field(model, field)
+    # Python3 does not allow to compare strings with numbers, emulate that.
+    if PY2 and not orderable_types(field_value, value):
+        raise TypeError
+    return field_value > value
+
+@false_on_raise
+def filter_gte(model, field, value):
+    """*Greater or equal than* filter"""
+    field_value = get_field(model, field)
+    # Python3 does not allow to compare strings with numbers, emulate that.
+    if PY2 and not orderable_types(field_value, value):
+        raise TypeError
+    return field_value >= value
+
+@false_on_raise
+def filter_not(model, expr):
+    """*Not* filter."""
+    return not filter_matches(model, expr)
+
+@false_on_raise
+def filter_and(model, *expressions):
+    """*And* filter. Accepts any number of expressions."""
+    return all(filter_matches(model, expr)
+               for expr in expressions)
+
+@false_on_raise
+def filter_or(model, *expressions):
+    """*Or* filter. Accepts any number of expressions."""
+    return any(filter_matches(model, expr)
+               for expr in expressions)
+
+operator_functions = {
+    '==': filter_eq,
+    '<': filter_lt,
+    '<=': filter_lte,
+    '>': filter_gt,
+    '>=': filter_gte,
+    'and': filter_and,
+    'or': filter_or,
+    'not': filter_not,
+}
+
+def filter_matches(model, filter):
+    """Returns true if a model matches the provided filter."""
+    op = filter[0]
+    args = filter[1:]
+    return operator_functions[op](model, *args)
+
+
+"""
+Compiled filters
+================
+
+Interpreting a filter with :py:func:`filter_matches` means looking up every
+operator, splitting every field name and going through the exception handling
+machinery for every node of the expression, every time a model is checked.
+
+Dealers which check the same filters against many models compile them first
+with :py:func:`compile_filter`, which walks the expression only once and
+returns a predicate made of closures with the field paths already split and
+the constants already bound. The semantics are the same as in
+:py:func:`filter_matches`: a missing field or a comparison between unorderable
+types makes the comparison false.
+"""
+
+comparison_operators = {
+    '==': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+boolean_operators = ('and', 'or', 'not')
+
+def is_filter(thing):
+    """Returns true if the value has the shape of a filter expression, i.e. it
+    is a non empty list or tuple."""
+    return isinstance(thing, (list, tuple)) and len(thing) > 0
+
+def split_field(name):
+    """Returns the path of a dot separated field name as a tuple.
+
+    Raises :py:class:`BadQuery` if the name is not a string."""
+    if not is_string(name):
+        raise BadQuery("Field names must be strings")
+    return tuple(name.split('.'))
+
+def compile_getter(path):
+    """Returns a function which accesses the field with the provided path (as
+    returned by :py:func:`split_field`) in a model."""
+    if len(path) == 1:
+        return operator.itemgetter(path[0])
+
+    def getter(model):
+        for prop_name in path:
+            model = model[prop_name]
+        return model
+    return getter
+
+def compile_comparison(op, path, value):
+    """Returns a predicate for a comparison atom, e.g. ``['<', 'age', 21]``.
+    """
+    getter = compile_getter(path)
+    compare = comparison_operators[op]
+
+    if op == '==' or not PY2:
+        def predicate(model):
+            try:
+                return compare(getter(model), value)
+            except (KeyError, TypeError):
+                return False
+    else:
+        # Python3 does not allow to compare strings with numbers, emulate that.
+        def predicate(model):
+            try:
+                field_value = getter(model)
+                if not orderable_types(field_value, value):
+                    return False
+                return compare(field_value, value)
+            except (KeyError, TypeError):
+                return False
+    return predicate
+
+def compile_and(predicates):
+    """Returns a predicate which is true if all the provided predicates are
+    true."""
+    predicates = tuple(predicates)
+
+    def predicate(model):
+        for sub_predicate in predicates:
+            if not sub_predicate(model):
+                return False
+        return True
+    return predicate
+
+def compile_or(predicates):
+    """Returns a predicate which is true if any of the provided predicates is
+    true."""
+    predicates = tuple(predicates)
+
+    def predicate(model):
+        for sub_predicate in predicates:
+            if sub_predicate(model):
+                return True
+        return False
+    return predicate
+
+def compile_not(sub_predicate):
+    """Returns a predicate which negates the provided one."""
+    def predicate(model):
+        return not sub_predicate(model)
+    return predicate
+
+def compile_filter(filter):
+    """Translates a filter expression into a function which receives a model
+    and returns whether it matches the filter.
+
+    Raises :py:class:`BadQuery` if the expression is malformed.
+    """
+    if not is_filter(filter):
+        raise BadQuery("Filters must be non empty lists")
+
+    op = filter[0]
+    args = filter[1:]
+
+    if op in comparison_operators:
+        if len(args) != 2:
+            raise BadQuery("'%s' expects a field and a value" % op)
+        field, value = args
+        return compile_comparison(op, split_field(field), value)
+    elif op == 'and':
+        return compile_and(compile_filter(expr) for expr in args)
+    elif op == 'or':
+        return compile_or(compile_filter(expr) for expr in args)
+    elif op == 'not':
+        if len(args) != 1:
+            raise BadQuery("'not' expects exactly one expression")
+        return compile_not(compile_filter(args[0]))
+    else:
+        raise BadQuery("Unknown operator: %r" % (op,))
+
+
+class CompiledFilter(object):
+    """A filter expression along with the predicate it compiles to.
+
+    Call :py:meth:`matches` with a model to check whether it satisfies the
+    filter.
+    """
+    __slots__ = ('filter', 'matches')
+
+    def __init__(self, filter):
+        self.filter = filter
+        """The original filter expression."""
+
+        self.matches = compile_filter(filter)
+        """A function which returns whether a model matches the filter."""
+
+
+"""
+Filter analysis
+===============
+
+Functions to inspect the structure of a filter expression, used by the
+matchers in :py:mod:`snorky.services.datasync.matchers` to index filters.
+"""
+
+def is_scalar(value):
+    """Returns true if the value is a string, a number, a boolean or None.
+
+    Scalars are hashable and equal only to other scalars, therefore they can be
+    used as keys of an index over model fields."""
+    return value is None or isinstance(value, Number) or is_string(value)
+
+def is_orderable_scalar(value):
+    """Returns true if the value is a number or a string, as long as it is not
+    a NaN, which cannot be ordered."""
+    if isinstance(value, Number):
+        return value == value
+    return is_string(value)
+
+def required_atoms(filter):
+    """Returns a list of ``(op, path, value)`` tuples, one for each comparison
+    atom that must be satisfied for the filter to match, i.e. the filter itself
+    or the operands of a top level ``and``.
+
+    Only equalities against scalars and order comparisons against numbers or
+    strings are returned.
+    """
+    op = filter[0]
+    if op in comparison_operators:
+        field, value = filter[1:]
+        if (op == '==' and is_scalar(value)) or \
+                (op != '==' and is_orderable_scalar(value)):
+            return [(op, split_field(field), value)]
+    elif op == 'and':
+        return [atom
+                for expr in filter[1:]
+                for atom in required_atoms(expr)]
+    return []
+
+def is_indexable_atom(op, value):
+    """Returns true if a comparison atom with the provided operator and value
+    can be looked up in an index (see :py:func:`required_atoms`)."""
+    if op == '==':
+        return is_scalar(value)
+    return is_orderable_scalar(value)
+
+def to_dnf(filter, max_conjunctions=32):
+    """Rewrites a filter in disjunctive normal form, i.e. as a list of
+    conjunctions, any of which being satisfied makes the filter match.
+
+    Each conjunction is a tuple of literals ``(negated, atom)``, where atom is
+    an ``(op, path, value)`` tuple. An empty list of conjunctions never
+    matches, while an empty conjunction always does.
+
+    Returns ``None`` if the filter contains atoms which can't be indexed or if
+    its normal form would have more than ``max_conjunctions`` conjunctions.
+    """
+    class TooComplex(Exception):
+        pass
+
+    def product(dnfs):
+        conjunctions = [()]
+        for dnf in dnfs:
+            conjunctions = [left + right
+                            for left in conjunctions
+                            for right in dnf]
+            if len(conjunctions) > max_conjunctions:
+                raise TooComplex
+        return conjunctions
+
+    def dnf(expr, negated):
+        op = expr[0]
+        args = expr[1:]
+
+        if op in comparison_operators:
+            field, value = args
+            if not is_indexable_atom(op, value):
+                raise TooComplex
+            return [((negated, (op, split_field(field), value)),)]
+        elif op == 'not':
+            return dnf(args[0], not negated)
+        elif (op == 'and') != negated:
+            # and, or a negated or (De Morgan)
+            return product(dnf(sub_expr, negated) for sub_expr in args)
+        else:
+            # or, or a negated and (De Morgan)
+            conjunctions = [conjunction
+                            for sub_expr in args
+                            for conjunction in dnf(sub_expr, negated)]
+            if len(conjunctions) > max_conjunctions:
+                raise TooComplex
+            return conjunctions
+
+    try:
+        conjunctions = dnf(filter, False)
+    except TooComplex:
+        return None
+
+    normalized = []
+    for conjunction in conjunctions:
+        literals = set(conjunction)
+        # Drop contradictions, e.g. a == 1 and not a == 1
+        if any((not negated, atom) in literals
+               for negated, atom in literals):
+            continue
+        normalized.append(tuple(literals))
+    return normalized
+
+def canonical_filter(filter):
+    """Returns a hashable canonical form of a filter, so equivalent filters
+    written differently compare equal. The result is a valid filter itself.
+
+    Lists are turned into tuples, nested ``and`` and ``or`` expressions are
+    flattened, their operands are deduplicated and sorted, and single operand
+    ``and`` and ``or`` expressions are replaced with their operand. Constants
+    are made hashable with :py:func:`snorky.hashable.make_hashable`.
+
+    Raises :py:class:`BadQuery` if the filter is malformed.
+    """
+    if not is_filter(filter):
+        raise BadQuery("Filters must be non empty lists")
+
+    op = filter[0]
+    args = filter[1:]
+
+    if op in comparison_operators:
+        if len(args) != 2:
+            raise BadQuery("'%s' expects a field and a value" % op)
+        field, value = args
+        split_field(field)
+        return (op, field, make_hashable(value))
+    elif op in ('and', 'or'):
+        operands = set()
+        for expr in args:
+            expr = canonical_filter(expr)
+            if expr[0] == op:
+                operands.update(expr[1:])
+            else:
+                operands.add(expr)
+        if len(operands) == 1:
+            return operands.pop()
+        return (op,) + tuple(sorted(operands, key=repr))
+    elif op == 'not':
+        if len(args) != 1:
+            raise BadQuery("'not' expects exactly one expression")
+        return (op, canonical_filter(args[0]))
+    else:
+        raise BadQuery("Unknown operator: %r" % (op,))
+
+def filter_fields(filter):
+    """Returns the set of top level model fields a filter reads, e.g.
+    ``{'player'}`` for ``['==', 'player.color', 'blue']``."""
+    op = filter[0]
+    if op in comparison_operators:
+        return set([split_field(filter[1])[0]])
+    fields = set()
+    for expr in filter[1:]:
+        fields.update(filter_fields(expr))
+    return fields
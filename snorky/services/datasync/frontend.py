@@ -10,14 +10,23 @@ from snorky.types import is_string
 
 class DataSyncService(RPCService):
     """Distributes deltas (change notifications) among sets of clients
-    identified by subscriptions."""
-    def __init__(self, name, dealers=[]):
+    identified by subscriptions.
+
+    ``primary_keys`` maps model class names to the name of the field which
+    identifies their rows in the patch format, by default ``id``.
+    """
+    default_primary_key = "id"
+    """Primary key of the models not in ``primary_keys``."""
+
+    def __init__(self, name, dealers=[], primary_keys=None):
         super(DataSyncService, self).__init__(name)
 
         self.dm = DealerManager()
         """Dealer manager"""
         self.sm = SubscriptionManager()
         """Subscription manager"""
+        self.primary_keys = dict(primary_keys or {})
+        """Primary key field by model class name"""
 
         for dealer in dealers:
             self.register_dealer(dealer)
@@ -47,18 +56,27 @@ class DataSyncService(RPCService):
         self.dm.unregister_dealer(dealer)
 
     @rpc_command
-    def acquireSubscription(self, req, token):
+    def acquireSubscription(self, req, token, patch=False):
         """RPC command.
 
-        Acquire a subscription given its token."""
+        Acquire a subscription given its token.
+
+        If ``patch`` is true, update and deletion deltas are sent in the patch
+        format: instead of full rows they carry the value of the primary key
+        of the row in ``key``. Updates also carry the fields which were added
+        or changed in ``changes`` and, if any, the names of the fields which
+        were removed in ``removed``. Deltas whose rows lack the primary key
+        are sent in full."""
         if not is_string(token):
             raise RPCError("token must be string")
+        if not isinstance(patch, bool):
+            raise RPCError("patch must be boolean")
 
         subscription = self.sm.get_subscription_with_token(token)
         if not subscription:
             raise RPCError("No such subscription")
 
-        self.sm.link_subscription_to_client(subscription, req.client)
+        self.sm.link_subscription_to_client(subscription, req.client, patch)
 
     @rpc_command
     def cancelSubscription(self, req, token):
@@ -84,12 +102,22 @@ class DataSyncService(RPCService):
 
         self.sm.unregister_subscription(subscription)
 
-    def deliver_delta(self, client, delta):
-        """Deliver a delta to the subscribed clients."""
-        self.send_message_to(client, {
-            "type": "delta",
-            "delta": delta.for_json()
-        })
+    def get_primary_key(self, model):
+        """Returns the primary key field of a model class."""
+        return self.primary_keys.get(model, self.default_primary_key)
+
+    def deliver_delta(self, client, delta, patch=False):
+        """Deliver a delta to the subscribed clients, in the patch format if
+        ``patch`` is true.
+
+        Every client receiving the delta in the same format gets the same
+        message, so it is encoded only once per format and codec however many
+        clients receive it."""
+        if patch:
+            primary_key = self.get_primary_key(delta.model)
+        else:
+            primary_key = None
+        client.send(delta.message(self.name, primary_key))
 
     def client_disconnected(self, client):
         """Called when a client disconnects.
@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from snorky.types import MultiDict
+from snorky.services.datasync.dealers import Dealer
 import itertools
 
 __all__ = ('UnknownDealer', 'UnknownModelClass', 'DealerManager')
@@ -25,10 +26,28 @@ class UnknownModelClass(Exception):
                 "dealer manager" % self.dealer_name
 
 
+_dealer_deliver_delta = getattr(Dealer.deliver_delta, '__func__',
+                                Dealer.deliver_delta)
+
+
+def routes_deltas(dealer):
+    """Returns true if the deltas of a dealer can be routed together with
+    :py:meth:`Dealer.route_deltas`. Dealers lacking that method or
+    overriding :py:meth:`Dealer.deliver_delta` must receive each delta
+    through ``deliver_delta`` instead."""
+    if not hasattr(dealer, 'route_deltas'):
+        return False
+    if not isinstance(dealer, Dealer):
+        return True
+    method = type(dealer).deliver_delta
+    return getattr(method, '__func__', method) is _dealer_deliver_delta
+
+
 class DealerManager(object):
     """Tracks dealers registered in the system."""
 
-    __slots__ = ('dealers_by_name', 'dealers_by_model')
+    __slots__ = ('dealers_by_name', 'dealers_by_model',
+                 'dealers_by_related_model')
 
     def __init__(self):
         self.dealers_by_name = {}
@@ -37,6 +56,9 @@ class DealerManager(object):
         self.dealers_by_model = MultiDict()
         """Dealers indexed by model."""
 
+        self.dealers_by_related_model = MultiDict()
+        """Dealers indexed by each of their ``related_models``."""
+
     def register_dealer(self, dealer):
         """Registers a new dealer."""
         name = dealer.name
@@ -52,10 +74,15 @@ class DealerManager(object):
         # Add to dealers_by_model
         self.dealers_by_model.add(model, dealer)
 
+        for related_model in getattr(dealer, 'related_models', ()):
+            self.dealers_by_related_model.add(related_model, dealer)
+
     def unregister_dealer(self, dealer):
         """Remove a dealer from the system."""
         del self.dealers_by_name[dealer.name]
         self.dealers_by_model.remove(dealer.model, dealer)
+        for related_model in getattr(dealer, 'related_models', ()):
+            self.dealers_by_related_model.remove(related_model, dealer)
 
     def get_dealer(self, name):
         """Returns a dealer with the specified name."""
@@ -66,24 +93,83 @@ class DealerManager(object):
 
     def get_dealers_for_model_class(self, model):
         """Returns an iterable of dealers with the specified model.
+
+        Model classes which are only related to some dealers (see
+        :py:attr:`Dealer.related_models`) have an empty iterable.
         """
         try:
             return self.dealers_by_model[model]
         except KeyError:
+            if model in self.dealers_by_related_model:
+                return ()
             raise UnknownModelClass(model)
 
     def deliver_delta(self, delta):
         """Deliver a delta to its associated dealers.
         """
-        for dealer in self.get_dealers_for_model_class(delta.model):
+        dealers = self.get_dealers_for_model_class(delta.model)
+        for dealer in self.dealers_by_related_model.get_set(delta.model):
+            dealer.process_related_delta(delta)
+        for dealer in dealers:
             dealer.deliver_delta(delta)
 
+    def deliver_deltas(self, deltas):
+        """Deliver several deltas to their associated dealers.
+
+        The deltas of each dealer are routed together (see
+        :py:meth:`Dealer.route_deltas`), but they are still delivered to
+        subscriptions in the same order :py:meth:`deliver_delta` would have
+        done one by one. Dealers without :py:meth:`Dealer.route_deltas` or
+        overriding :py:meth:`Dealer.deliver_delta` receive each delta through
+        ``deliver_delta`` instead.
+        """
+        # Fail before delivering anything if a model class is unknown
+        dealers_by_delta = [self.get_dealers_for_model_class(delta.model)
+                            for delta in deltas]
+
+        if any(delta.model in self.dealers_by_related_model
+               for delta in deltas):
+            # Related deltas change how the following deltas are routed
+            for delta in deltas:
+                self.deliver_delta(delta)
+            return
+
+        deltas_by_dealer = {}
+        for delta, dealers in zip(deltas, dealers_by_delta):
+            for dealer in dealers:
+                if routes_deltas(dealer):
+                    deltas_by_dealer.setdefault(dealer, []).append(delta)
+
+        routes_by_dealer = dict(
+            (dealer, iter(dealer.route_deltas(dealer_deltas)))
+            for dealer, dealer_deltas in deltas_by_dealer.items())
+
+        for delta, dealers in zip(deltas, dealers_by_delta):
+            for dealer in dealers:
+                routes = routes_by_dealer.get(dealer)
+                if routes is None:
+                    dealer.deliver_delta(delta)
+                    continue
+                for item, item_delta in next(routes):
+                    item.subscription.deliver_delta(item_delta)
+
     def connect_subscription(self, subscription):
         """Bind each of the items of a subscription to their adequate dealers.
+
+        If a dealer rejects an item, for instance raising
+        :py:class:`snorky.services.datasync.filters.BadQuery`, the items
+        already bound are disconnected before the exception propagates.
         """
-        for item in subscription.items:
-            dealer = self.get_dealer(item.dealer_name)
-            dealer.add_subscription_item(item)
+        connected = []
+        try:
+            for item in subscription.items:
+                dealer = self.get_dealer(item.dealer_name)
+                dealer.add_subscription_item(item)
+                connected.append((dealer, item))
+        except Exception:
+            for dealer, item in reversed(connected):
+                dealer.remove_subscription_item(item)
+            raise
 
     def disconnect_subscription(self, subscription):
         """Disconnect each of the items of a subscription from their dealers.
@@ -72,10 +72,10 @@ class SubscriptionManager(object):
         """Returns a Subscription with the specified token."""
         return self.subscriptions_by_token.get(token)
 
-    def link_subscription_to_client(self, subscription, client):
+    def link_subscription_to_client(self, subscription, client, patch=False):
         """Associates a client and a subscription, allowing the user to receive
-        notifications."""
-        subscription.got_client(client)
+        notifications, in the patch format if ``patch`` is true."""
+        subscription.got_client(client, patch)
 
         self.subscriptions_by_client.add(client, subscription)
 
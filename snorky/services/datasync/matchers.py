@@ -0,0 +1,683 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import abc
+from bisect import bisect_left, bisect_right
+from snorky.types import \
+        with_metaclass, MultiDict, items, Number, StringTypes, is_string
+from snorky.services.datasync.filters import \
+        comparison_operators, compile_getter, required_atoms, to_dnf
+from snorky.services.datasync.batch import BatchEvaluator
+from snorky.log import snorky_log
+
+__all__ = ('Matcher', 'ScanMatcher', 'IndexMatcher', 'CountingMatcher',
+           'AdaptiveMatcher')
+
+
+class Matcher(with_metaclass(abc.ABCMeta, object)):
+    """Strategy used by :py:class:`FilterDealer` to find which of its
+    registered filters are matched by a model.
+
+    Filters are registered as :py:class:`CompiledFilter` objects under an
+    arbitrary hashable key, which is what :py:meth:`match` returns.
+    """
+    __slots__ = tuple()
+
+    @abc.abstractmethod
+    def add(self, key, compiled):
+        """Registers a compiled filter under the specified key."""
+        pass
+
+    @abc.abstractmethod
+    def remove(self, key):
+        """Unregisters the filter with the specified key."""
+        pass
+
+    @abc.abstractmethod
+    def match(self, model):
+        """Returns a set with the keys of the filters matched by the model."""
+        pass
+
+    def match_many(self, models):
+        """Returns a list with the set of keys of the filters matched by each
+        of the models.
+
+        By default each model is matched on its own. Subclasses may override
+        this to share work across the batch."""
+        return [self.match(model) for model in models]
+
+
+class ScanMatcher(Matcher):
+    """Checks every filter against every model.
+
+    Batches of models are evaluated column by column with a
+    :py:class:`BatchEvaluator`."""
+    __slots__ = ('filters',)
+
+    def __init__(self):
+        self.filters = {}
+
+    def add(self, key, compiled):
+        self.filters[key] = compiled
+
+    def remove(self, key):
+        del self.filters[key]
+
+    def match(self, model):
+        return set(key
+                   for key, compiled in items(self.filters)
+                   if compiled.matches(model))
+
+    def match_many(self, models):
+        if len(models) < 2:
+            return [self.match(model) for model in models]
+        evaluator = BatchEvaluator(models)
+        return evaluator.match((key, compiled.filter)
+                               for key, compiled in items(self.filters))
+
+
+def order_class(value):
+    """Returns the class of values the provided value can be ordered with:
+    :py:class:`Number` for numbers or ``StringTypes`` for strings.
+
+    Returns ``None`` for any other value, and for NaN."""
+    if isinstance(value, Number):
+        return Number if value == value else None
+    elif is_string(value):
+        return StringTypes
+    return None
+
+
+class SortedConstants(object):
+    """Keys sorted by an associated constant, allowing to retrieve the keys
+    whose constants are below or above a value by bisection.
+    """
+    __slots__ = ('constants', 'keys')
+
+    def __init__(self):
+        self.constants = []
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, constant, key):
+        pos = bisect_right(self.constants, constant)
+        self.constants.insert(pos, constant)
+        self.keys.insert(pos, key)
+
+    def remove(self, constant, key):
+        start = bisect_left(self.constants, constant)
+        end = bisect_right(self.constants, constant)
+        pos = self.keys.index(key, start, end)
+        del self.constants[pos]
+        del self.keys[pos]
+
+
+class RangeIndex(object):
+    """Index of order comparison atoms (``<``, ``<=``, ``>`` and ``>=``) over
+    a single field.
+
+    Atoms are kept sorted by their constant, separately for each operator and
+    for numbers and strings, which can't be compared to each other.
+    """
+    __slots__ = ('bounds', 'size')
+
+    def __init__(self):
+        self.bounds = {}
+        """(order class, operator) -> SortedConstants"""
+
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, op, constant, key):
+        bound_key = (order_class(constant), op)
+        bounds = self.bounds.get(bound_key)
+        if bounds is None:
+            bounds = self.bounds[bound_key] = SortedConstants()
+        bounds.add(constant, key)
+        self.size += 1
+
+    def remove(self, op, constant, key):
+        bound_key = (order_class(constant), op)
+        bounds = self.bounds[bound_key]
+        bounds.remove(constant, key)
+        if len(bounds) == 0:
+            del self.bounds[bound_key]
+        self.size -= 1
+
+    def satisfied(self, value):
+        """Returns an iterable of the keys of the atoms satisfied by the
+        provided value."""
+        value_class = order_class(value)
+        if value_class is None:
+            return
+
+        bounds = self.bounds.get((value_class, '>='))
+        if bounds:
+            # constant <= value
+            for key in bounds.keys[:bisect_right(bounds.constants, value)]:
+                yield key
+
+        bounds = self.bounds.get((value_class, '>'))
+        if bounds:
+            # constant < value
+            for key in bounds.keys[:bisect_left(bounds.constants, value)]:
+                yield key
+
+        bounds = self.bounds.get((value_class, '<='))
+        if bounds:
+            # value <= constant
+            for key in bounds.keys[bisect_left(bounds.constants, value):]:
+                yield key
+
+        bounds = self.bounds.get((value_class, '<'))
+        if bounds:
+            # value < constant
+            for key in bounds.keys[bisect_right(bounds.constants, value):]:
+                yield key
+
+
+class IndexMatcher(Matcher):
+    """Indexes filters by one of the comparison atoms they require.
+
+    A filter which is a comparison atom (e.g. ``['==', 'owner', 15]`` or
+    ``['>=', 'severity_level', 3]``) or an ``and`` containing at least one is
+    indexed by the field of that atom.
+
+    * Equality atoms are stored in a hash index under their value, so when a
+      model arrives only the filters stored under the value the model actually
+      has are checked.
+
+    * Order comparison atoms are stored sorted by their constant, so the
+      filters whose atom is satisfied by the value of the model are found by
+      bisection.
+
+    Equality atoms are preferred, since they are usually more selective. The
+    rest of the filter is only evaluated for the candidates found in the
+    indices, and not at all if the filter consists only of the indexed atom.
+
+    Filters without required comparisons are checked against every model, like
+    :py:class:`ScanMatcher` does.
+    """
+    __slots__ = ('filters', 'unindexed', 'exact', 'keys_by_value',
+                 'ranges', 'getters', 'entry_by_key')
+
+    def __init__(self):
+        self.filters = {}
+        """Compiled filters by key."""
+
+        self.unindexed = set()
+        """Keys of the filters which must be checked against every model."""
+
+        self.exact = set()
+        """Keys of the filters which consist only of their indexed atom and
+        therefore do not need to be checked once found in the index."""
+
+        self.keys_by_value = {}
+        """For each field path with equality atoms, a MultiDict of keys by
+        value."""
+
+        self.ranges = {}
+        """For each field path with order comparison atoms, a RangeIndex."""
+
+        self.getters = {}
+        """Field getters by path, for each indexed field path."""
+
+        self.entry_by_key = {}
+        """The (op, path, value) atom each indexed filter is stored under."""
+
+    def choose_atom(self, atoms):
+        """Chooses which of the required atoms of a filter will be used to
+        index it."""
+        equalities = [atom for atom in atoms if atom[0] == '==']
+        if not equalities:
+            return atoms[0]
+
+        # Any of the equalities would do, but the less filters share a value
+        # the less filters have to be checked when it appears. Pick the one
+        # with the least populated bucket.
+        def bucket_size(atom):
+            op, path, value = atom
+            keys_by_value = self.keys_by_value.get(path)
+            if keys_by_value is None:
+                return 0
+            return len(keys_by_value.get_set(value))
+
+        return min(equalities, key=bucket_size)
+
+    def add(self, key, compiled):
+        self.filters[key] = compiled
+
+        atoms = required_atoms(compiled.filter)
+        if not atoms:
+            self.unindexed.add(key)
+            return
+
+        op, path, value = atom = self.choose_atom(atoms)
+        if op == '==':
+            keys_by_value = self.keys_by_value.get(path)
+            if keys_by_value is None:
+                keys_by_value = self.keys_by_value[path] = MultiDict()
+            keys_by_value.add(value, key)
+        else:
+            range_index = self.ranges.get(path)
+            if range_index is None:
+                range_index = self.ranges[path] = RangeIndex()
+            range_index.add(op, value, key)
+
+        if path not in self.getters:
+            self.getters[path] = compile_getter(path)
+        self.entry_by_key[key] = atom
+        if compiled.filter[0] in comparison_operators:
+            self.exact.add(key)
+
+    def remove(self, key):
+        del self.filters[key]
+        self.exact.discard(key)
+
+        entry = self.entry_by_key.pop(key, None)
+        if entry is None:
+            self.unindexed.remove(key)
+            return
+
+        op, path, value = entry
+        if op == '==':
+            keys_by_value = self.keys_by_value[path]
+            keys_by_value.remove(value, key)
+            if len(keys_by_value) == 0:
+                del self.keys_by_value[path]
+        else:
+            range_index = self.ranges[path]
+            range_index.remove(op, value, key)
+            if len(range_index) == 0:
+                del self.ranges[path]
+
+        if path not in self.keys_by_value and path not in self.ranges:
+            del self.getters[path]
+
+    def candidates(self, model):
+        """Returns an iterable of the keys of the filters which may match the
+        model."""
+        for path, getter in items(self.getters):
+            try:
+                value = getter(model)
+            except (KeyError, TypeError):
+                # Missing field
+                continue
+
+            keys_by_value = self.keys_by_value.get(path)
+            if keys_by_value:
+                try:
+                    keys = keys_by_value.get(value)
+                except TypeError:
+                    # Unhashable value, it can't be equal to any of the
+                    # indexed scalars.
+                    keys = None
+                if keys:
+                    for key in keys:
+                        yield key
+
+            range_index = self.ranges.get(path)
+            if range_index:
+                for key in range_index.satisfied(value):
+                    yield key
+
+        for key in self.unindexed:
+            yield key
+
+    def match(self, model):
+        filters = self.filters
+        exact = self.exact
+        return set(key
+                   for key in self.candidates(model)
+                   if key in exact or filters[key].matches(model))
+
+
+class CountingMatcher(Matcher):
+    """Matches arbitrary ``and``/``or``/``not`` filters counting satisfied
+    atoms, in the style of the k-index publish/subscribe matchers.
+
+    Each filter is normalized into a disjunction of conjunctions (see
+    :py:func:`snorky.services.datasync.filters.to_dnf`). Every distinct atom
+    is indexed once, in a hash index for equalities or in a
+    :py:class:`RangeIndex` for order comparisons, however many conjunctions
+    use it.
+
+    When a model arrives the atoms it satisfies are looked up in the indices
+    and, for each conjunction, the satisfied atoms it requires are counted. A
+    conjunction is satisfied when the count reaches the number of atoms it
+    requires and none of the atoms it negates is satisfied. Conjunctions made
+    only of negated atoms are satisfied unless one of those is.
+
+    Therefore the cost of a match is proportional to the number of satisfied
+    atoms and the conjunctions that use them rather than to the number of
+    filters. Filters which can't be normalized (because they compare with
+    lists or objects, or because their normal form would be too big) are
+    checked against every model, like :py:class:`ScanMatcher` does.
+    """
+    __slots__ = ('max_conjunctions', 'unindexed', 'atom_ids', 'atoms',
+                 'atom_refs', 'atom_ids_by_value', 'ranges', 'getters',
+                 'positive_postings', 'negative_postings', 'required_count',
+                 'key_by_conjunction', 'conjunctions_by_key',
+                 'negative_only', 'next_id')
+
+    def __init__(self, max_conjunctions=32):
+        self.max_conjunctions = max_conjunctions
+
+        self.unindexed = {}
+        """Compiled filters which must be checked against every model, by
+        key."""
+
+        self.atom_ids = {}
+        """Atom id by (op, path, value) atom."""
+        self.atoms = {}
+        """(op, path, value) atom by atom id."""
+        self.atom_refs = {}
+        """Number of literals referring each atom, by atom id."""
+
+        self.atom_ids_by_value = {}
+        """For each field path with equality atoms, atom ids by value."""
+        self.ranges = {}
+        """For each field path with order comparison atoms, a RangeIndex of
+        atom ids."""
+        self.getters = {}
+        """Field getter and number of atoms using it, by path."""
+
+        self.positive_postings = MultiDict()
+        """Conjunction ids requiring each atom, by atom id."""
+        self.negative_postings = MultiDict()
+        """Conjunction ids negating each atom, by atom id."""
+        self.required_count = {}
+        """Number of atoms required by each conjunction, by conjunction id."""
+        self.key_by_conjunction = {}
+        self.conjunctions_by_key = {}
+        self.negative_only = set()
+        """Conjunction ids which require no atom at all."""
+
+        self.next_id = 0
+
+    def generate_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def acquire_atom(self, atom):
+        """Returns the id of an atom, indexing it if it's new."""
+        atom_id = self.atom_ids.get(atom)
+        if atom_id is not None:
+            self.atom_refs[atom_id] += 1
+            return atom_id
+
+        atom_id = self.generate_id()
+        self.atom_ids[atom] = atom_id
+        self.atoms[atom_id] = atom
+        self.atom_refs[atom_id] = 1
+
+        op, path, value = atom
+        if op == '==':
+            self.atom_ids_by_value.setdefault(path, {})[value] = atom_id
+        else:
+            range_index = self.ranges.get(path)
+            if range_index is None:
+                range_index = self.ranges[path] = RangeIndex()
+            range_index.add(op, value, atom_id)
+
+        getter = self.getters.get(path)
+        if getter is None:
+            self.getters[path] = [compile_getter(path), 1]
+        else:
+            getter[1] += 1
+        return atom_id
+
+    def release_atom(self, atom_id):
+        """Drops a reference to an atom, removing it from the indices if it's
+        no longer used."""
+        self.atom_refs[atom_id] -= 1
+        if self.atom_refs[atom_id] > 0:
+            return
+
+        del self.atom_refs[atom_id]
+        atom = self.atoms.pop(atom_id)
+        del self.atom_ids[atom]
+
+        op, path, value = atom
+        if op == '==':
+            ids_by_value = self.atom_ids_by_value[path]
+            del ids_by_value[value]
+            if len(ids_by_value) == 0:
+                del self.atom_ids_by_value[path]
+        else:
+            range_index = self.ranges[path]
+            range_index.remove(op, value, atom_id)
+            if len(range_index) == 0:
+                del self.ranges[path]
+
+        getter = self.getters[path]
+        getter[1] -= 1
+        if getter[1] == 0:
+            del self.getters[path]
+
+    def add(self, key, compiled):
+        conjunctions = to_dnf(compiled.filter, self.max_conjunctions)
+        if conjunctions is None:
+            self.unindexed[key] = compiled
+            return
+
+        conjunction_ids = []
+        for conjunction in conjunctions:
+            conjunction_id = self.generate_id()
+            conjunction_ids.append(conjunction_id)
+            self.key_by_conjunction[conjunction_id] = key
+
+            required = 0
+            for negated, atom in conjunction:
+                atom_id = self.acquire_atom(atom)
+                if negated:
+                    self.negative_postings.add(atom_id, conjunction_id)
+                else:
+                    self.positive_postings.add(atom_id, conjunction_id)
+                    required += 1
+
+            self.required_count[conjunction_id] = required
+            if required == 0:
+                self.negative_only.add(conjunction_id)
+
+        self.conjunctions_by_key[key] = (conjunctions, conjunction_ids)
+
+    def remove(self, key):
+        if key in self.unindexed:
+            del self.unindexed[key]
+            return
+
+        conjunctions, conjunction_ids = self.conjunctions_by_key.pop(key)
+        for conjunction, conjunction_id in zip(conjunctions, conjunction_ids):
+            del self.key_by_conjunction[conjunction_id]
+            del self.required_count[conjunction_id]
+            self.negative_only.discard(conjunction_id)
+
+            for negated, atom in conjunction:
+                atom_id = self.atom_ids[atom]
+                if negated:
+                    self.negative_postings.remove(atom_id, conjunction_id)
+                else:
+                    self.positive_postings.remove(atom_id, conjunction_id)
+                self.release_atom(atom_id)
+
+    def satisfied_atoms(self, model):
+        """Returns an iterable of the ids of the atoms satisfied by the
+        model."""
+        for path, (getter, count) in items(self.getters):
+            try:
+                value = getter(model)
+            except (KeyError, TypeError):
+                # Missing field
+                continue
+
+            ids_by_value = self.atom_ids_by_value.get(path)
+            if ids_by_value:
+                try:
+                    atom_id = ids_by_value.get(value)
+                except TypeError:
+                    # Unhashable value, it can't be equal to any of the
+                    # indexed scalars.
+                    atom_id = None
+                if atom_id is not None:
+                    yield atom_id
+
+            range_index = self.ranges.get(path)
+            if range_index:
+                for atom_id in range_index.satisfied(value):
+                    yield atom_id
+
+    def match(self, model):
+        counts = {}
+        violated = set()
+        positive_postings = self.positive_postings
+        negative_postings = self.negative_postings
+
+        for atom_id in self.satisfied_atoms(model):
+            for conjunction_id in positive_postings.get(atom_id, ()):
+                counts[conjunction_id] = counts.get(conjunction_id, 0) + 1
+            violated.update(negative_postings.get(atom_id, ()))
+
+        required_count = self.required_count
+        key_by_conjunction = self.key_by_conjunction
+
+        matched = set(key_by_conjunction[conjunction_id]
+                      for conjunction_id, count in items(counts)
+                      if count == required_count[conjunction_id] and
+                      conjunction_id not in violated)
+        matched.update(key_by_conjunction[conjunction_id]
+                       for conjunction_id in self.negative_only
+                       if conjunction_id not in violated)
+        matched.update(key
+                       for key, compiled in items(self.unindexed)
+                       if compiled.matches(model))
+        return matched
+
+
+def filter_shape(filter):
+    """Classifies a filter by the matcher that suits it best:
+
+    * ``'equality'``: it requires an equality atom.
+    * ``'range'``: it requires order comparison atoms, but no equality.
+    * ``'compound'``: it requires no atom, but it can be normalized (see
+      :py:func:`snorky.services.datasync.filters.to_dnf`).
+    * ``'other'``: none of the above.
+    """
+    atoms = required_atoms(filter)
+    if any(atom[0] == '==' for atom in atoms):
+        return 'equality'
+    elif atoms:
+        return 'range'
+    elif to_dnf(filter) is not None:
+        return 'compound'
+    return 'other'
+
+
+class AdaptiveMatcher(Matcher):
+    """Chooses between :py:class:`ScanMatcher`, :py:class:`IndexMatcher` and
+    :py:class:`CountingMatcher` depending on the shapes of the registered
+    filters (see :py:func:`filter_shape`), and switches when they change:
+
+    * With less than ``scan_threshold`` filters, scanning is cheapest.
+    * If at least half the filters require an atom, they are indexed by it.
+    * Otherwise, if at least half of them can be normalized, atoms are
+      counted.
+    * Otherwise, filters are scanned.
+
+    The choice is reconsidered after a number of filters have been added or
+    removed proportional to the number of filters, so the matcher is rebuilt
+    at most once for every few changes.
+
+    The name of the matcher in use can be read from :py:attr:`strategy`.
+    """
+    __slots__ = ('filters', 'shapes', 'shape_counts', 'matcher', 'changes')
+
+    scan_threshold = 16
+
+    min_changes = 16
+    """Minimum number of changes between reconsiderations."""
+
+    def __init__(self):
+        self.filters = {}
+        """Compiled filters by key."""
+
+        self.shapes = {}
+        """Shape of each filter by key."""
+
+        self.shape_counts = {'equality': 0, 'range': 0, 'compound': 0,
+                             'other': 0}
+        """Number of filters of each shape."""
+
+        self.matcher = ScanMatcher()
+        """The matcher in use."""
+
+        self.changes = 0
+        """Filters added or removed since the choice was last
+        reconsidered."""
+
+    @property
+    def strategy(self):
+        """Name of the class of the matcher in use."""
+        return type(self.matcher).__name__
+
+    def choose_matcher_class(self):
+        """Returns the matcher class best suited for the current filters."""
+        counts = self.shape_counts
+        total = len(self.filters)
+        if total < self.scan_threshold:
+            return ScanMatcher
+
+        indexed = counts['equality'] + counts['range']
+        if indexed * 2 >= total:
+            return IndexMatcher
+        elif (indexed + counts['compound']) * 2 >= total:
+            return CountingMatcher
+        return ScanMatcher
+
+    def adapt(self):
+        """Reconsiders the choice of matcher, rebuilding it if it changes."""
+        self.changes = 0
+        matcher_class = self.choose_matcher_class()
+        if type(self.matcher) is matcher_class:
+            return
+
+        snorky_log.info("Switching from %s to %s for %d filters (%s)",
+                        self.strategy, matcher_class.__name__,
+                        len(self.filters),
+                        ", ".join("%s: %d" % shape_count
+                                  for shape_count in
+                                  sorted(items(self.shape_counts))))
+        matcher = matcher_class()
+        for key, compiled in items(self.filters):
+            matcher.add(key, compiled)
+        self.matcher = matcher
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= max(self.min_changes, len(self.filters) // 4):
+            self.adapt()
+
+    def add(self, key, compiled):
+        shape = filter_shape(compiled.filter)
+        self.filters[key] = compiled
+        self.shapes[key] = shape
+        self.shape_counts[shape] += 1
+        self.matcher.add(key, compiled)
+        self.changed()
+
+    def remove(self, key):
+        del self.filters[key]
+        self.shape_counts[self.shapes.pop(key)] -= 1
+        self.matcher.remove(key)
+        self.changed()
+
+    def match(self, model):
+        return self.matcher.match(model)
+
+    def match_many(self, models):
+        return self.matcher.match_many(models)
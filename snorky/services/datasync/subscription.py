@@ -37,14 +37,18 @@ class Subscription(object):
     * Stale: Time has passed since the Subscription was created but no Client
       has acquired it. Subscriptions in this state will be removed by the
       system in order to free memory.
+
+    If ``patch`` is true deltas are delivered in the patch format, see
+    :py:meth:`snorky.services.datasync.DataSyncService.acquireSubscription`.
     """
 
     __slots__ = ('token', 'client', '_awaited_client_buffer',
-            '_awaited_client_timeout', 'items', 'service')
+            '_awaited_client_timeout', 'items', 'service', 'patch')
 
     def __init__(self, items, service):
         self.token = None
         self.client = None
+        self.patch = False
         self._awaited_client_buffer = []
         self._awaited_client_timeout = None
 
@@ -53,14 +57,16 @@ class Subscription(object):
         for item in items:
             item.subscription = self
 
-    def got_client(self, client):
-        """Links this subscription with a client. If there were deltas received
+    def got_client(self, client, patch=False):
+        """Links this subscription with a client, which will receive deltas in
+        the patch format if ``patch`` is true. If there were deltas received
         before, they will be sent now."""
 
         if self.client is not None:
             raise RuntimeError("Subscription already linked to a Client")
 
         self.client = client
+        self.patch = patch
         self.cancel_timeout()
         self.flush_awaited_client_buffer()
 
@@ -77,7 +83,7 @@ class Subscription(object):
         be sent when a client arrives."""
 
         if self.client is not None:
-            self.service.deliver_delta(self.client, delta)
+            self.service.deliver_delta(self.client, delta, patch=self.patch)
         else:
             self._awaited_client_buffer.append(delta)
 
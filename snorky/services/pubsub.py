@@ -19,12 +19,11 @@ class PubSubService(RPCService):
 
     def do_publish(self, channel, message):
         """Common code for publishing a message."""
-        for client in self.subscriptions.get_set(channel):
-            self.send_message_to(client, {
-                "type": "message",
-                "channel": channel,
-                "message": message
-            })
+        self.send_message_to_many(self.subscriptions.get_set(channel), {
+            "type": "message",
+            "channel": channel,
+            "message": message
+        })
 
     @rpc_command
     def publish(self, req, channel, message):
@@ -0,0 +1,207 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import Mock
+from snorky.services.datasync.dealers import AggregateDealer, BadQuery
+from snorky.services.datasync.delta import \
+        InsertionDelta, UpdateDelta, DeletionDelta, AggregateDelta
+
+
+class FakeSubscription(object):
+    def __init__(self):
+        self.deliver_delta = Mock()
+
+
+class FakeSubscriptionItem(object):
+    def __init__(self, query):
+        self.subscription = FakeSubscription()
+        self.query = query
+
+
+class MessageStats(AggregateDealer):
+    name = 'MessageStats'
+    model = 'Message'
+
+
+def message(id, folder, size, read=False):
+    return {'id': id, 'folder': folder, 'size': size, 'read': read}
+
+
+class TestAggregateDealer(unittest.TestCase):
+    def setUp(self):
+        self.dealer = MessageStats()
+
+    def subscribe(self, query):
+        item = FakeSubscriptionItem(query)
+        self.dealer.add_subscription_item(item)
+        return item
+
+    def deliver(self, item, delta):
+        item.subscription.deliver_delta.reset_mock()
+        self.dealer.deliver_delta(delta)
+        return [args[0][0] for args in
+                item.subscription.deliver_delta.call_args_list]
+
+    def aggregate(self, label, group, value):
+        return AggregateDelta('Message', 'MessageStats', label, group, value)
+
+    def test_count(self):
+        item = self.subscribe({
+            'function': 'count',
+            'filter': ['==', 'read', False],
+            'label': 'unread',
+            'rows': [message(1, 'inbox', 10), message(2, 'inbox', 20, True)],
+        })
+
+        self.assertEqual(
+            self.deliver(item, InsertionDelta('Message',
+                                              message(3, 'inbox', 5))),
+            [self.aggregate('unread', None, 2)])
+
+        # Does not change the count
+        self.assertEqual(
+            self.deliver(item, UpdateDelta('Message',
+                                           message(3, 'spam', 5),
+                                           message(3, 'inbox', 5))),
+            [])
+        self.assertEqual(
+            self.deliver(item, InsertionDelta('Message',
+                                              message(4, 'inbox', 5, True))),
+            [])
+
+        self.assertEqual(
+            self.deliver(item, UpdateDelta('Message',
+                                           message(1, 'inbox', 10, True),
+                                           message(1, 'inbox', 10))),
+            [self.aggregate('unread', None, 1)])
+        self.assertEqual(
+            self.deliver(item, DeletionDelta('Message',
+                                             message(3, 'spam', 5))),
+            [self.aggregate('unread', None, 0)])
+
+    def test_grouped_sum(self):
+        item = self.subscribe({
+            'function': 'sum',
+            'field': 'size',
+            'groupBy': 'folder',
+        })
+
+        self.assertEqual(
+            self.deliver(item, InsertionDelta('Message',
+                                              message(1, 'inbox', 10))),
+            [self.aggregate(None, 'inbox', 10)])
+        self.assertEqual(
+            self.deliver(item, InsertionDelta('Message',
+                                              message(2, 'inbox', 5))),
+            [self.aggregate(None, 'inbox', 15)])
+
+        # Moving a message changes two groups
+        self.assertEqual(
+            self.deliver(item, UpdateDelta('Message',
+                                           message(2, 'spam', 5),
+                                           message(2, 'inbox', 5))),
+            [self.aggregate(None, 'inbox', 10),
+             self.aggregate(None, 'spam', 5)])
+
+    def test_float_sum(self):
+        item = self.subscribe({
+            'function': 'sum',
+            'field': 'size',
+            'rows': [message(1, 'inbox', 0.1), message(2, 'inbox', 0.2)],
+        })
+
+        # 0.1 + 0.2 - 0.1 != 0.2 with floats
+        self.assertEqual(
+            self.deliver(item, DeletionDelta('Message',
+                                             message(1, 'inbox', 0.1))),
+            [self.aggregate(None, None, 0.2)])
+
+        # Back to an integer once the floats are gone
+        self.dealer.deliver_delta(
+            InsertionDelta('Message', message(3, 'inbox', 3)))
+        self.assertEqual(
+            self.deliver(item, DeletionDelta('Message',
+                                             message(2, 'inbox', 0.2))),
+            [self.aggregate(None, None, 3)])
+        value = item.subscription.deliver_delta.call_args[0][0].value
+        self.assertIs(type(value), int)
+
+        # Not finite
+        self.assertEqual(
+            self.deliver(item, InsertionDelta('Message',
+                                              message(4, 'inbox',
+                                                      float('inf')))),
+            [])
+
+    def test_min_max(self):
+        item_min = self.subscribe({'function': 'min', 'field': 'size',
+                                   'label': 'min'})
+        item_max = self.subscribe({'function': 'max', 'field': 'size',
+                                   'label': 'max'})
+
+        for id, size in [(1, 10), (2, 30), (3, 20)]:
+            self.dealer.deliver_delta(
+                InsertionDelta('Message', message(id, 'inbox', size)))
+
+        item_min.subscription.deliver_delta.reset_mock()
+
+        # The maximum is removed, the next one takes its place
+        delta = DeletionDelta('Message', message(2, 'inbox', 30))
+        self.assertEqual(self.deliver(item_max, delta),
+                         [self.aggregate('max', None, 20)])
+        item_min.subscription.deliver_delta.assert_not_called()
+
+        delta = DeletionDelta('Message', message(1, 'inbox', 10))
+        self.assertEqual(self.deliver(item_min, delta),
+                         [self.aggregate('min', None, 20)])
+
+        delta = DeletionDelta('Message', message(3, 'inbox', 20))
+        self.assertEqual(self.deliver(item_min, delta),
+                         [self.aggregate('min', None, None)])
+
+    def test_shared_aggregate(self):
+        item1 = self.subscribe({'function': 'count', 'label': 'a'})
+        item2 = self.subscribe({'function': 'count', 'label': 'b'})
+        self.assertEqual(len(self.dealer.aggregates), 1)
+
+        self.dealer.deliver_delta(
+            InsertionDelta('Message', message(1, 'inbox', 10)))
+        item1.subscription.deliver_delta.assert_called_once_with(
+            self.aggregate('a', None, 1))
+        item2.subscription.deliver_delta.assert_called_once_with(
+            self.aggregate('b', None, 1))
+
+        self.dealer.remove_subscription_item(item1)
+        self.dealer.remove_subscription_item(item2)
+        self.assertEqual(self.dealer.aggregates, {})
+
+    def test_bad_query(self):
+        for query in [
+            None,
+            {},
+            {'function': 'avg', 'field': 'size'},
+            {'function': 'sum'},
+            {'function': 'count', 'groupBy': 1},
+            {'function': 'count', 'filter': ['~', 'read', 1]},
+            {'function': 'count', 'label': 1},
+            {'function': 'count', 'rows': {}},
+        ]:
+            with self.assertRaises(BadQuery):
+                self.subscribe(query)
+        self.assertEqual(self.dealer.aggregates, {})
+
+    def test_for_json(self):
+        self.assertEqual(self.aggregate('unread', 'inbox', 3).for_json(), {
+            'type': 'aggregate',
+            'model': 'Message',
+            'dealer': 'MessageStats',
+            'label': 'unread',
+            'group': 'inbox',
+            'value': 3,
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import unittest
+from mock import Mock
+from snorky.services.datasync.dealers import BoundingBoxDealer, BadQuery
+from snorky.services.datasync.delta import \
+        InsertionDelta, UpdateDelta, DeletionDelta
+
+
+class FakeSubscription(object):
+    def __init__(self):
+        self.deliver_delta = Mock()
+
+
+class FakeSubscriptionItem(object):
+    def __init__(self, query):
+        self.subscription = FakeSubscription()
+        self.query = query
+
+
+class VehiclesInArea(BoundingBoxDealer):
+    model = 'Vehicle'
+    x_field = 'position.lon'
+    y_field = 'position.lat'
+    cell_size = 10
+    max_cells = 16
+
+
+def vehicle(id, lon, lat):
+    return {'id': id, 'position': {'lon': lon, 'lat': lat}}
+
+
+class TestBoundingBoxDealer(unittest.TestCase):
+    def setUp(self):
+        self.dealer = VehiclesInArea()
+        self.item1 = FakeSubscriptionItem([0, 0, 15, 15])
+        self.item2 = FakeSubscriptionItem([-5, -5, 5, 5])
+        self.item3 = FakeSubscriptionItem([-100, -100, 100, 100])
+        for item in (self.item1, self.item2, self.item3):
+            self.dealer.add_subscription_item(item)
+
+    def matches(self, lon, lat):
+        return self.dealer.get_subscription_items_for_model(
+            vehicle(1, lon, lat))
+
+    def test_items(self):
+        self.assertEqual(self.dealer.large_boxes, {(-100, -100, 100, 100)})
+
+        self.assertEqual(self.matches(1, 1),
+                         {self.item1, self.item2, self.item3})
+        self.assertEqual(self.matches(10, 12), {self.item1, self.item3})
+        self.assertEqual(self.matches(-1, 3), {self.item2, self.item3})
+        self.assertEqual(self.matches(200, 3), set())
+
+        # Half-open boxes
+        self.assertEqual(self.matches(15, 0), {self.item3})
+        self.assertEqual(self.matches(0, 0),
+                         {self.item1, self.item2, self.item3})
+
+        # Not a position
+        self.assertEqual(self.matches('1', 1), set())
+        self.assertEqual(self.matches(float('nan'), 1), set())
+        self.assertEqual(self.matches(10 ** 400, 1), set())
+        self.assertEqual(self.matches(1j, 1), set())
+        self.assertEqual(self.dealer.get_subscription_items_for_model({}),
+                         set())
+
+    def test_remove(self):
+        for item in (self.item1, self.item2, self.item3):
+            self.dealer.remove_subscription_item(item)
+        self.assertEqual(self.dealer.items_by_box, {})
+        self.assertEqual(self.dealer.boxes_by_cell, {})
+        self.assertEqual(self.dealer.large_boxes, set())
+
+    def test_equivalent_to_scan(self):
+        rand = random.Random(7)
+        dealer = VehiclesInArea()
+        boxes = []
+        for i in range(50):
+            x, y = rand.uniform(-50, 50), rand.uniform(-50, 50)
+            box = [x, y, x + rand.uniform(0, 60), y + rand.uniform(0, 60)]
+            item = FakeSubscriptionItem(box)
+            dealer.add_subscription_item(item)
+            boxes.append(item)
+
+        for i in range(200):
+            lon, lat = rand.uniform(-60, 60), rand.uniform(-60, 60)
+            expected = set(item for item in boxes
+                           if item.query[0] <= lon < item.query[2] and
+                              item.query[1] <= lat < item.query[3])
+            self.assertEqual(dealer.get_subscription_items_for_model(
+                vehicle(1, lon, lat)), expected)
+
+    def test_move(self):
+        delta = UpdateDelta('Vehicle', vehicle(1, 12, 12), vehicle(1, 1, 1))
+        self.dealer.deliver_delta(delta)
+
+        self.item1.subscription.deliver_delta.assert_called_once_with(delta)
+        self.item2.subscription.deliver_delta.assert_called_once_with(
+            DeletionDelta('Vehicle', vehicle(1, 1, 1)))
+        self.item3.subscription.deliver_delta.assert_called_once_with(delta)
+
+    def test_dependent_fields(self):
+        self.assertEqual(set(self.dealer.get_dependent_fields()),
+                         {'position'})
+
+    def test_bad_query(self):
+        for query in [
+            None,
+            [0, 0, 1],
+            [0, 0, 1, '1'],
+            [0, 0, 1, True],
+            [0, 0, 1, float('inf')],
+            [0, 0, 1, 10 ** 400],
+            [1, 0, 0, 1],
+        ]:
+            with self.assertRaises(BadQuery):
+                self.dealer.add_subscription_item(FakeSubscriptionItem(query))
+        self.assertEqual(len(self.dealer.items_by_box), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -56,7 +56,7 @@ class TestChat(RPCTestMixin, unittest.TestCase):
 
         for call_object in client.send.call_args_list:
             args = call_object[0]
-            presence = args[0]["message"]
+            presence = args[0].decode()["message"]
             self.assertEqual(presence["type"], "presence")
             presences_received.add((
                 presence["from"],
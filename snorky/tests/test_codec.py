@@ -0,0 +1,164 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import unittest
+from snorky.codec import EncodedMessage, \
+        JSONCodec, MsgpackCodec, CBORCodec, codec_classes, get_codec, \
+        get_subprotocol_codec, default_codec
+from snorky.hashable import HashableDict, HashableList
+
+
+class FakeBinaryCodec(JSONCodec):
+    name = 'fake'
+    binary = True
+
+    def dumps(self, obj):
+        return super(FakeBinaryCodec, self).dumps(obj).encode("UTF-8")
+
+
+class TestEncodedMessage(unittest.TestCase):
+    def test_equality(self):
+        message = EncodedMessage({"a": [1, 2]})
+        self.assertEqual(message, {"a": [1, 2]})
+        self.assertEqual({"a": [1, 2]}, message)
+        self.assertEqual(message, EncodedMessage({"a": [1, 2]}))
+        self.assertNotEqual(message, {"a": [1]})
+
+    def test_encode_with(self):
+        message = EncodedMessage({"a": [1, 2]})
+        text = message.encode_with(JSONCodec())
+        self.assertEqual(json.loads(text), {"a": [1, 2]})
+        self.assertIs(message.encode_with(JSONCodec()), text)
+
+        codec = FakeBinaryCodec()
+        data = message.encode_with(codec)
+        self.assertEqual(codec.loads(data), {"a": [1, 2]})
+        self.assertIs(message.encode_with(FakeBinaryCodec()), data)
+
+    def test_encode_with_each_codec(self):
+        class CompactJSONCodec(JSONCodec):
+            def dumps(self, obj):
+                return json.dumps(obj, separators=(",", ":"))
+
+        message = EncodedMessage({"a": [1, 2]})
+        self.assertEqual(message.encode_with(JSONCodec()), '{"a": [1, 2]}')
+        self.assertEqual(message.encode_with(CompactJSONCodec()),
+                         '{"a":[1,2]}')
+
+
+class TestCodecs(unittest.TestCase):
+    message = {
+        "service": "datasync",
+        "message": {"type": "delta", "delta": {
+            "type": "update", "model": "Player", "newData": {
+                "id": 1, "name": u"J\u00falia \U0001f3b2", "score": 1.5,
+                "tags": ["a", "b"], "active": True, "team": None,
+            },
+        }},
+    }
+
+    def codecs(self):
+        return [cls() for cls in codec_classes if cls.available]
+
+    def test_round_trip(self):
+        for codec in self.codecs():
+            text = codec.dumps(self.message)
+            self.assertIsInstance(text, type(u""))
+            self.assertEqual(json.loads(text), self.message)
+            self.assertEqual(codec.loads(text), self.message)
+            self.assertEqual(codec.loads(text.encode("UTF-8")), self.message)
+
+    def test_invalid_json(self):
+        for codec in self.codecs():
+            for text in ['{"service": "echo', b'\xff', '']:
+                with self.assertRaises(ValueError):
+                    codec.loads(text)
+
+    def test_unusual_values(self):
+        # Not supported by every library, but by the standard json module
+        for codec in self.codecs():
+            self.assertEqual(json.loads(codec.dumps({1: 2 ** 70})),
+                             {"1": 2 ** 70})
+            self.assertEqual(codec.loads("[%d]" % 2 ** 70), [2 ** 70])
+
+    def test_join(self):
+        for codec in self.codecs():
+            messages = [self.message, [], "a"]
+            text = codec.join([codec.dumps(message) for message in messages])
+            self.assertEqual(json.loads(text), messages)
+            self.assertEqual(json.loads(codec.join([])), [])
+
+    def test_get_codec(self):
+        self.assertIsInstance(get_codec("json"), JSONCodec)
+        self.assertTrue(get_codec().available)
+        self.assertEqual(type(default_codec), type(get_codec()))
+
+        with self.assertRaises(ValueError):
+            get_codec("yaml")
+
+        for cls in codec_classes:
+            if not cls.available:
+                with self.assertRaises(ValueError):
+                    get_codec(cls.name)
+
+
+class BinaryCodecTests(object):
+    codec_class = None
+    message = TestCodecs.message
+
+    def setUp(self):
+        if not self.codec_class.available:
+            self.skipTest("%s is not installed" % self.codec_class.name)
+        self.codec = self.codec_class()
+
+    def test_round_trip(self):
+        data = self.codec.dumps(self.message)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(self.codec.loads(data), self.message)
+
+    def test_hashable(self):
+        decoded = self.codec.loads_hashable(self.codec.dumps(self.message))
+        self.assertEqual(decoded, self.message)
+        self.assertIsInstance(decoded, HashableDict)
+        self.assertIsInstance(
+            decoded["message"]["delta"]["newData"]["tags"], HashableList)
+        hash(decoded)
+
+    def test_invalid(self):
+        for data in [b"", b"\xc1", u"text", self.codec.dumps([1, 2])[:-1]]:
+            with self.assertRaises(ValueError):
+                self.codec.loads(data)
+
+    def test_join(self):
+        for length in [0, 1, 15, 16, 23, 24, 255, 256, 0x10000]:
+            messages = [{"n": i} for i in range(length)]
+            data = self.codec.join([self.codec.dumps(message)
+                                    for message in messages])
+            self.assertEqual(self.codec.loads(data), messages)
+
+    def test_subprotocol(self):
+        self.assertIsInstance(
+            get_subprotocol_codec(self.codec_class.subprotocol),
+            self.codec_class)
+        self.assertIsInstance(get_codec(self.codec_class.name),
+                              self.codec_class)
+
+
+class TestMsgpackCodec(BinaryCodecTests, unittest.TestCase):
+    codec_class = MsgpackCodec
+
+
+class TestCBORCodec(BinaryCodecTests, unittest.TestCase):
+    codec_class = CBORCodec
+
+
+class TestSubprotocols(unittest.TestCase):
+    def test_not_binary(self):
+        self.assertIsNone(get_subprotocol_codec("snorky.json"))
+        self.assertIsNone(get_subprotocol_codec("snorky.yaml"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from mock import Mock
+from mock import Mock, patch
 from unittest import TestCase
 from snorky.tests.utils.rpc import RPCTestMixin
 from snorky.tests.utils.timeout import TestTimeoutFactory
@@ -10,8 +10,9 @@ import unittest
 
 from snorky.services.datasync.frontend import DataSyncService
 from snorky.services.datasync.backend import DataSyncBackend
-from snorky.services.datasync.dealers import SimpleDealer
+from snorky.services.datasync.dealers import SimpleDealer, MultiKeyDealer
 from snorky.types import is_string
+from snorky.codec import EncodedMessage, JSONCodec
 
 
 class FakeClient(object):
@@ -19,6 +20,24 @@ class FakeClient(object):
         self.send = Mock()
 
 
+class BinaryClient(object):
+    """A client encoding the messages it receives with a binary codec."""
+    def __init__(self, codec):
+        self.codec = codec
+        self.frames = []
+
+    def send(self, msg):
+        self.frames.append(msg.encode_with(self.codec))
+
+
+class FakeBinaryCodec(JSONCodec):
+    name = 'fake-binary'
+    binary = True
+
+    def dumps(self, obj):
+        return super(FakeBinaryCodec, self).dumps(obj).encode("UTF-8")
+
+
 class TestDealer(SimpleDealer):
     name = "players_with_color"
     model = "Player"
@@ -27,6 +46,21 @@ class TestDealer(SimpleDealer):
         return model["color"]
 
 
+class TestMultiKeyDealer(MultiKeyDealer):
+    name = "players_with_colors"
+    model = "Player"
+
+    def get_key_for_model(self, model):
+        return model["color"]
+
+
+class BrokenDealer(TestMultiKeyDealer):
+    name = "broken"
+
+    def add_subscription_item(self, item):
+        raise RuntimeError("broken")
+
+
 class TestDataSync(RPCTestMixin, TestCase):
     def setUp(self):
         self.time_man = TestTimeoutFactory()
@@ -123,6 +157,44 @@ class TestDataSync(RPCTestMixin, TestCase):
                                   }])
         self.assertEqual(msg, "No such dealer")
 
+    def test_authorize_subscription_bad_query(self):
+        multi_key_dealer = TestMultiKeyDealer()
+        self.frontend.register_dealer(multi_key_dealer)
+
+        msg = self.rpcExpectError(self.backend, None,
+                                  "authorizeSubscription", items=[{
+                                      "dealer": "players_with_color",
+                                      "query": "red",
+                                  }, {
+                                      "dealer": "players_with_colors",
+                                      "query": "red",
+                                  }])
+        self.assertEqual(msg, "Bad query")
+
+        # Nothing is left behind
+        self.assertEqual(self.sm.subscriptions_by_token, {})
+        self.assertEqual(self.time_man.timeouts_pending, 0)
+        self.assertEqual(len(self.dealer.items_by_model_key), 0)
+        self.assertEqual(multi_key_dealer.keys_by_item, {})
+
+    def test_authorize_subscription_dealer_error(self):
+        self.frontend.register_dealer(BrokenDealer())
+
+        with self.assertRaises(RuntimeError):
+            self.rpcCall(self.backend, None,
+                         "authorizeSubscription", items=[{
+                             "dealer": "players_with_color",
+                             "query": "red",
+                         }, {
+                             "dealer": "broken",
+                             "query": "red",
+                         }])
+
+        # Nothing is left behind
+        self.assertEqual(self.sm.subscriptions_by_token, {})
+        self.assertEqual(self.time_man.timeouts_pending, 0)
+        self.assertEqual(len(self.dealer.items_by_model_key), 0)
+
     def test_acquire_subscription(self):
         self.test_authorize_subscription()
 
@@ -156,6 +228,116 @@ class TestDataSync(RPCTestMixin, TestCase):
         # Test client must have received the delta
         self.assert_test_delta("red")
 
+    def test_delta_encoded_once(self):
+        self.test_acquire_subscription()
+        other_client = FakeClient()
+        token = self.rpcCall(self.backend, None,
+                "authorizeSubscription", items=[{
+                    "dealer": "players_with_color",
+                    "query": "red"
+                }])
+        self.rpcCall(self.frontend, other_client,
+                     "acquireSubscription", token=token)
+
+        codec = self.client.codec = other_client.codec = JSONCodec()
+        with patch.object(JSONCodec, "dumps", autospec=True,
+                          side_effect=JSONCodec.dumps) as dumps_mock:
+            self.send_test_delta("red")
+            for client in (self.client, other_client):
+                client.send.call_args[0][0].encode_with(codec)
+        self.assertEqual(dumps_mock.call_count, 1)
+
+        # Both clients share the message and its encodings
+        message = other_client.send.call_args[0][0]
+        self.assertIsInstance(message, EncodedMessage)
+        self.assertIs(message, self.client.send.call_args[0][0])
+        self.assert_test_delta("red")
+
+    def test_delta_binary_encoded_once(self):
+        codec = FakeBinaryCodec()
+        clients = [BinaryClient(codec) for i in range(5)]
+        for client in clients:
+            token = self.rpcCall(self.backend, None,
+                    "authorizeSubscription", items=[{
+                        "dealer": "players_with_color",
+                        "query": "red"
+                    }])
+            self.rpcCall(self.frontend, client,
+                         "acquireSubscription", token=token)
+
+        with patch.object(codec, "dumps", wraps=codec.dumps) as dumps_mock:
+            self.send_test_delta("red")
+        self.assertEqual(dumps_mock.call_count, 1)
+        self.assertEqual(len(set(client.frames[0] for client in clients)), 1)
+
+    def test_delta_patch(self):
+        self.test_authorize_subscription()
+        self.rpcCall(self.frontend, self.client, "acquireSubscription",
+                     token=self.token, patch=True)
+
+        self.rpcCall(self.backend, None, "publishDeltas", deltas=[{
+            "type": "update",
+            "model": "Player",
+            "newData": {"id": 1, "name": "Alice", "color": "red"},
+            "oldData": {"id": 1, "name": "Ali", "color": "red"},
+        }, {
+            "type": "delete",
+            "model": "Player",
+            "data": {"id": 1, "name": "Alice", "color": "red"},
+        }])
+
+        self.assertEqual([args[0][0].decode()["message"]["delta"] for args
+                          in self.client.send.call_args_list], [{
+            "type": "update",
+            "model": "Player",
+            "key": 1,
+            "changes": {"name": "Alice"},
+        }, {
+            "type": "delete",
+            "model": "Player",
+            "key": 1,
+        }])
+
+    def test_delta_patch_primary_key(self):
+        self.frontend.primary_keys["Player"] = "name"
+        self.test_authorize_subscription()
+        self.rpcCall(self.frontend, self.client, "acquireSubscription",
+                     token=self.token, patch=True)
+
+        # Insertions are never patches
+        self.send_test_delta("red")
+        self.assert_test_delta("red")
+
+        self.rpcCall(self.backend, None, "publishDeltas", deltas=[{
+            "type": "delete",
+            "model": "Player",
+            "data": {"name": "Alice", "color": "red"},
+        }])
+        message = self.client.send.call_args[0][0].decode()
+        self.assertEqual(message["message"]["delta"],
+                         {"type": "delete", "model": "Player",
+                          "key": "Alice"})
+
+    def test_acquire_subscription_twice_keeps_format(self):
+        self.test_acquire_subscription()
+
+        request = self._rpcCallNoAsserts(self.frontend, FakeClient(),
+                                         "acquireSubscription",
+                                         request_debug=False,
+                                         token=self.token, patch=True)
+        self.assertEqual(request.response_type, "error")
+        self.assertFalse(self.subscription.patch)
+
+        self.send_test_delta("red")
+        self.assert_test_delta("red")
+
+    def test_acquire_subscription_invalid_patch(self):
+        self.test_authorize_subscription()
+        msg = self.rpcExpectError(self.frontend, self.client,
+                                  "acquireSubscription", token=self.token,
+                                  patch="yes")
+        self.assertEqual(msg, "patch must be boolean")
+
     def test_delta_other(self):
         self.test_acquire_subscription()
 
@@ -3,10 +3,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import unittest
-from mock import Mock
+from mock import Mock, call
 from snorky.services.datasync.managers.dealer import \
         DealerManager, UnknownModelClass, UnknownDealer
 from snorky.services.datasync.subscription import SubscriptionItem
+from snorky.services.datasync.dealers import SimpleDealer
 from snorky.services.datasync.delta import \
         InsertionDelta, UpdateDelta, DeletionDelta
 
@@ -86,6 +87,91 @@ class TestDealerManager(unittest.TestCase):
         with self.assertRaises(UnknownModelClass):
             dm.deliver_delta(delta)
 
+    def test_deliver_deltas(self):
+        dm = DealerManager()
+        dm.register_dealer(self.dealer1)
+        dm.register_dealer(self.dealer2)
+
+        delivered = []
+        subscription = Mock()
+        subscription.deliver_delta.side_effect = \
+                lambda delta: delivered.append(delta)
+        item1 = SubscriptionItem('test_dealer1', None)
+        item1.subscription = subscription
+        item2 = SubscriptionItem('test_dealer2', None)
+        item2.subscription = subscription
+
+        self.dealer1.route_deltas = lambda deltas: \
+                [[(item1, ('dealer1', delta))] for delta in deltas]
+        self.dealer2.route_deltas = lambda deltas: \
+                [[(item2, ('dealer2', delta))] for delta in deltas]
+
+        delta1 = InsertionDelta('test_model', {'id': 1})
+        delta2 = DeletionDelta('test_model', {'id': 2})
+        dm.deliver_deltas([delta1, delta2])
+
+        # Deltas are delivered in order
+        dealer_names = [name for name, delta in delivered[:2]]
+        self.assertEqual(set(dealer_names), {'dealer1', 'dealer2'})
+        self.assertEqual([delta for name, delta in delivered],
+                         [delta1, delta1, delta2, delta2])
+
+    def test_deliver_deltas_overridden(self):
+        delivered = []
+
+        class LoggingDealer(SimpleDealer):
+            name = 'logging_dealer'
+            model = 'test_model'
+
+            def get_key_for_model(self, model):
+                return model['id']
+
+            def deliver_delta(self, delta):
+                delivered.append(delta)
+                super(LoggingDealer, self).deliver_delta(delta)
+
+        dm = DealerManager()
+        dealer = LoggingDealer()
+        dm.register_dealer(dealer)
+        dm.register_dealer(self.dealer1)
+        self.dealer1.route_deltas = lambda deltas: [[] for delta in deltas]
+
+        item = SubscriptionItem('logging_dealer', 1)
+        item.subscription = Mock()
+        dealer.add_subscription_item(item)
+
+        delta1 = InsertionDelta('test_model', {'id': 1})
+        delta2 = DeletionDelta('test_model', {'id': 2})
+        dm.deliver_deltas([delta1, delta2])
+
+        self.assertEqual(delivered, [delta1, delta2])
+        item.subscription.deliver_delta.assert_called_once_with(delta1)
+
+    def test_deliver_deltas_without_route_deltas(self):
+        dm = DealerManager()
+        dm.register_dealer(self.dealer1)
+        dm.register_dealer(self.dealer2)
+        self.dealer2.route_deltas = lambda deltas: [[] for delta in deltas]
+
+        delta1 = InsertionDelta('test_model', {'id': 1})
+        delta2 = DeletionDelta('test_model', {'id': 2})
+        dm.deliver_deltas([delta1, delta2])
+
+        # dealer1 is not a Dealer and has no route_deltas
+        self.assertEqual(self.dealer1.deliver_delta.call_args_list,
+                         [call(delta1), call(delta2)])
+        self.assertFalse(self.dealer2.deliver_delta.called)
+
+    def test_deliver_deltas_unknown_model_class(self):
+        dm = DealerManager()
+        dm.register_dealer(self.dealer1)
+        self.dealer1.route_deltas = Mock()
+
+        with self.assertRaises(UnknownModelClass):
+            dm.deliver_deltas([InsertionDelta('test_model', {'id': 1}),
+                               InsertionDelta('unknown_model', {'id': 1})])
+        self.assertFalse(self.dealer1.route_deltas.called)
+
     def test_connect_subscription(self):
         dm = DealerManager()
         dm.register_dealer(self.dealer1)
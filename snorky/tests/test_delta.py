@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from snorky.services.datasync.delta import \
+        InsertionDelta, UpdateDelta, DeletionDelta
+
+
+class TestPatchFormat(unittest.TestCase):
+    def test_update(self):
+        delta = UpdateDelta("Task",
+                            {"id": 1, "title": "b", "done": 1, "tags": ["x"],
+                             "owner": "alice"},
+                            {"id": 1, "title": "a", "done": True,
+                             "tags": ["x"], "list": 3})
+        self.assertEqual(delta.for_patch_json("id"), {
+            "type": "update",
+            "model": "Task",
+            "key": 1,
+            "changes": {"title": "b", "done": 1, "owner": "alice"},
+            "removed": ["list"],
+        })
+
+    def test_update_key_changed(self):
+        delta = UpdateDelta("Task", {"id": 2}, {"id": 1})
+        self.assertEqual(delta.for_patch_json("id"), {
+            "type": "update",
+            "model": "Task",
+            "key": 1,
+            "changes": {"id": 2},
+        })
+
+    def test_without_key(self):
+        self.assertIsNone(UpdateDelta("Task", {"id": 1}, {"title": "a"})
+                          .for_patch_json("id"))
+        self.assertIsNone(UpdateDelta("Task", "b", "a").for_patch_json("id"))
+        self.assertIsNone(DeletionDelta("Task", {"title": "a"})
+                          .for_patch_json("id"))
+
+        delta = DeletionDelta("Task", {"title": "a"})
+        self.assertEqual(delta.message("datasync", "id"),
+                         delta.message("datasync"))
+
+    def test_insertion(self):
+        delta = InsertionDelta("Task", {"id": 1})
+        self.assertIsNone(delta.for_patch_json("id"))
+        self.assertEqual(
+            delta.message("datasync", "id").decode()["message"]["delta"],
+            delta.for_json())
+
+    def test_message(self):
+        delta = DeletionDelta("Task", {"id": 1, "title": "a"})
+        message = delta.message("datasync")
+        self.assertEqual(message.decode(), {
+            "service": "datasync",
+            "message": {"type": "delta", "delta": delta.for_json()},
+        })
+        self.assertIs(delta.message("datasync"), message)
+
+        patch_message = delta.message("datasync", "id")
+        self.assertEqual(patch_message.decode()["message"]["delta"],
+                         {"type": "delete", "model": "Task", "key": 1})
+        self.assertIs(delta.message("datasync", "id"), patch_message)
+
+
+if __name__ == "__main__":
+    unittest.main()
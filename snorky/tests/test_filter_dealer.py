@@ -5,6 +5,7 @@
 import unittest
 from mock import Mock
 from snorky.services.datasync.dealers import FilterDealer, BadQuery
+from snorky.services.datasync.matchers import IndexMatcher
 from snorky.services.datasync.delta import \
         InsertionDelta, UpdateDelta, DeletionDelta
 
@@ -37,7 +38,13 @@ class MyDealer(FilterDealer):
         return model.prop
 
 
+class MyIndexedDealer(MyDealer):
+    matcher_class = IndexMatcher
+
+
 class TestSimpleDealer(unittest.TestCase):
+    dealer_class = MyDealer
+
     def setUp(self):
         self.model1 = { "color": "blue" }
         self.model2 = { "color": "red" }
@@ -46,12 +53,12 @@ class TestSimpleDealer(unittest.TestCase):
         self.item3 = FakeSubscriptionItem(['==', 'color', 'blue'])
 
     def test_name(self):
-        dealer = MyDealer()
+        dealer = self.dealer_class()
 
         self.assertEqual(dealer.name, 'test_dealer')
 
     def test_items(self):
-        dealer = MyDealer()
+        dealer = self.dealer_class()
 
         dealer.add_subscription_item(self.item1)
         dealer.add_subscription_item(self.item2)
@@ -71,11 +78,135 @@ class TestSimpleDealer(unittest.TestCase):
         self.assertEqual(len(items), 0)
 
     def test_bad_format(self):
-        dealer = MyDealer()
+        dealer = self.dealer_class()
 
         with self.assertRaises(BadQuery):
             dealer.add_subscription_item(FakeSubscriptionItem({"foo": "bar"}))
 
+        with self.assertRaises(BadQuery):
+            dealer.add_subscription_item(
+                FakeSubscriptionItem(['~=', 'color', 'blue']))
+
+    def test_shared_filters(self):
+        dealer = self.dealer_class()
+        item4 = FakeSubscriptionItem(['==', 'color', 'red'])
+
+        dealer.add_subscription_item(self.item1)
+        dealer.add_subscription_item(self.item2)
+        dealer.add_subscription_item(self.item3)
+        dealer.add_subscription_item(item4)
+        self.assertEqual(len(dealer.items_by_filter), 2)
+
+        items = dealer.get_subscription_items_for_model(self.model1)
+        self.assertEqual(items, {self.item1, self.item3})
+
+        dealer.remove_subscription_item(self.item1)
+        dealer.remove_subscription_item(self.item3)
+        self.assertEqual(len(dealer.items_by_filter), 1)
+        items = dealer.get_subscription_items_for_model(self.model1)
+        self.assertEqual(items, set())
+
+    def test_dependent_fields(self):
+        dealer = self.dealer_class()
+        item = FakeSubscriptionItem(['or', ['==', 'player.color', 'blue'],
+                                           ['>', 'age', 3]])
+        dealer.add_subscription_item(self.item1)
+        dealer.add_subscription_item(item)
+        self.assertEqual(set(dealer.get_dependent_fields()),
+                         {'color', 'player', 'age'})
+
+        dealer.remove_subscription_item(item)
+        self.assertEqual(set(dealer.get_dependent_fields()), {'color'})
+
+    def test_update_unrelated_field(self):
+        dealer = self.dealer_class()
+        dealer.add_subscription_item(self.item1)
+        dealer.add_subscription_item(self.item2)
+
+        delta = UpdateDelta('Player', new_data={"color": "red", "x": 2},
+                            old_data={"color": "red", "x": 1})
+        dealer.deliver_delta(delta)
+
+        self.assertFalse(self.item1.subscription.deliver_delta.called)
+        self.item2.subscription.deliver_delta.assert_called_once_with(delta)
+
+    def test_update(self):
+        dealer = self.dealer_class()
+        dealer.add_subscription_item(self.item1)
+        dealer.add_subscription_item(self.item2)
+
+        delta = UpdateDelta('Player', new_data={"color": "red"},
+                            old_data={"color": "blue"})
+        dealer.deliver_delta(delta)
+
+        self.item1.subscription.deliver_delta.assert_called_once_with(
+            DeletionDelta('Player', {"color": "blue"}))
+        self.item2.subscription.deliver_delta.assert_called_once_with(
+            InsertionDelta('Player', {"color": "red"}))
+
+
+    def test_route_deltas(self):
+        dealer = self.dealer_class()
+        dealer.add_subscription_item(self.item1)
+        dealer.add_subscription_item(self.item2)
+
+        insertion = InsertionDelta('Player', {"color": "blue"})
+        update = UpdateDelta('Player', {"color": "red"}, {"color": "blue"})
+        deletion = DeletionDelta('Player', {"color": "red"})
+
+        routes = dealer.route_deltas([insertion, update, deletion])
+        self.assertEqual(routes, [
+            [(self.item1, insertion)],
+            [(self.item2, InsertionDelta('Player', {"color": "red"})),
+             (self.item1, DeletionDelta('Player', {"color": "blue"}))],
+            [(self.item2, deletion)],
+        ])
+        self.assertEqual(dealer.route_delta(update), routes[1])
+
+
+class TestIndexedFilterDealer(TestSimpleDealer):
+    dealer_class = MyIndexedDealer
+
+
+class MyCachedDealer(MyDealer):
+    match_cache_size = 2
+
+
+class TestCachedFilterDealer(TestSimpleDealer):
+    dealer_class = MyCachedDealer
+
+    def test_cache(self):
+        dealer = self.dealer_class()
+        cache = dealer.match_cache
+        dealer.add_subscription_item(self.item1)
+
+        delta = InsertionDelta('Player', {"color": "blue", "x": 1})
+        dealer.deliver_delta(delta)
+        dealer.deliver_delta(InsertionDelta('Player', {"color": "blue"}))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(self.item1.subscription.deliver_delta.call_count, 2)
+
+        # Adding a subscription item invalidates the cache
+        dealer.add_subscription_item(self.item3)
+        dealer.deliver_delta(delta)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.item3.subscription.deliver_delta.assert_called_once_with(delta)
+
+        # Least recently used entries are discarded
+        dealer.deliver_delta(InsertionDelta('Player', {"color": "red"}))
+        dealer.deliver_delta(InsertionDelta('Player', {"color": "green"}))
+        dealer.deliver_delta(delta)
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+
+        # Unhashable values are not cached
+        dealer.deliver_delta(InsertionDelta('Player', {"color": ["blue"]}))
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+
+    def test_constructor_parameter(self):
+        self.assertIsNone(MyDealer().match_cache)
+        self.assertIsNotNone(MyDealer(match_cache_size=10).match_cache)
+        self.assertIsNone(MyCachedDealer(match_cache_size=0).match_cache)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -2,7 +2,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from snorky.services.datasync.dealers import filter_matches
+from snorky.services.datasync.filters import \
+        compile_filter, canonical_filter, to_dnf, filter_matches, BadQuery
 import unittest
 
 
@@ -89,6 +90,137 @@ class TestFilters(unittest.TestCase):
         self.assertFalse(filter_matches({'a': 'other', 'b': 'other'}, f))
         self.assertFalse(filter_matches({'a': 'bar', 'b': 'foo'}, f))
 
+    def test_nested_field(self):
+        f = ['==', 'player.color', 'blue']
+        self.assertTrue(filter_matches({'player': {'color': 'blue'}}, f))
+        self.assertFalse(filter_matches({'player': {'color': 'red'}}, f))
+        self.assertFalse(filter_matches({'color': 'blue'}, f))
+
+
+class TestCompiledFilters(unittest.TestCase):
+    filters = [
+        ['==', 'color', 'blue'],
+        ['==', 'a', 1],
+        ['<', 'age', 21],
+        ['<=', 'age', 21],
+        ['>', 'age', 21],
+        ['>=', 'age', 21],
+        ['not', ['==', 'color', 'blue']],
+        ['not', ['<', 'age', 21]],
+        ['and', ['>=', 'a', 3], ['<=', 'a', 7]],
+        ['and', ['==', 'a', 'foo'], ['==', 'b', 'bar']],
+        ['or', ['<', 'a', 3], ['>', 'a', 7]],
+        ['or', ['not', ['==', 'a', 'foo']], ['>=', 'b', 3]],
+        ['==', 'player.color', 'blue'],
+        ['and'],
+        ['or'],
+    ]
+
+    models = [
+        {},
+        {'color': 'blue'},
+        {'color': 'red'},
+        {'a': 1},
+        {'a': '1'},
+        {'a': 2},
+        {'a': 5},
+        {'a': 8},
+        {'a': 'foo', 'b': 'bar'},
+        {'a': 'foo', 'b': 4},
+        {'age': 20},
+        {'age': 21},
+        {'age': 22},
+        {'age': '20'},
+        {'age': None},
+        {'player': {'color': 'blue'}},
+        {'player': 'blue'},
+        {'player': None},
+    ]
+
+    def test_same_as_interpreted(self):
+        for f in self.filters:
+            predicate = compile_filter(f)
+            for model in self.models:
+                self.assertEqual(predicate(model), filter_matches(model, f),
+                                 "%r on %r" % (f, model))
+
+    def test_bad_filters(self):
+        bad_filters = [
+            [],
+            'color',
+            ['=', 'color', 'blue'],
+            ['==', 'color'],
+            ['==', 5, 'blue'],
+            ['not', ['==', 'a', 1], ['==', 'b', 2]],
+            ['and', ['==', 'a', 1], 'foo'],
+        ]
+        for f in bad_filters:
+            with self.assertRaises(BadQuery):
+                compile_filter(f)
+
+
+class TestDNF(unittest.TestCase):
+    def test_atom(self):
+        self.assertEqual(to_dnf(['==', 'a', 1]),
+                         [((False, ('==', ('a',), 1)),)])
+
+    def test_de_morgan(self):
+        dnf = to_dnf(['not', ['and', ['==', 'a', 1], ['<', 'b.c', 2]]])
+        self.assertEqual(sorted(dnf), [
+            ((True, ('<', ('b', 'c'), 2)),),
+            ((True, ('==', ('a',), 1)),),
+        ])
+
+    def test_distribution(self):
+        dnf = to_dnf(['and', ['or', ['==', 'a', 1], ['==', 'a', 2]],
+                             ['not', ['not', ['==', 'b', 3]]]])
+        self.assertEqual(sorted(set(c) for c in dnf), sorted([
+            {(False, ('==', ('a',), 1)), (False, ('==', ('b',), 3))},
+            {(False, ('==', ('a',), 2)), (False, ('==', ('b',), 3))},
+        ]))
+
+    def test_contradiction(self):
+        self.assertEqual(to_dnf(['and', ['==', 'a', 1],
+                                        ['not', ['==', 'a', 1]]]), [])
+
+    def test_not_indexable(self):
+        self.assertIsNone(to_dnf(['==', 'a', [1, 2]]))
+        self.assertIsNone(to_dnf(['<', 'a', None]))
+        self.assertIsNone(to_dnf(['and'] + [['or', ['==', 'a', 1],
+                                                   ['==', 'b', 1]]] * 6))
+
+
+class TestCanonicalFilter(unittest.TestCase):
+    def test_equivalent(self):
+        a = canonical_filter(['and', ['==', 'a', 1], ['>', 'b', 2]])
+        b = canonical_filter(['and', ['>', 'b', 2],
+                                     ['and', ['==', 'a', 1], ['>', 'b', 2]]])
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+
+    def test_single_operand(self):
+        self.assertEqual(canonical_filter(['or', ['==', 'a', 1]]),
+                         ('==', 'a', 1))
+
+    def test_different(self):
+        self.assertNotEqual(canonical_filter(['and', ['==', 'a', 1],
+                                                     ['==', 'b', 2]]),
+                            canonical_filter(['or', ['==', 'a', 1],
+                                                    ['==', 'b', 2]]))
+        self.assertNotEqual(canonical_filter(['==', 'a', 1]),
+                            canonical_filter(['==', 'a', '1']))
+
+    def test_unhashable_constant(self):
+        f = canonical_filter(['==', 'tags', ['a', 'b']])
+        hash(f)
+        self.assertTrue(compile_filter(f)({'tags': ['a', 'b']}))
+
+    def test_bad_filters(self):
+        with self.assertRaises(BadQuery):
+            canonical_filter(['and', ['==', 'a']])
+        with self.assertRaises(BadQuery):
+            canonical_filter(['xor', ['==', 'a', 1]])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import Mock
+from snorky.services.datasync.dealers import JoinDealer, BadQuery
+from snorky.services.datasync.managers.dealer import \
+        DealerManager, UnknownModelClass
+from snorky.services.datasync.delta import \
+        InsertionDelta, UpdateDelta, DeletionDelta
+
+
+class FakeSubscription(object):
+    def __init__(self):
+        self.deliver_delta = Mock()
+
+
+class FakeSubscriptionItem(object):
+    def __init__(self, query):
+        self.subscription = FakeSubscription()
+        self.query = query
+
+
+class TodosByListOwner(JoinDealer):
+    model = 'Todo'
+    parent_model = 'List'
+    foreign_key = 'list_id'
+    parent_field = 'owner'
+
+
+def todo(id, list_id):
+    return {'id': id, 'list_id': list_id}
+
+
+def todo_list(id, owner):
+    return {'id': id, 'owner': owner}
+
+
+class TestJoinDealer(unittest.TestCase):
+    def setUp(self):
+        self.dealer = TodosByListOwner()
+        self.dm = DealerManager()
+        self.dm.register_dealer(self.dealer)
+
+        self.alice = FakeSubscriptionItem({'value': 'alice',
+                                           'parents': [1, 2]})
+        self.bob = FakeSubscriptionItem({'value': 'bob'})
+        self.dealer.add_subscription_item(self.alice)
+        self.dealer.add_subscription_item(self.bob)
+
+    def test_items(self):
+        get_items = self.dealer.get_subscription_items_for_model
+        self.assertEqual(get_items(todo(1, 1)), {self.alice})
+        self.assertEqual(get_items(todo(1, 2)), {self.alice})
+        self.assertEqual(get_items(todo(1, 3)), set())
+        self.assertEqual(get_items({}), set())
+
+    def test_parent_deltas(self):
+        self.dm.deliver_delta(InsertionDelta('List', todo_list(3, 'bob')))
+        self.dm.deliver_delta(UpdateDelta('List', todo_list(1, 'bob'),
+                                          todo_list(1, 'alice')))
+        self.dm.deliver_delta(DeletionDelta('List', todo_list(2, 'alice')))
+
+        get_items = self.dealer.get_subscription_items_for_model
+        self.assertEqual(get_items(todo(1, 1)), {self.bob})
+        self.assertEqual(get_items(todo(1, 2)), set())
+        self.assertEqual(get_items(todo(1, 3)), {self.bob})
+
+    def test_move_child(self):
+        self.dm.deliver_delta(InsertionDelta('List', todo_list(3, 'bob')))
+
+        delta = UpdateDelta('Todo', todo(1, 3), todo(1, 1))
+        self.dm.deliver_delta(delta)
+        self.alice.subscription.deliver_delta.assert_called_once_with(
+            DeletionDelta('Todo', todo(1, 1)))
+        self.bob.subscription.deliver_delta.assert_called_once_with(
+            InsertionDelta('Todo', todo(1, 3)))
+
+    def test_deliver_deltas_in_order(self):
+        insertion = InsertionDelta('Todo', todo(1, 3))
+        self.dm.deliver_deltas([
+            InsertionDelta('List', todo_list(3, 'bob')),
+            insertion,
+        ])
+        self.bob.subscription.deliver_delta.assert_called_once_with(
+            insertion)
+
+    def test_unknown_model_class(self):
+        with self.assertRaises(UnknownModelClass):
+            self.dm.deliver_delta(InsertionDelta('Tag', {'id': 1}))
+
+        self.dm.unregister_dealer(self.dealer)
+        with self.assertRaises(UnknownModelClass):
+            self.dm.deliver_delta(InsertionDelta('List', todo_list(3, 'x')))
+
+    def test_remove(self):
+        self.dm.deliver_delta(InsertionDelta('List', todo_list(3, 'bob')))
+        self.dealer.remove_subscription_item(self.alice)
+        self.assertEqual(self.dealer.values_by_parent, {3: 'bob'})
+
+        self.dealer.remove_subscription_item(self.bob)
+        self.assertEqual(self.dealer.items_by_value, {})
+        self.assertEqual(self.dealer.values_by_parent, {})
+        self.assertEqual(self.dealer.parents_by_value, {})
+
+    def test_unwanted_parents(self):
+        # No subscription item wants carol's lists
+        self.dm.deliver_delta(InsertionDelta('List', todo_list(3, 'carol')))
+        self.dm.deliver_delta(UpdateDelta('List', todo_list(1, 'carol'),
+                                          todo_list(1, 'alice')))
+        self.assertEqual(self.dealer.values_by_parent, {2: 'alice'})
+        self.assertEqual(self.dealer.parents_by_value, {'alice': {2}})
+
+    def test_bad_query(self):
+        for query in [
+            'alice',
+            {},
+            {'value': ['alice']},
+            {'value': 'alice', 'parents': 1},
+            {'value': 'alice', 'parents': [[1]]},
+        ]:
+            with self.assertRaises(BadQuery):
+                self.dealer.add_subscription_item(FakeSubscriptionItem(query))
+
+
+if __name__ == "__main__":
+    unittest.main()
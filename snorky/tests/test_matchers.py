@@ -0,0 +1,243 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import unittest
+from snorky.services.datasync.filters import CompiledFilter
+from snorky.services.datasync.matchers import \
+        ScanMatcher, IndexMatcher, CountingMatcher, AdaptiveMatcher, \
+        filter_shape
+from snorky.services.datasync import batch
+from snorky.services.datasync.batch import BatchEvaluator
+
+
+def random_atom(rand):
+    op = rand.choice(['==', '==', '<', '<=', '>', '>='])
+    field = rand.choice(['a', 'b', 'c', 'd.e'])
+    value = rand.choice([0, 1, 2, 3, 4, 2.5, True, 'x', 'y', None])
+    return [op, field, value]
+
+def random_filter(rand, depth=0):
+    kind = rand.random()
+    if depth >= 2 or kind < 0.4:
+        return random_atom(rand)
+    elif kind < 0.7:
+        return ['and'] + [random_filter(rand, depth + 1)
+                          for i in range(rand.randint(1, 3))]
+    elif kind < 0.9:
+        return ['or'] + [random_filter(rand, depth + 1)
+                         for i in range(rand.randint(1, 3))]
+    else:
+        return ['not', random_filter(rand, depth + 1)]
+
+def random_model(rand):
+    values = [0, 1, 2, 3, 4, 1.5, False, True, 'x', 'y', 'z', None, [1]]
+    model = {}
+    for field in ['a', 'b', 'c']:
+        if rand.random() < 0.8:
+            model[field] = rand.choice(values)
+    if rand.random() < 0.5:
+        model['d'] = {'e': rand.choice(values)}
+    return model
+
+
+class MatcherTestMixin(object):
+    """Checks a matcher returns the same results as :class:`ScanMatcher`."""
+    matcher_class = None
+
+    def test_equivalent_to_scan(self):
+        rand = random.Random(1234)
+        matcher = self.matcher_class()
+        reference = ScanMatcher()
+
+        keys = []
+        for i in range(300):
+            compiled = CompiledFilter(random_filter(rand))
+            matcher.add(i, compiled)
+            reference.add(i, compiled)
+            keys.append(i)
+
+        # Remove some filters, so removal is also exercised
+        for key in rand.sample(keys, 100):
+            matcher.remove(key)
+            reference.remove(key)
+
+        for i in range(300):
+            model = random_model(rand)
+            self.assertEqual(matcher.match(model), reference.match(model),
+                             model)
+
+    def test_match_many(self):
+        rand = random.Random(4321)
+        matcher = self.matcher_class()
+        for i in range(100):
+            matcher.add(i, CompiledFilter(random_filter(rand)))
+
+        models = [random_model(rand) for i in range(50)]
+        self.assertEqual(matcher.match_many(models),
+                         [matcher.match(model) for model in models])
+        self.assertEqual(matcher.match_many([]), [])
+
+    def test_empty(self):
+        matcher = self.matcher_class()
+        matcher.add('k', CompiledFilter(['==', 'a', 1]))
+        matcher.remove('k')
+        self.assertEqual(matcher.match({'a': 1}), set())
+
+
+class TestScanMatcher(MatcherTestMixin, unittest.TestCase):
+    matcher_class = ScanMatcher
+
+
+class PurePythonEvaluator(BatchEvaluator):
+    use_numpy = False
+
+
+class TestBatchEvaluator(unittest.TestCase):
+    def evaluate(self, filter, models):
+        return BatchEvaluator(models).evaluate(CompiledFilter(filter).filter)
+
+    def test_bitmask(self):
+        models = [{'a': 1}, {'a': 5}, {}, {'a': 'x'}, {'a': 7}]
+        self.assertEqual(self.evaluate(['>', 'a', 2], models), 0b10010)
+        self.assertEqual(self.evaluate(['==', 'a', 1], models), 0b00001)
+        self.assertEqual(self.evaluate(['not', ['>', 'a', 2]], models),
+                         0b01101)
+        self.assertEqual(self.evaluate(['or', ['==', 'a', 'x'],
+                                              ['<=', 'a', 1]], models),
+                         0b01001)
+
+    def test_nan(self):
+        nan = float('nan')
+        models = [{'a': nan}, {'a': 1}]
+        self.assertEqual(self.evaluate(['==', 'a', nan], models), 0)
+        self.assertEqual(self.evaluate(['<', 'a', 2], models), 0b10)
+
+    @unittest.skipIf(batch.numpy is None, "NumPy is not installed")
+    def test_numpy_equivalent(self):
+        rand = random.Random(99)
+        models = [random_model(rand) for i in range(70)]
+        models.append({'a': 2 ** 60, 'b': 2 ** 60 + 1})
+        filters = [random_filter(rand) for i in range(200)]
+        filters.append(['<', 'a', 2 ** 60 + 1])
+        filters.append(['>=', 'b', 2 ** 60 + 1])
+
+        for filter in filters:
+            with_numpy = BatchEvaluator(models)
+            without_numpy = PurePythonEvaluator(models)
+            filter = CompiledFilter(filter).filter
+            self.assertEqual(with_numpy.evaluate(filter),
+                             without_numpy.evaluate(filter), filter)
+
+
+class TestIndexMatcher(MatcherTestMixin, unittest.TestCase):
+    matcher_class = IndexMatcher
+
+    def test_only_candidates_are_checked(self):
+        matcher = IndexMatcher()
+        matcher.add(1, CompiledFilter(['==', 'owner', 1]))
+        matcher.add(2, CompiledFilter(['and', ['==', 'owner', 2],
+                                              ['>', 'priority', 3]]))
+        matcher.add(3, CompiledFilter(['<', 'priority', 3]))
+
+        self.assertEqual(set(matcher.candidates({'owner': 2})), {2})
+        self.assertEqual(set(matcher.candidates({'priority': 1})), {3})
+        self.assertEqual(matcher.match({'owner': 2, 'priority': 5}), {2})
+        self.assertEqual(matcher.match({'owner': 1, 'priority': 1}), {1, 3})
+        self.assertEqual(matcher.match({'owner': [1]}), set())
+
+    def test_thresholds(self):
+        matcher = IndexMatcher()
+        for level in range(10):
+            matcher.add(('>=', level),
+                        CompiledFilter(['>=', 'severity_level', level]))
+            matcher.add(('>', level),
+                        CompiledFilter(['>', 'severity_level', level]))
+            matcher.add(('<=', level),
+                        CompiledFilter(['<=', 'severity_level', level]))
+            matcher.add(('<', level),
+                        CompiledFilter(['<', 'severity_level', level]))
+        matcher.add('string', CompiledFilter(['>', 'severity_level', 'a']))
+
+        self.assertEqual(matcher.match({'severity_level': 4}),
+                         set([('>=', k) for k in range(5)] +
+                             [('>', k) for k in range(4)] +
+                             [('<=', k) for k in range(4, 10)] +
+                             [('<', k) for k in range(5, 10)]))
+        self.assertEqual(matcher.match({'severity_level': 'b'}), {'string'})
+        self.assertEqual(matcher.match({'severity_level': None}), set())
+        self.assertEqual(matcher.match({'severity_level': float('nan')}),
+                         set())
+
+
+class TestCountingMatcher(MatcherTestMixin, unittest.TestCase):
+    matcher_class = CountingMatcher
+
+    def test_atoms_are_shared(self):
+        matcher = CountingMatcher()
+        matcher.add(1, CompiledFilter(['and', ['==', 'status', 'open'],
+                                              ['>', 'priority', 3]]))
+        matcher.add(2, CompiledFilter(['or', ['==', 'status', 'open'],
+                                             ['not', ['>', 'priority', 3]]]))
+        self.assertEqual(len(matcher.atoms), 2)
+
+        self.assertEqual(matcher.match({'status': 'open', 'priority': 5}),
+                         {1, 2})
+        self.assertEqual(matcher.match({'status': 'closed', 'priority': 5}),
+                         set())
+        self.assertEqual(matcher.match({'status': 'closed'}), {2})
+
+        matcher.remove(1)
+        matcher.remove(2)
+        self.assertEqual(matcher.atoms, {})
+        self.assertEqual(matcher.getters, {})
+        self.assertEqual(matcher.positive_postings, {})
+
+    def test_too_complex(self):
+        matcher = CountingMatcher(max_conjunctions=2)
+        f = ['and', ['or', ['==', 'a', 1], ['==', 'a', 2]],
+                    ['or', ['==', 'b', 1], ['==', 'b', 2]]]
+        matcher.add(1, CompiledFilter(f))
+        self.assertIn(1, matcher.unindexed)
+        self.assertEqual(matcher.match({'a': 2, 'b': 1}), {1})
+
+
+class TestAdaptiveMatcher(MatcherTestMixin, unittest.TestCase):
+    matcher_class = AdaptiveMatcher
+
+    def test_filter_shape(self):
+        self.assertEqual(filter_shape(['==', 'a', 1]), 'equality')
+        self.assertEqual(filter_shape(['and', ['<', 'a', 1], ['==', 'b', 1]]),
+                         'equality')
+        self.assertEqual(filter_shape(['<', 'a', 1]), 'range')
+        self.assertEqual(filter_shape(['or', ['==', 'a', 1], ['<', 'a', 0]]),
+                         'compound')
+        self.assertEqual(filter_shape(['==', 'a', [1]]), 'other')
+
+    def test_strategy(self):
+        matcher = AdaptiveMatcher()
+        self.assertEqual(matcher.strategy, 'ScanMatcher')
+
+        for i in range(20):
+            matcher.add(('eq', i), CompiledFilter(['==', 'owner', i]))
+        self.assertEqual(matcher.strategy, 'IndexMatcher')
+        self.assertEqual(matcher.match({'owner': 3}), {('eq', 3)})
+
+        for i in range(40):
+            matcher.add(('or', i), CompiledFilter(
+                ['or', ['==', 'a', i], ['==', 'b', i]]))
+        self.assertEqual(matcher.strategy, 'CountingMatcher')
+        self.assertEqual(matcher.match({'owner': 3, 'b': 3}),
+                         {('eq', 3), ('or', 3)})
+
+        for i in range(20):
+            matcher.remove(('eq', i))
+        for i in range(40):
+            matcher.remove(('or', i))
+        self.assertEqual(matcher.strategy, 'ScanMatcher')
+        self.assertEqual(matcher.match({'owner': 3}), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
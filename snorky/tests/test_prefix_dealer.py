@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import Mock
+from snorky.services.datasync.dealers import PrefixDealer, BadQuery
+from snorky.services.datasync.delta import \
+        InsertionDelta, UpdateDelta, DeletionDelta
+
+
+class FakeSubscription(object):
+    def __init__(self):
+        self.deliver_delta = Mock()
+
+
+class FakeSubscriptionItem(object):
+    def __init__(self, query):
+        self.subscription = FakeSubscription()
+        self.query = query
+
+
+class DocumentsInFolder(PrefixDealer):
+    model = 'Document'
+    key_field = 'path'
+
+
+def document(path):
+    return {'path': path}
+
+
+class TestPrefixDealer(unittest.TestCase):
+    def setUp(self):
+        self.dealer = DocumentsInFolder()
+        self.item_all = FakeSubscriptionItem('')
+        self.item_project = FakeSubscriptionItem('projects/42/')
+        self.item_docs = FakeSubscriptionItem('projects/42/docs/')
+        self.item_other = FakeSubscriptionItem('projects/43/')
+        for item in (self.item_all, self.item_project, self.item_docs,
+                     self.item_other):
+            self.dealer.add_subscription_item(item)
+
+    def matches(self, path):
+        return self.dealer.get_subscription_items_for_model(document(path))
+
+    def test_items(self):
+        self.assertEqual(self.matches('projects/42/docs/a.txt'),
+                         {self.item_all, self.item_project, self.item_docs})
+        self.assertEqual(self.matches('projects/42/b.txt'),
+                         {self.item_all, self.item_project})
+        self.assertEqual(self.matches('projects/4'), {self.item_all})
+        self.assertEqual(self.matches('projects/43/'),
+                         {self.item_all, self.item_other})
+
+        # Not a path
+        self.assertEqual(self.matches(42), set())
+        self.assertEqual(self.dealer.get_subscription_items_for_model({}),
+                         set())
+
+    def test_remove(self):
+        self.dealer.remove_subscription_item(self.item_docs)
+        self.assertEqual(self.matches('projects/42/docs/a.txt'),
+                         {self.item_all, self.item_project})
+
+        for item in (self.item_all, self.item_project, self.item_other):
+            self.dealer.remove_subscription_item(item)
+        self.assertEqual(self.dealer.root.children, {})
+        self.assertEqual(self.dealer.root.items, set())
+
+    def test_move(self):
+        delta = UpdateDelta('Document', document('projects/43/a.txt'),
+                            document('projects/42/a.txt'))
+        self.dealer.deliver_delta(delta)
+
+        self.item_all.subscription.deliver_delta.assert_called_once_with(
+            delta)
+        self.item_project.subscription.deliver_delta.assert_called_once_with(
+            DeletionDelta('Document', document('projects/42/a.txt')))
+        self.item_other.subscription.deliver_delta.assert_called_once_with(
+            InsertionDelta('Document', document('projects/43/a.txt')))
+        self.assertFalse(self.item_docs.subscription.deliver_delta.called)
+
+    def test_bad_query(self):
+        with self.assertRaises(BadQuery):
+            self.dealer.add_subscription_item(FakeSubscriptionItem(['a']))
+
+
+if __name__ == "__main__":
+    unittest.main()
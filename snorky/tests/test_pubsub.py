@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from snorky.services.pubsub import PubSubService, PubSubBackend
+from snorky.codec import EncodedMessage
 
 from snorky.tests.utils.rpc import RPCTestMixin
 from unittest import TestCase
@@ -49,6 +50,18 @@ class TestPubSub(RPCTestMixin, TestCase):
             },
         })
 
+    def test_send_encoded_once(self):
+        self.rpcCall(self.service, self.alice,
+                     "subscribe", channel="offtopic")
+        self.rpcCall(self.service, self.bob,
+                     "subscribe", channel="offtopic")
+        self.rpcCall(self.service, self.bob,
+                     "publish", channel="offtopic", message="Hello")
+
+        # Both clients receive the same encoded message
+        self.assertIsInstance(self.msg_alice, EncodedMessage)
+        self.assertIs(self.msg_alice, self.msg_bob)
+
     def test_unsubscribe(self):
         self.test_send()
 
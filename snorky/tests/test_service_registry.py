@@ -5,8 +5,10 @@
 from snorky.service_registry import ServiceRegistry
 from snorky.services.base import Service
 from snorky.client import Client
+from snorky.codec import JSONCodec
 from tornado.testing import ExpectLog
 
+from mock import Mock
 import unittest
 
 
@@ -68,6 +70,19 @@ class TestServiceRegistry(unittest.TestCase):
             "message": "foo"
         })
 
+    def test_codec(self):
+        codec = Mock(wraps=JSONCodec())
+        self.mh = ServiceRegistry([EchoService("echo")], codec=codec)
+        self.assertIs(self.mh.codec, codec)
+
+        self.test_process_message_raw()
+        self.assertEqual(codec.loads_hashable.call_count, 1)
+
+    def test_client_codec(self):
+        self.client.codec = Mock(wraps=JSONCodec())
+        self.test_process_message_raw()
+        self.assertEqual(self.client.codec.loads_hashable.call_count, 1)
+
     def test_invalid_json(self):
         with ExpectLog("snorky", 'Invalid JSON.*'):
             self.mh.process_message_raw(self.client, '''{
@@ -4,7 +4,8 @@
 
 import unittest
 from mock import Mock
-from snorky.services.datasync.dealers import SimpleDealer
+from snorky.services.datasync.dealers import \
+        SimpleDealer, MultiKeyDealer, BadQuery
 from snorky.services.datasync.delta import \
         Delta, InsertionDelta, UpdateDelta, DeletionDelta
 
@@ -70,5 +71,86 @@ class TestSimpleDealer(unittest.TestCase):
         self.assertEqual(len(items), 0)
 
 
+class MyCachedDealer(SimpleDealer):
+    name = 'test_cached_dealer'
+    model = 'dummy (unused)'
+    key_fields = ('prop',)
+    match_cache_size = 10
+
+    def get_key_for_model(self, model):
+        return model['prop']
+
+
+class TestCachedSimpleDealer(unittest.TestCase):
+    def test_cache(self):
+        dealer = MyCachedDealer()
+        item = FakeSubscriptionItem(1)
+        dealer.add_subscription_item(item)
+
+        delta = InsertionDelta('dummy', {'prop': 1})
+        dealer.deliver_delta(delta)
+        dealer.deliver_delta(delta)
+        self.assertEqual(dealer.match_cache.hits, 1)
+        self.assertEqual(item.subscription.deliver_delta.call_count, 2)
+
+        dealer.remove_subscription_item(item)
+        dealer.deliver_delta(delta)
+        self.assertEqual(dealer.match_cache.hits, 1)
+        self.assertEqual(item.subscription.deliver_delta.call_count, 2)
+
+
+class MyMultiKeyDealer(MultiKeyDealer):
+    name = 'test_multi_key_dealer'
+    model = 'dummy (unused)'
+
+    def get_key_for_model(self, model):
+        return model.prop
+
+
+class TestMultiKeyDealer(unittest.TestCase):
+    def test_items(self):
+        dealer = MyMultiKeyDealer()
+        item1 = FakeSubscriptionItem([1, 2, 3])
+        item2 = FakeSubscriptionItem([3, 4, 4])
+
+        dealer.add_subscription_item(item1)
+        dealer.add_subscription_item(item2)
+
+        self.assertEqual(dealer.get_subscription_items_for_model(
+            DummyModel(1)), {item1})
+        self.assertEqual(dealer.get_subscription_items_for_model(
+            DummyModel(3)), {item1, item2})
+        self.assertEqual(dealer.get_subscription_items_for_model(
+            DummyModel(4)), {item2})
+        self.assertEqual(dealer.get_subscription_items_for_model(
+            DummyModel(5)), set())
+
+        dealer.remove_subscription_item(item1)
+        self.assertEqual(dealer.get_subscription_items_for_model(
+            DummyModel(3)), {item2})
+
+        dealer.remove_subscription_item(item2)
+        self.assertEqual(dealer.items_by_model_key, {})
+        self.assertEqual(dealer.keys_by_item, {})
+
+    def test_bad_query(self):
+        dealer = MyMultiKeyDealer()
+
+        with self.assertRaises(BadQuery):
+            dealer.add_subscription_item(FakeSubscriptionItem(1))
+        with self.assertRaises(BadQuery):
+            dealer.add_subscription_item(FakeSubscriptionItem([1, [2]]))
+        self.assertEqual(dealer.items_by_model_key, {})
+
+    def test_deliver_delta(self):
+        dealer = MyMultiKeyDealer()
+        item = FakeSubscriptionItem([1, 2])
+        dealer.add_subscription_item(item)
+
+        delta = UpdateDelta('dummy', DummyModel(2), DummyModel(1))
+        dealer.deliver_delta(delta)
+        item.subscription.deliver_delta.assert_called_once_with(delta)
+
+
 if __name__ == "__main__":
     unittest.main()
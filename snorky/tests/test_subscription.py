@@ -53,8 +53,8 @@ class TestSubscription(unittest.TestCase):
         subscription.got_client(self.client)
 
         # Delta should have arrived to client, untouched
-        self.service.deliver_delta.assert_called_once_with(self.client,
-                                                           self.delta)
+        self.service.deliver_delta.assert_called_once_with(
+            self.client, self.delta, patch=False)
 
         # Awaited client buffer should be empty now
         self.assertEqual(subscription._awaited_client_buffer, [])
@@ -62,6 +62,20 @@ class TestSubscription(unittest.TestCase):
         # Further messages must arrive directly
         self.service.deliver_delta.reset_mock()
         subscription.deliver_delta(self.delta)
-        self.service.deliver_delta.assert_called_once_with(self.client,
-                                                           self.delta)
+        self.service.deliver_delta.assert_called_once_with(
+            self.client, self.delta, patch=False)
         self.assertEqual(subscription._awaited_client_buffer, [])
+
+    def test_patch(self):
+        subscription = Subscription([self.subscription_item], self.service)
+        subscription.deliver_delta(self.delta)
+        subscription.got_client(self.client, patch=True)
+
+        # Buffered deltas are sent in the patch format too
+        self.service.deliver_delta.assert_called_once_with(
+            self.client, self.delta, patch=True)
+
+        # A second client can't change the format
+        with self.assertRaises(RuntimeError):
+            subscription.got_client(FakeClient(), patch=False)
+        self.assertTrue(subscription.patch)
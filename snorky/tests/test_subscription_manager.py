@@ -17,7 +17,7 @@ class FakeSubscription(object):
         self.got_client = Mock(side_effect=self._got_client)
         self.lost_client = Mock()
 
-    def _got_client(self, client):
+    def _got_client(self, client, patch=False):
         self.client = client
 
 
@@ -63,7 +63,7 @@ class TestSubscriptionManager(unittest.TestCase):
         subscription = self.sm.get_subscription_with_token(token)
         self.sm.link_subscription_to_client(subscription, client)
 
-        self.subscription.got_client.assert_called_with(client)
+        self.subscription.got_client.assert_called_with(client, False)
         self.assertTrue(self.sm.subscriptions_by_client.in_set(
             client, subscription))
 
@@ -0,0 +1,160 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import Mock
+from snorky.services.datasync.dealers import \
+        TimeWindowDealer, BadQuery, parse_timestamp
+from snorky.services.datasync.delta import \
+        InsertionDelta, UpdateDelta, DeletionDelta
+from snorky.tests.utils.timeout import TestTimeoutFactory
+
+
+class FakeSubscription(object):
+    def __init__(self):
+        self.deliver_delta = Mock()
+
+
+class FakeSubscriptionItem(object):
+    def __init__(self, query):
+        self.subscription = FakeSubscription()
+        self.query = query
+
+
+class RecentActivity(TimeWindowDealer):
+    model = 'Activity'
+
+
+def activity(id, timestamp, kind='comment'):
+    return {'id': id, 'timestamp': timestamp, 'kind': kind}
+
+
+class TestTimeWindowDealer(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.time_man = TestTimeoutFactory()
+        self.dealer = RecentActivity(timeout_factory=self.time_man,
+                                     clock=lambda: self.now)
+        self.item = FakeSubscriptionItem({
+            'seconds': 60,
+            'rows': [activity(1, 950), activity(2, 970), activity(3, 900)],
+        })
+        self.dealer.add_subscription_item(self.item)
+        self.window = list(self.dealer.windows.values())[0]
+
+    def advance(self, seconds):
+        """Moves the clock forward and fires the pending timeouts."""
+        self.now += seconds
+        timeouts = list(self.time_man.timeouts.values())
+        self.time_man.timeouts.clear()
+        for callback, args, kwargs in timeouts:
+            callback(*args, **kwargs)
+
+    def delivered(self):
+        deltas = [args[0][0] for args in
+                  self.item.subscription.deliver_delta.call_args_list]
+        self.item.subscription.deliver_delta.reset_mock()
+        return deltas
+
+    def test_seed(self):
+        self.assertEqual(set(self.window.rows), {1, 2})
+        self.assertEqual(self.time_man.timeouts_pending, 1)
+
+    def test_expiration(self):
+        self.advance(5)
+        self.assertEqual(self.delivered(), [])
+
+        self.advance(5)
+        self.assertEqual(self.delivered(),
+                         [DeletionDelta('Activity', activity(1, 950))])
+        self.assertEqual(self.time_man.timeouts_pending, 1)
+
+        self.advance(20)
+        self.assertEqual(self.delivered(),
+                         [DeletionDelta('Activity', activity(2, 970))])
+        self.assertEqual(self.time_man.timeouts_pending, 0)
+
+    def test_insertion(self):
+        # Too old
+        self.dealer.deliver_delta(InsertionDelta('Activity',
+                                                 activity(4, 800)))
+        self.assertEqual(self.delivered(), [])
+
+        delta = InsertionDelta('Activity', activity(4, 995))
+        self.dealer.deliver_delta(delta)
+        self.assertEqual(self.delivered(), [delta])
+
+        self.advance(60)
+        self.assertEqual(self.delivered(), [
+            DeletionDelta('Activity', activity(1, 950)),
+            DeletionDelta('Activity', activity(2, 970)),
+            DeletionDelta('Activity', activity(4, 995)),
+        ])
+
+    def test_update_and_deletion(self):
+        # Refreshing a row postpones its expiration
+        delta = UpdateDelta('Activity', activity(2, 999), activity(2, 970))
+        self.dealer.deliver_delta(delta)
+        self.assertEqual(self.delivered(), [delta])
+
+        delta = DeletionDelta('Activity', activity(1, 950))
+        self.dealer.deliver_delta(delta)
+        self.assertEqual(self.delivered(), [delta])
+
+        self.advance(55)
+        self.assertEqual(self.delivered(), [])
+        self.advance(5)
+        self.assertEqual(self.delivered(),
+                         [DeletionDelta('Activity', activity(2, 999))])
+
+        # Entering the window
+        self.dealer.deliver_delta(UpdateDelta('Activity', activity(3, 1050),
+                                              activity(3, 900)))
+        self.assertEqual(self.delivered(),
+                         [InsertionDelta('Activity', activity(3, 1050))])
+
+    def test_filter_and_strings(self):
+        item = FakeSubscriptionItem({
+            'seconds': 60,
+            'filter': ['==', 'kind', 'like'],
+        })
+        self.dealer.add_subscription_item(item)
+
+        delta = InsertionDelta('Activity',
+                               activity(5, '1970-01-01T00:16:30Z', 'like'))
+        self.dealer.deliver_delta(delta)
+        self.dealer.deliver_delta(InsertionDelta('Activity',
+                                                 activity(6, 990, 'comment')))
+        item.subscription.deliver_delta.assert_called_once_with(delta)
+
+    def test_remove_subscription_item(self):
+        self.dealer.remove_subscription_item(self.item)
+        self.assertEqual(self.dealer.windows, {})
+        self.assertEqual(self.time_man.timeouts_pending, 0)
+
+    def test_bad_query(self):
+        for query in [
+            None,
+            {},
+            {'seconds': 0},
+            {'seconds': True},
+            {'seconds': 60, 'filter': 'kind'},
+            {'seconds': 60, 'rows': {}},
+        ]:
+            with self.assertRaises(BadQuery):
+                self.dealer.add_subscription_item(FakeSubscriptionItem(query))
+        self.assertEqual(len(self.dealer.windows), 1)
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp(12.5), 12.5)
+        self.assertEqual(parse_timestamp('1970-01-01T00:01:00.5Z'), 60.5)
+        self.assertEqual(parse_timestamp('1970-01-01T01:01:00+01:00'), 60)
+        self.assertEqual(parse_timestamp('1970-01-01T00:01:00'), 60)
+        self.assertIsNone(parse_timestamp('yesterday'))
+        self.assertIsNone(parse_timestamp(None))
+        self.assertIsNone(parse_timestamp(True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,8 @@
 from unittest import TestCase
 from mock import Mock
 from snorky.tests.utils.timeout import TestTimeoutFactory
+from snorky.timeout import TimerWheel
+import random
 import unittest
 
 
@@ -31,5 +33,102 @@ class TestTimeouts(TestCase):
         self.assertFalse(self.mock.called)
 
 
+class FakeIOLoop(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.callbacks = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        self.callbacks.append(callback)
+
+
+class TestTimerWheel(TestCase):
+    def setUp(self):
+        self.io_loop = FakeIOLoop()
+        self.wheel = TimerWheel(resolution=1, io_loop=self.io_loop)
+        self.fired = []
+
+    def schedule(self, delay):
+        due = self.io_loop.now + delay
+        return self.wheel.call_later(
+            delay, lambda: self.fired.append((due, self.io_loop.now)))
+
+    def run_until(self, time):
+        while self.io_loop.now < time:
+            self.io_loop.now += 1
+            self.wheel.advance()
+
+    def test_add_and_run(self):
+        mock = Mock()
+        self.wheel.call_later(5, mock, "foo", bar=5)
+        self.assertEqual(self.wheel.count, 1)
+        self.assertEqual(len(self.io_loop.callbacks), 1)
+
+        self.run_until(1004)
+        self.assertFalse(mock.called)
+        self.run_until(1005)
+        mock.assert_called_once_with("foo", bar=5)
+        self.assertEqual(self.wheel.count, 0)
+
+        # The wheel stops ticking when it is empty
+        self.wheel.tick()
+        self.assertFalse(self.wheel.ticking)
+
+    def test_cancel(self):
+        timeout = self.schedule(5)
+        timeout.cancel()
+        self.assertEqual(self.wheel.count, 0)
+        with self.assertRaises(RuntimeError):
+            timeout.cancel()
+
+        self.run_until(1010)
+        self.assertEqual(self.fired, [])
+
+    def test_cancel_from_callback(self):
+        # Both timeouts run in the same tick, the first one cancels the other
+        handles = []
+        for i in range(2):
+            handles.append(self.wheel.call_later(
+                3, lambda i=i: handles[1 - i].cancel()))
+        self.run_until(1010)
+        self.assertEqual(sorted(handle.cancelled for handle in handles),
+                         [False, True])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_schedule_from_callback(self):
+        self.wheel.call_later(2, self.schedule, 0)
+        self.run_until(1003)
+        self.assertEqual(self.fired, [(1002, 1003)])
+
+    def test_long_delays(self):
+        rand = random.Random(3)
+        delays = [0, 255, 256, 257, 16383, 16384, 70000] + \
+                 [rand.uniform(0, 100000) for i in range(200)]
+        handles = [self.schedule(delay) for delay in delays]
+        cancelled = set(handles[-50:])
+        for handle in cancelled:
+            handle.cancel()
+
+        self.run_until(1000 + 100001)
+        self.assertEqual(self.wheel.count, 0)
+        self.assertEqual(len(self.fired), len(delays) - 50)
+        # Never early, at most a tick late
+        for due, now in self.fired:
+            self.assertLessEqual(due, now)
+            self.assertLessEqual(now, due + 1)
+
+    def test_after_idle(self):
+        self.schedule(1)
+        self.run_until(1001)
+        self.io_loop.now += 10 ** 6
+        self.schedule(1)
+        self.io_loop.now += 1
+        self.wheel.advance()
+        self.assertEqual(len(self.fired), 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,182 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import Mock
+from snorky.services.datasync.dealers import TopNDealer, BadQuery
+from snorky.services.datasync.delta import \
+        InsertionDelta, UpdateDelta, DeletionDelta
+
+
+class FakeSubscription(object):
+    def __init__(self):
+        self.deliver_delta = Mock()
+
+
+class FakeSubscriptionItem(object):
+    def __init__(self, query):
+        self.subscription = FakeSubscription()
+        self.query = query
+
+
+class LatestEvents(TopNDealer):
+    model = 'Event'
+
+
+def event(id, time, kind='info'):
+    return {'id': id, 'time': time, 'kind': kind}
+
+
+class TestTopNDealer(unittest.TestCase):
+    def setUp(self):
+        self.dealer = LatestEvents()
+        self.item = FakeSubscriptionItem({
+            'orderBy': 'time',
+            'descending': True,
+            'limit': 2,
+            'rows': [event(1, 10), event(2, 20), event(3, 30)],
+        })
+        self.dealer.add_subscription_item(self.item)
+
+    def deliver(self, delta):
+        self.item.subscription.deliver_delta.reset_mock()
+        self.dealer.deliver_delta(delta)
+        return [args[0][0] for args in
+                self.item.subscription.deliver_delta.call_args_list]
+
+    def test_seed(self):
+        window = list(self.dealer.windows.values())[0]
+        self.assertEqual(window.ids, [2, 3])
+
+    def test_insertion(self):
+        # Too old
+        self.assertEqual(self.deliver(InsertionDelta('Event', event(4, 5))),
+                         [])
+
+        # Enters the window, evicting the oldest event
+        delta = InsertionDelta('Event', event(5, 40))
+        self.assertEqual(self.deliver(delta), [
+            DeletionDelta('Event', event(2, 20)),
+            delta,
+        ])
+
+    def test_deletion(self):
+        delta = DeletionDelta('Event', event(3, 30))
+        self.assertEqual(self.deliver(delta), [delta])
+
+        # The window has room now, but event 1 and other unknown rows go
+        # before this one
+        self.assertEqual(self.deliver(InsertionDelta('Event', event(4, 5))),
+                         [])
+
+        # Goes before every row left out of the window
+        delta = InsertionDelta('Event', event(5, 15))
+        self.assertEqual(self.deliver(delta), [delta])
+
+    def test_deletion_complete_window(self):
+        item = FakeSubscriptionItem({
+            'orderBy': 'time', 'limit': 2, 'rows': [event(1, 10)],
+        })
+        self.dealer.add_subscription_item(item)
+
+        # No row has been left out of the window, so it is still complete
+        self.dealer.deliver_delta(DeletionDelta('Event', event(1, 10)))
+        delta = InsertionDelta('Event', event(4, 50))
+        item.subscription.deliver_delta.reset_mock()
+        self.dealer.deliver_delta(delta)
+        item.subscription.deliver_delta.assert_called_once_with(delta)
+
+    def test_insertion_left_out(self):
+        item = FakeSubscriptionItem({
+            'orderBy': 'time', 'limit': 2, 'rows': [event(1, 10), event(2, 20)],
+        })
+        self.dealer.add_subscription_item(item)
+
+        # Does not fit, so it is left out of the window
+        self.dealer.deliver_delta(InsertionDelta('Event', event(3, 30)))
+        self.dealer.deliver_delta(DeletionDelta('Event', event(1, 10)))
+
+        # Event 3 goes before it
+        item.subscription.deliver_delta.reset_mock()
+        self.dealer.deliver_delta(InsertionDelta('Event', event(4, 35)))
+        self.assertFalse(item.subscription.deliver_delta.called)
+
+        delta = InsertionDelta('Event', event(5, 25))
+        self.dealer.deliver_delta(delta)
+        item.subscription.deliver_delta.assert_called_once_with(delta)
+
+    def test_update(self):
+        # Inside the window
+        delta = UpdateDelta('Event', event(3, 35), event(3, 30))
+        self.assertEqual(self.deliver(delta), [delta])
+
+        # Falls behind the window
+        delta = UpdateDelta('Event', event(3, 1), event(3, 35))
+        self.assertEqual(self.deliver(delta),
+                         [DeletionDelta('Event', event(3, 35))])
+
+        # Enters the window
+        delta = UpdateDelta('Event', event(1, 50), event(1, 10))
+        self.assertEqual(self.deliver(delta),
+                         [InsertionDelta('Event', event(1, 50))])
+
+    def test_filter(self):
+        item = FakeSubscriptionItem({
+            'orderBy': 'time',
+            'limit': 1,
+            'filter': ['==', 'kind', 'error'],
+        })
+        self.dealer.add_subscription_item(item)
+
+        delta = InsertionDelta('Event', event(4, 40, 'error'))
+        self.dealer.deliver_delta(delta)
+        item.subscription.deliver_delta.assert_called_once_with(delta)
+
+        # Ascending, so a later event does not enter the window
+        item.subscription.deliver_delta.reset_mock()
+        self.dealer.deliver_delta(
+            InsertionDelta('Event', event(5, 50, 'error')))
+        self.dealer.deliver_delta(
+            InsertionDelta('Event', event(6, 1, 'info')))
+        self.assertFalse(item.subscription.deliver_delta.called)
+
+    def test_shared_window(self):
+        item = FakeSubscriptionItem({
+            'orderBy': 'time', 'descending': True, 'limit': 2,
+        })
+        self.dealer.add_subscription_item(item)
+        self.assertEqual(len(self.dealer.windows), 1)
+
+        self.dealer.remove_subscription_item(self.item)
+        self.assertEqual(len(self.dealer.windows), 1)
+        self.dealer.remove_subscription_item(item)
+        self.assertEqual(self.dealer.windows, {})
+
+    def test_get_subscription_items_for_model(self):
+        self.assertEqual(
+            self.dealer.get_subscription_items_for_model(event(3, 30)),
+            {self.item})
+        self.assertEqual(
+            self.dealer.get_subscription_items_for_model(event(1, 10)),
+            set())
+
+    def test_bad_query(self):
+        for query in [
+            None,
+            {'limit': 2},
+            {'orderBy': 'time'},
+            {'orderBy': 'time', 'limit': 0},
+            {'orderBy': 'time', 'limit': True},
+            {'orderBy': 'time', 'limit': 2, 'descending': 'yes'},
+            {'orderBy': 'time', 'limit': 2, 'filter': 'kind'},
+            {'orderBy': 'time', 'limit': 2, 'filter': ['~', 'kind', 1]},
+            {'orderBy': 'time', 'limit': 2, 'rows': {}},
+        ]:
+            with self.assertRaises(BadQuery):
+                self.dealer.add_subscription_item(FakeSubscriptionItem(query))
+        self.assertEqual(len(self.dealer.windows), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -118,5 +118,47 @@ class TestUpdateCasesDealer(unittest.TestCase):
         self.assertFalse(self.deliver_delta.called)
 
 
+class CountingPlayersWithColorDealer(PlayersWithColorDealer):
+    key_fields = ('color',)
+
+    def __init__(self):
+        super(CountingPlayersWithColorDealer, self).__init__()
+        self.lookups = 0
+
+    def get_key_for_model(self, model):
+        self.lookups += 1
+        return model['color']
+
+
+class TestUpdateCasesDependentFields(TestUpdateCasesDealer):
+    def test_unchanged_fields_are_matched_once(self):
+        dealer = CountingPlayersWithColorDealer()
+        dealer.add_subscription_item(self.subscription_item)
+
+        # Alice changes her player name, which no subscription depends on
+        original_delta = UpdateDelta('player',
+                old_data={'id': 1, 'name': 'Alice', 'color': 'red'},
+                new_data={'id': 1, 'name': 'SuperAlice', 'color': 'red'})
+
+        dealer.deliver_delta(original_delta)
+
+        self.deliver_delta.assert_called_once_with(original_delta)
+        self.assertEqual(dealer.lookups, 1)
+
+    def test_changed_fields_are_matched_twice(self):
+        dealer = CountingPlayersWithColorDealer()
+        dealer.add_subscription_item(self.subscription_item)
+
+        original_delta = UpdateDelta('player',
+                old_data={'id': 1, 'name': 'Alice', 'color': 'blue'},
+                new_data={'id': 1, 'name': 'Alice', 'color': 'red'})
+
+        dealer.deliver_delta(original_delta)
+
+        self.deliver_delta.assert_called_once_with(
+            InsertionDelta("player", original_delta.new_data))
+        self.assertEqual(dealer.lookups, 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,370 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+from tornado.httpclient import HTTPRequest
+from tornado.concurrent import Future
+from mock import Mock
+from snorky.service_registry import ServiceRegistry
+from snorky.services.base import Service
+from snorky.codec import JSONCodec, MsgpackCodec
+from snorky.request_handlers.websocket import \
+        SnorkyWebSocketHandler, WebSocketClient, CompressionStats, \
+        SlowConsumerStats
+import json
+import unittest
+
+
+class EchoService(Service):
+    def process_message_from(self, client, msg):
+        self.send_message_to(client, msg)
+
+
+class BurstService(Service):
+    client = None
+
+    def process_message_from(self, client, msg):
+        self.client = client
+        for i in range(msg):
+            self.send_message_to(client, i)
+
+
+class CompressionTestCase(AsyncHTTPTestCase):
+    handler_options = {
+        "compression": True,
+        "compression_threshold": 100,
+    }
+
+    def get_app(self):
+        self.stats = CompressionStats()
+        registry = ServiceRegistry([EchoService("echo")])
+        return Application([
+            SnorkyWebSocketHandler.get_route(
+                registry, "/ws", ping_pong_interval=0, stats=self.stats,
+                **self.handler_options),
+        ])
+
+    def connect(self, **kwargs):
+        return websocket_connect(
+            "ws://127.0.0.1:%d/ws" % self.get_http_port(),
+            io_loop=self.io_loop, **kwargs)
+
+    def echo(self, connection, message):
+        connection.write_message(json.dumps({"service": "echo",
+                                             "message": message}))
+        return connection.read_message()
+
+    @gen.coroutine
+    def echo_twice(self, connection):
+        """Echoes a long message twice and returns the bytes sent each
+        time."""
+        long_message = "delta " * 100
+        sizes = []
+        for i in range(2):
+            sent_bytes = self.stats.sent_bytes
+            reply = yield self.echo(connection, long_message)
+            self.assertEqual(json.loads(reply)["message"], long_message)
+            sizes.append(self.stats.sent_bytes - sent_bytes)
+        raise gen.Return(sizes)
+
+
+class TestCompression(CompressionTestCase):
+    @gen_test
+    def test_threshold(self):
+        connection = yield self.connect(compression_options={})
+
+        reply = yield self.echo(connection, "short")
+        self.assertEqual(json.loads(reply)["message"], "short")
+        self.assertEqual(self.stats.compressed_messages, 0)
+        # Only the 2 bytes of the frame header are added
+        self.assertEqual(self.stats.sent_bytes, self.stats.raw_bytes + 2)
+
+        sizes = yield self.echo_twice(connection)
+        # The second message is compressed against the first one
+        self.assertLess(sizes[1], sizes[0])
+
+        self.assertEqual(self.stats.messages, 3)
+        self.assertEqual(self.stats.compressed_messages, 2)
+        self.assertGreater(self.stats.ratio, 5)
+
+    @gen_test
+    def test_client_without_compression(self):
+        connection = yield self.connect()
+
+        reply = yield self.echo(connection, "delta " * 100)
+        self.assertEqual(json.loads(reply)["message"], "delta " * 100)
+        self.assertEqual(self.stats.compressed_messages, 0)
+        # Only the 4 bytes of the frame header are added
+        self.assertEqual(self.stats.sent_bytes, self.stats.raw_bytes + 4)
+
+
+class TestNoContextTakeover(CompressionTestCase):
+    handler_options = dict(CompressionTestCase.handler_options,
+                           context_takeover=False,
+                           compression_level=9)
+
+    @gen_test
+    def test_no_context_takeover(self):
+        connection = yield self.connect(compression_options={})
+        self.assertIn("server_no_context_takeover",
+                      connection.headers["Sec-WebSocket-Extensions"])
+
+        sizes = yield self.echo_twice(connection)
+        # Without a shared context, both messages take the same space
+        self.assertEqual(sizes[0], sizes[1])
+
+
+class TestBatching(AsyncHTTPTestCase):
+    def get_app(self):
+        self.stats = CompressionStats()
+        registry = ServiceRegistry([BurstService("burst")])
+        return Application([
+            SnorkyWebSocketHandler.get_route(
+                registry, "/ws", ping_pong_interval=0, stats=self.stats),
+        ])
+
+    @gen.coroutine
+    def burst(self, query, codec=None):
+        request = HTTPRequest("ws://127.0.0.1:%d/ws%s"
+                              % (self.get_http_port(), query))
+        if codec is not None:
+            request.headers["Sec-WebSocket-Protocol"] = codec.subprotocol
+        else:
+            codec = JSONCodec()
+        connection = yield websocket_connect(request, io_loop=self.io_loop)
+        connection.write_message(codec.dumps({"service": "burst",
+                                              "message": 3}),
+                                 binary=codec.binary)
+        frame = yield connection.read_message()
+        raise gen.Return(frame)
+
+    @gen_test
+    def test_batch(self):
+        frame = yield self.burst("?batch=1")
+        self.assertEqual(json.loads(frame), [
+            {"service": "burst", "message": i} for i in range(3)
+        ])
+        self.assertEqual(self.stats.messages, 1)
+
+    @gen_test
+    def test_no_batch(self):
+        frame = yield self.burst("")
+        self.assertEqual(json.loads(frame),
+                         {"service": "burst", "message": 0})
+
+    @gen_test
+    def test_batch_binary(self):
+        codec = MsgpackCodec()
+        if not codec.available:
+            self.skipTest("msgpack is not installed")
+
+        frame = yield self.burst("?batch=1", codec)
+        self.assertEqual(codec.loads(frame), [
+            {"service": "burst", "message": i} for i in range(3)
+        ])
+
+
+class TestPendingCounters(AsyncHTTPTestCase):
+    def get_app(self):
+        self.service = BurstService("burst")
+        self.slow_consumer_stats = SlowConsumerStats()
+        registry = ServiceRegistry([self.service])
+        return Application([
+            SnorkyWebSocketHandler.get_route(
+                registry, "/ws", ping_pong_interval=0,
+                max_pending_messages=1000,
+                slow_consumer_stats=self.slow_consumer_stats),
+        ])
+
+    @gen_test
+    def test_counters_drain(self):
+        connection = yield websocket_connect(
+            "ws://127.0.0.1:%d/ws" % self.get_http_port(),
+            io_loop=self.io_loop)
+        connection.write_message(json.dumps({"service": "burst",
+                                             "message": 200}))
+        for i in range(200):
+            message = yield connection.read_message()
+            self.assertEqual(json.loads(message)["message"], i)
+
+        # Every write of the installed Tornado resolves its own future
+        client = self.service.client
+        for i in range(100):
+            if client.pending_messages == 0:
+                break
+            yield gen.sleep(0.01)
+        self.assertEqual(client.pending_messages, 0)
+        self.assertEqual(client.pending_bytes, 0)
+        self.assertEqual(self.slow_consumer_stats.dropped_messages, 0)
+
+
+class FakeHandler(object):
+    def __init__(self, **options):
+        self.service_registry = ServiceRegistry()
+        self.ws_connection = object()
+        self.written = []
+        self.futures = []
+        self.close = Mock()
+
+        self.max_pending_messages = None
+        self.max_pending_bytes = None
+        self.slow_consumer_policy = "drop_oldest"
+        self.conflation_key = None
+        self.slow_consumer_close_code = 1013
+        self.slow_consumer_stats = SlowConsumerStats()
+        for name, value in options.items():
+            setattr(self, name, value)
+
+    def has_outbox_limits(self):
+        return (self.max_pending_messages is not None or
+                self.max_pending_bytes is not None)
+
+    def write_message(self, data, binary=False):
+        self.written.append(json.loads(data))
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def flush_network(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.set_result(None)
+
+
+class TestSlowConsumer(unittest.TestCase):
+    def make_client(self, **options):
+        self.handler = FakeHandler(**options)
+        self.stats = self.handler.slow_consumer_stats
+        return WebSocketClient(self.handler)
+
+    def test_no_limits(self):
+        client = self.make_client()
+        for i in range(100):
+            client.send(i)
+        self.assertEqual(self.handler.written, list(range(100)))
+        self.assertEqual(client.pending_messages, 0)
+
+    def test_high_water_mark(self):
+        client = self.make_client(max_pending_messages=2)
+        for i in range(4):
+            client.send(i)
+        self.assertEqual(self.handler.written, [0, 1])
+        self.assertEqual(len(client.outbox), 2)
+
+        self.handler.flush_network()
+        self.assertEqual(self.handler.written, [0, 1, 2, 3])
+        self.assertEqual(client.pending_messages, 2)
+        self.handler.flush_network()
+        self.assertEqual(client.pending_messages, 0)
+        self.assertEqual(client.pending_bytes, 0)
+
+    def test_drop_oldest(self):
+        client = self.make_client(max_pending_bytes=2)
+        for i in range(6):
+            client.send(i)
+        # 0 and 1 are written, only two messages of one byte fit in the
+        # outbox
+        self.assertEqual(self.handler.written, [0, 1])
+        self.assertEqual(self.stats.dropped_messages, 2)
+        self.assertEqual(self.stats.dropped_bytes, 2)
+
+        self.handler.flush_network()
+        self.assertEqual(self.handler.written, [0, 1, 4, 5])
+
+    def test_conflate(self):
+        client = self.make_client(
+            max_pending_messages=2, slow_consumer_policy="conflate",
+            conflation_key=lambda msg: msg.get("cursor"))
+        for cursor, position in [("a", 0), ("a", 1), ("b", 1), ("a", 2),
+                                 ("b", 2), ("a", 3)]:
+            client.send({"cursor": cursor, "position": position})
+        self.assertEqual(self.stats.conflated_messages, 2)
+        self.assertEqual(self.stats.dropped_messages, 0)
+
+        # Conflation is not enough, the oldest message is dropped
+        client.send({"text": "hello"})
+        self.assertEqual(self.stats.dropped_messages, 1)
+
+        self.handler.flush_network()
+        self.assertEqual(self.handler.written, [
+            {"cursor": "a", "position": 0},
+            {"cursor": "a", "position": 1},
+            {"cursor": "a", "position": 3},
+            {"text": "hello"},
+        ])
+
+    def test_conflate_requires_key(self):
+        with self.assertRaises(ValueError):
+            SnorkyWebSocketHandler(None, None,
+                                   service_registry=ServiceRegistry(),
+                                   slow_consumer_policy="conflate")
+
+    def test_batch_bounded(self):
+        client = self.make_client(max_pending_messages=2)
+        client.batch = True
+        for i in range(3):
+            client.send(i)
+        # The outbox overflowed, so the batch is written early
+        self.assertEqual(self.handler.written, [[0, 1, 2]])
+        self.assertEqual(len(client.outbox), 0)
+
+        # The connection is congested now, so the outbox is bounded by the
+        # slow consumer policy
+        for i in range(3, 8):
+            client.send(i)
+        self.assertEqual(list(msg for msg, data in client.outbox), [6, 7])
+        self.assertEqual(self.stats.dropped_messages, 3)
+
+        self.handler.flush_network()
+        self.assertEqual(self.handler.written, [[0, 1, 2], [6, 7]])
+
+    def test_disconnect(self):
+        client = self.make_client(max_pending_messages=1,
+                                  slow_consumer_policy="disconnect")
+        for i in range(3):
+            client.send(i)
+        self.handler.close.assert_called_once_with(1013, "Slow consumer")
+        self.assertEqual(self.stats.disconnections, 1)
+        self.assertEqual(len(client.outbox), 0)
+
+    def test_closed(self):
+        client = self.make_client(max_pending_messages=1)
+        client.send(0)
+        client.send(1)
+        self.handler.ws_connection = None
+        self.handler.flush_network()
+        self.assertEqual(self.handler.written, [0])
+        self.assertEqual(len(client.outbox), 0)
+
+
+class CountingCodec(JSONCodec):
+    def __init__(self):
+        self.calls = 0
+
+    def dumps(self, obj):
+        self.calls += 1
+        return super(CountingCodec, self).dumps(obj)
+
+
+class TestRegistryCodec(unittest.TestCase):
+    def test_shared_message(self):
+        codec = CountingCodec()
+        clients = []
+        for i in range(3):
+            handler = FakeHandler()
+            handler.service_registry = ServiceRegistry(codec=codec)
+            clients.append(WebSocketClient(handler))
+
+        EchoService("echo").send_message_to_many(clients, "hello")
+        self.assertEqual(codec.calls, 1)
+        for client in clients:
+            self.assertEqual(client.req_handler.written,
+                             [{"service": "echo", "message": "hello"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
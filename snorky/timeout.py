@@ -3,6 +3,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from tornado.ioloop import IOLoop
+from snorky.log import snorky_log
+import math
 
 
 class TornadoTimeoutHandle(object):
@@ -38,3 +40,175 @@ class _TornadoTimeoutFactory(object):
 
 
 TornadoTimeoutFactory = _TornadoTimeoutFactory()
+
+
+class TimerWheelHandle(object):
+    """Represents a handle to a timeout of a :class:`TimerWheel`."""
+    __slots__ = ('expires', 'callback', 'args', 'kwargs', 'bucket', 'wheel',
+                 'cancelled')
+
+    def __init__(self, wheel, expires, callback, args, kwargs):
+        self.wheel = wheel
+        self.expires = expires
+        """Tick in which the timeout expires."""
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.bucket = None
+        """Slot of the wheel the timeout is in, ``None`` once it has run."""
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancels the timeout."""
+        if self.cancelled:
+            raise RuntimeError("Already cancelled")
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+            self.wheel.count -= 1
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """Timeout factory keeping its timeouts in a hierarchical timing wheel.
+
+    Time is divided in ticks of ``resolution`` seconds. The first level of
+    the wheel has a slot for each of the next 256 ticks, and each following
+    level has 64 slots, each one spanning a full turn of the previous level.
+    Scheduling and cancelling a timeout are O(1) operations. A single IOLoop
+    timeout per tick advances the wheel while there are timeouts pending, and
+    the timeouts of the higher levels are moved down a level each time the
+    previous one completes a turn.
+
+    Timeouts run at most one tick late, and never early. Timeouts further
+    than the range of the wheel (around 77 days at the default resolution)
+    are moved down until they fit.
+    """
+    level_bits = (8, 6, 6, 6)
+    """Number of slots of each level, as powers of two."""
+
+    def __init__(self, resolution=0.1, io_loop=None):
+        self.resolution = resolution
+        """Duration of a tick in seconds."""
+
+        self._io_loop = io_loop
+
+        self.levels = [[set() for i in range(1 << bits)]
+                       for bits in self.level_bits]
+        """Slots of each level."""
+
+        self.shifts = []
+        """Position of the bits indexing each level in a tick number."""
+        shift = 0
+        for bits in self.level_bits:
+            self.shifts.append(shift)
+            shift += bits
+        self.max_ticks = (1 << shift) - 1
+
+        self.current_tick = None
+        """Next tick to be run."""
+
+        self.count = 0
+        """Number of timeouts pending."""
+
+        self.ticking = False
+
+    @property
+    def io_loop(self):
+        if self._io_loop is None:
+            self._io_loop = IOLoop.instance()
+        return self._io_loop
+
+    def now_tick(self):
+        return int(self.io_loop.time() / self.resolution)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """Returns a :class:`TimerWheelHandle` for a timeout which will
+        execute the provided callback with provided arguments in the
+        specified delay in seconds, starting to count from now.
+        """
+        now = self.io_loop.time()
+        if self.count == 0:
+            # Every slot is empty, so the wheel can jump to the present.
+            now_tick = int(now / self.resolution)
+            if self.current_tick is None or self.current_tick < now_tick:
+                self.current_tick = now_tick
+
+        expires = int(math.ceil((now + delay) / self.resolution))
+        handle = TimerWheelHandle(self, expires, callback, args, kwargs)
+        self.insert(handle)
+        self.count += 1
+
+        if not self.ticking:
+            self.ticking = True
+            self.io_loop.call_later(self.resolution, self.tick)
+        return handle
+
+    def insert(self, handle):
+        """Puts a timeout in the slot of the level corresponding to how far
+        its expiration is."""
+        expires = max(handle.expires, self.current_tick)
+        ticks = expires - self.current_tick
+        if ticks > self.max_ticks:
+            expires = self.current_tick + self.max_ticks
+            ticks = self.max_ticks
+
+        for level, shift, bits in zip(self.levels, self.shifts,
+                                      self.level_bits):
+            if ticks < 1 << (shift + bits):
+                break
+        bucket = level[(expires >> shift) & ((1 << bits) - 1)]
+        bucket.add(handle)
+        handle.bucket = bucket
+
+    def cascade(self, level_number):
+        """Moves the timeouts of the current slot of a level to the lower
+        levels, cascading the next level too if this one completed a
+        turn."""
+        shift = self.shifts[level_number]
+        index = ((self.current_tick >> shift) &
+                 ((1 << self.level_bits[level_number]) - 1))
+        if index == 0 and level_number + 1 < len(self.levels):
+            self.cascade(level_number + 1)
+
+        bucket = self.levels[level_number][index]
+        self.levels[level_number][index] = set()
+        for handle in bucket:
+            self.insert(handle)
+
+    def advance(self):
+        """Runs the timeouts of every tick up to now."""
+        now_tick = self.now_tick()
+        first_level = self.levels[0]
+        mask = len(first_level) - 1
+
+        while self.count and self.current_tick <= now_tick:
+            index = self.current_tick & mask
+            if index == 0:
+                self.cascade(1)
+
+            bucket = first_level[index]
+            first_level[index] = set()
+            # Timeouts added by the callbacks belong to the following ticks
+            self.current_tick += 1
+
+            for handle in list(bucket):
+                if handle.bucket is not bucket:
+                    # Cancelled by a previous callback
+                    continue
+                handle.bucket = None
+                self.count -= 1
+                try:
+                    handle.callback(*handle.args, **handle.kwargs)
+                except Exception:
+                    snorky_log.exception("Exception in timeout callback")
+
+    def tick(self):
+        self.advance()
+        if self.count:
+            self.io_loop.call_later(self.resolution, self.tick)
+        else:
+            self.ticking = False
+
+
+TimerWheelTimeoutFactory = TimerWheel()